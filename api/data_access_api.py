@@ -1,20 +1,26 @@
-from multiprocessing.pool import ThreadPool
-from zipfile import ZipFile, ZIP_STORED
+import zlib
+from collections import namedtuple
+from functools import partial
+from time import localtime
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from flask import Blueprint, request, abort, json, Response
 
 # noinspection PyUnresolvedReferences
 from config import load_django
 
 from config.constants import (API_TIME_FORMAT, VOICE_RECORDING, ALL_DATA_STREAMS,
-    SURVEY_ANSWERS, SURVEY_TIMINGS, IMAGE_FILE)
+    SURVEY_ANSWERS, SURVEY_TIMINGS, IMAGE_FILE, DATA_ACCESS_MAX_BUFFERED_BYTES,
+    DATA_ACCESS_MAX_CONCURRENCY, DATA_ACCESS_STREAM_THRESHOLD, DATA_ACCESS_WATERMARK_LAG_SECONDS)
 from database.models import is_object_id
 from database.data_access_models import ChunkRegistry, PipelineRegistry
 from database.study_models import Study
 from database.user_models import Participant, Researcher, StudyRelation
-from libs.s3 import s3_retrieve, s3_upload
-from libs.streaming_bytes_io import StreamingBytesIO
+from libs.download_registry import decode_registry, encode_registry, InvalidRegistry
+from libs.s3 import S3Stream, s3_retrieve, s3_retrieve_stream, s3_upload
+from libs.streaming_bytes_io import UnseekableStreamingBytesIO
+from libs.threaded_pipeline import AdaptiveConcurrency, imap_adaptive
 
 from database.data_access_models import PipelineUpload, InvalidUploadParameterError, \
     PipelineUploadTags
@@ -26,7 +32,16 @@ from database.data_access_models import PipelineUpload, InvalidUploadParameterEr
 
 data_access_api = Blueprint('data_access_api', __name__)
 
-class DummyError(Exception): pass
+# values of the compression parameter of get-data, and the zip compression they use.
+ZIP_COMPRESSION_TYPES = {"none": ZIP_STORED, "deflate": ZIP_DEFLATED}
+# audio and images are already compressed, they are always stored as-is.
+ALREADY_COMPRESSED_EXTENSIONS = (".mp4", ".m4a", ".jpg", ".jpeg", ".png")
+
+# High-water marks have microseconds, updated_since also accepts API_TIME_FORMAT.
+WATERMARK_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# A file compressed for the zip on a download thread, see deflate.
+CompressedFile = namedtuple("CompressedFile", ["data", "crc", "size"])
 
 #########################################################################################
 
@@ -162,6 +177,20 @@ def get_data():
     JSON blobs: data streams, users - default to all
     Strings: date-start, date-end - format as "YYYY-MM-DDThh:mm:ss"
     optional: top-up = a file (registry.dat)
+    optional: registry = the registry of files already downloaded, either a json dictionary of chunk
+        paths to chunk hashes, or an uploaded file in the binary format of libs.download_registry, whose
+        watermark (which may be all it contains) limits the download to files updated since.
+    optional: registry_format = "binary" to get the registry in the zip in the binary format, as
+        registry.bin, with the watermark to send next time.  Default is "json", as registry.
+    optional: updated_since = only get files updated after this time (UTC), format as
+        "YYYY-MM-DDThh:mm:ss.ffffff" or "YYYY-MM-DDThh:mm:ss".  The zip contains a manifest.json with the
+        high_water_mark to send as updated_since next time, with the same other parameters, to get
+        only the files updated in between.  Files updated shortly before a download (see
+        DATA_ACCESS_WATERMARK_LAG_SECONDS) are in the next download as well.
+    optional: ordered = "true" to get the files in the zip in a deterministic order (by chunk path),
+        by default they are in whatever order they finish downloading, which is faster.
+    optional: compression = "deflate" to compress the files in the zip (csv files shrink 5-10x),
+        default is "none".  Any zip tool can extract either.
     cases handled:
         missing creds or study, invalid researcher or study, researcher does not have access
         researcher creds are invalid
@@ -180,24 +209,61 @@ def get_data():
     determine_users_for_db_query(query)  # select users
     determine_time_range_for_db_query(query)  # construct time ranges
 
+    ordered = request.values.get("ordered", "").lower() == "true"
+    compression = request.values.get("compression", "none").lower()
+    if compression not in ZIP_COMPRESSION_TYPES:
+        print("compression '%s' is invalid" % compression)
+        return abort(400)
+    compression = ZIP_COMPRESSION_TYPES[compression]
+
+    registry_format = request.values.get("registry_format", "json").lower()
+    if registry_format not in ("json", "binary"):
+        print("registry format '%s' is invalid" % registry_format)
+        return abort(400)
+
+    updated_since = None
+    if request.values.get("updated_since"):
+        updated_since = str_to_watermark(request.values["updated_since"])
+
+    # Chunks are registered in transactions, so a chunk can become visible after chunks with later
+    # last_updated times. Any chunk last updated DATA_ACCESS_WATERMARK_LAG_SECONDS before now is visible,
+    # so that is the high-water mark: files updated after it may be downloaded twice, but never missed.
+    high_water_mark = datetime.now(timezone.utc) - timedelta(seconds=DATA_ACCESS_WATERMARK_LAG_SECONDS)
+
     # Do query (this is actually a generator)
-    if "registry" in request.values:
-        get_these_files = handle_database_query(study.pk, query, registry=parse_registry(request.values["registry"]))
+    if "registry" in request.files:
+        registry, watermark = parse_binary_registry(request.files["registry"].read())
+        if watermark and (updated_since is None or watermark > updated_since):
+            updated_since = watermark
+        get_these_files = handle_database_query(
+            study.pk, query, registry=registry, updated_since=updated_since, ordered=ordered
+        )
+    elif "registry" in request.values:
+        get_these_files = handle_database_query(
+            study.pk, query, registry=parse_registry(request.values["registry"]), updated_since=updated_since,
+            ordered=ordered
+        )
     else:
-        get_these_files = handle_database_query(study.pk, query, registry=None)
+        get_these_files = handle_database_query(
+            study.pk, query, registry=None, updated_since=updated_since, ordered=ordered
+        )
+
+    if updated_since and updated_since > high_water_mark:
+        high_water_mark = updated_since
 
     # If the request is from the web form we need to indicate that it is an attachment,
     # and don't want to create a registry file.
     # Oddly, it is the presence of  mimetype=zip that causes the streaming response to actually stream.
     if 'web_form' in request.values:
         return Response(
-            zip_generator(get_these_files, construct_registry=False),
+            zip_generator(get_these_files, construct_registry=False, ordered=ordered, compression=compression),
             mimetype="zip",
             headers={'Content-Disposition': 'attachment; filename="data.zip"'}
         )
     else:
         return Response(
-                zip_generator(get_these_files, construct_registry=True),
+                zip_generator(get_these_files, construct_registry=True, ordered=ordered, compression=compression,
+                              registry_format=registry_format, high_water_mark=high_water_mark),
                 mimetype="zip",
         )
 
@@ -205,75 +271,168 @@ def get_data():
 # from libs.security import generate_random_string
 
 # Note: you cannot access the request context inside a generator function
-def zip_generator(files_list, construct_registry=False):
+def zip_generator(files_list, construct_registry=False, ordered=False, compression=ZIP_STORED,
+                  registry_format="json", high_water_mark=None):
     """ Pulls in data from S3 in a multithreaded network operation, constructs a zip file of that
     data. This is a generator, advantage is it starts returning data (file by file, but wrapped
-    in zip compression) almost immediately. """
+    in zip compression) almost immediately.  Files are in the order of files_list if ordered is
+    True, otherwise in the order they finish downloading.  With ZIP_DEFLATED compression files are
+    compressed on the download threads (see deflate), except large ones which are compressed as they
+    stream into the zip.  With a high_water_mark the zip ends with a manifest.json, and it is the
+    watermark of a binary registry. """
 
     processed_files = set()
     duplicate_files = set()
-    pool = ThreadPool(3)
-    # 3 Threads has been heuristically determined to be a good value, it does not cause the server
-    # to be overloaded, and provides more-or-less the maximum data download speed.  This was tested
-    # on an m4.large instance (dual core, 8GB of ram).
     file_registry = {}
 
-    zip_output = StreamingBytesIO()
-    zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
+    zip_output = UnseekableStreamingBytesIO()
+    zip_input = ZipFile(zip_output, mode="w", compression=compression, allowZip64=True)
     # random_id = generate_random_string()[:32]
     # print "returning data for query %s" % random_id
+
+    # chunks_and_content is a generator of tuples, of the chunk and the content of the file (or a
+    # stream of it, for large files), see fetch_files.
+    fetch_function = partial(batch_retrieve_s3, compress=compression == ZIP_DEFLATED)
+    chunks_and_content = fetch_files(fetch_function, files_list, chunk_fetch_cost, ordered)
     try:
-        # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-        # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-        # is the size of the batches that are handed to the pool. We always want to add the next
-        # file to retrieve to the pool asap, so we want a chunk size of 1.
-        # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-        chunks_and_content = pool.imap_unordered(batch_retrieve_s3, files_list, chunksize=1)
-        total_size = 0
         for chunk, file_contents in chunks_and_content:
             if construct_registry:
                 file_registry[chunk['chunk_path']] = chunk["chunk_hash"]
             file_name = determine_file_name(chunk)
             if file_name in processed_files:
                 duplicate_files.add((file_name, chunk['chunk_path']))
+                if isinstance(file_contents, S3Stream):
+                    file_contents.close()
                 continue
             processed_files.add(file_name)
             # print file_name
-            zip_input.writestr(file_name, file_contents)
-            # These can be large, and we don't want them sticking around in memory as we wait for the yield
+            # yields the (compressed) file information as it is written
+            if isinstance(file_contents, CompressedFile):
+                yield from write_compressed_into_zip(zip_input, zip_output, file_name, file_contents)
+            else:
+                compress_type = compression if is_compressible(chunk["chunk_path"]) else ZIP_STORED
+                yield from stream_into_zip(
+                    zip_input, zip_output, file_name, file_contents, compress_type, chunk["file_size"]
+                )
             del file_contents, chunk
-            # print len(zip_output)
-            x = zip_output.getvalue()
-            total_size += len(x)
-            # print "%s: %sK, %sM" % (random_id, total_size / 1024, total_size / 1024 / 1024)
-            yield x  # yield the (compressed) file information
-            del x
-            zip_output.empty()
 
-        if construct_registry:
+        if construct_registry and registry_format == "binary":
+            zip_input.writestr("registry.bin", encode_registry(file_registry, high_water_mark))
+            yield zip_output.getvalue()
+            zip_output.empty()
+        elif construct_registry:
             zip_input.writestr("registry", json.dumps(file_registry))
             yield zip_output.getvalue()
             zip_output.empty()
 
+        if high_water_mark:
+            manifest = {
+                "high_water_mark": high_water_mark.strftime(WATERMARK_TIME_FORMAT),
+                "file_count": len(processed_files),
+            }
+            zip_input.writestr("manifest.json", json.dumps(manifest))
+            yield zip_output.getvalue()
+            zip_output.empty()
+
         # close, then yield all remaining data in the zip.
         zip_input.close()
         yield zip_output.getvalue()
 
-    except DummyError:
-        # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
-        # we don't handle any errors, we just re-raise any error that shows up.
-        # (with statement does not work.)
-        raise
     finally:
-        # We rely on the finally block to ensure that the threadpool will be closed and terminated,
-        # and also to print an error to the log if we need to.
-        pool.close()
-        pool.terminate()
+        # Closing the generator stops the downloads and waits for any in progress.
+        chunks_and_content.close()
         # if duplicate_files:
         #     duplcate_file_message = "encountered duplicate files: %s" % ",".join(
         #             str(name_path) for name_path in duplicate_files)
 
 
+def fetch_files(fetch_function, files_list, cost_function, ordered):
+    """ Runs fetch_function on every file, yielding (file, fetched data).  The number of downloads
+    running at once adapts to the throughput and latency S3 delivers, from the 3 that were found to
+    be a good value on an m4.large instance (dual core, 8GB of ram) up to DATA_ACCESS_MAX_CONCURRENCY.
+    Downloads pause while the files downloaded but not yet written to the zip (as estimated by
+    cost_function) add up to more than DATA_ACCESS_MAX_BUFFERED_BYTES.  Streamed files cost nothing
+    here, they are downloaded as they are written to the zip (see s3_retrieve_stream). """
+    concurrency = AdaptiveConcurrency(initial=3, minimum=1, maximum=DATA_ACCESS_MAX_CONCURRENCY)
+    return imap_adaptive(
+        fetch_function, files_list, cost_function, DATA_ACCESS_MAX_BUFFERED_BYTES, concurrency, ordered=ordered
+    )
+
+
+def is_streamed(file_size):
+    """ Files of unknown size and files larger than DATA_ACCESS_STREAM_THRESHOLD are streamed into the
+    zip as they download, smaller files are downloaded whole (which is faster) before being written. """
+    return file_size is None or file_size > DATA_ACCESS_STREAM_THRESHOLD
+
+
+def chunk_fetch_cost(chunk):
+    """ The memory a chunk uses from the time it is downloaded until it is written to the zip.
+    Chunks whose file_size predates scripts/populate_chunk_file_size.py may record the size of a
+    compressed copy, and be larger than this (see ChunkRegistry.file_size). """
+    if is_streamed(chunk["file_size"]):
+        return 0
+    return chunk["file_size"]
+
+
+def stream_into_zip(zip_input, zip_output, file_name, blocks, compress_type=ZIP_STORED, file_size=None):
+    """ Writes a file into the zip block by block, yielding the zip data after every block, so the
+    file is never fully in memory.  zip_output must be an UnseekableStreamingBytesIO.  blocks is the
+    file's contents or an S3Stream of them, which is closed when done.  file_size is the size of the
+    contents, if it is known.  The zip64 extension, which files over 2GiB need, has to be chosen before
+    the file is written, so files of unknown size always use it. """
+    if isinstance(blocks, bytes):
+        file_size = len(blocks)
+    # the same file information that ZipFile.writestr uses
+    zip_info = ZipInfo(file_name, date_time=localtime()[:6])
+    zip_info.compress_type = compress_type
+    zip_info.external_attr = 0o600 << 16
+    if file_size is not None:
+        zip_info.file_size = file_size
+    try:
+        with zip_input.open(zip_info, mode="w", force_zip64=file_size is None) as zip_file:
+            for block in ((blocks,) if isinstance(blocks, bytes) else blocks):
+                zip_file.write(block)
+                del block
+                yield zip_output.getvalue()
+                zip_output.empty()
+    finally:
+        if isinstance(blocks, S3Stream):
+            blocks.close()
+    # the data descriptor, written when the file is closed
+    yield zip_output.getvalue()
+    zip_output.empty()
+
+
+def is_compressible(chunk_path):
+    return not chunk_path.lower().endswith(ALREADY_COMPRESSED_EXTENSIONS)
+
+
+def deflate(data):
+    """ Compresses a file's contents for the zip, as ZipFile would with ZIP_DEFLATED.  This runs on the
+    download threads, zlib releases the GIL so files are compressed in parallel. """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return CompressedFile(compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data))
+
+
+def write_compressed_into_zip(zip_input, zip_output, file_name, compressed_file):
+    """ Adds a file compressed by deflate to the zip.  ZipFile can only add files that it compresses
+    itself, so this writes the file header and data and registers the file with zip_input (for the
+    zip's central directory) the way ZipFile.writestr does. """
+    zip_info = ZipInfo(file_name, date_time=localtime()[:6])
+    zip_info.compress_type = ZIP_DEFLATED
+    zip_info.external_attr = 0o600 << 16
+    zip_info.file_size = compressed_file.size
+    zip_info.compress_size = len(compressed_file.data)
+    zip_info.CRC = compressed_file.crc
+    zip_info.header_offset = zip_output.tell()
+    zip_output.write(zip_info.FileHeader())
+    zip_output.write(compressed_file.data)
+    zip_input.filelist.append(zip_info)
+    zip_input.NameToInfo[zip_info.filename] = zip_info
+    zip_input.start_dir = zip_output.tell()
+    yield zip_output.getvalue()
+    zip_output.empty()
+
 
 #########################################################################################
 
@@ -292,6 +451,16 @@ def parse_registry(reg_dat):
     return ret
 
 
+def parse_binary_registry(registry_file_data):
+    """ Parses an uploaded registry in the binary format of libs.download_registry, returns a
+    dictionary of chunk paths and hashes, and the watermark. """
+    try:
+        return decode_registry(registry_file_data)
+    except InvalidRegistry as e:
+        print("invalid binary registry: %s" % e)
+        return abort(400)
+
+
 def determine_file_name(chunk):
     """ Generates the correct file name to provide the file with in the zip file.
         (This also includes the folder location files in the zip.) """
@@ -342,11 +511,28 @@ def str_to_datetime(time_string):
             return abort(400)
 
 
-def batch_retrieve_s3(chunk):
-    """ Data is returned in the form (chunk_object, file_data). """
-    return chunk, s3_retrieve(chunk["chunk_path"],
-                              study_object_id=Study.objects.get(id=chunk["study_id"]).object_id,
-                              raw_path=True)
+def str_to_watermark(time_string):
+    """ Translates a UTC time string, with or without microseconds, to a timezone aware datetime object,
+    raises a 400 if the format is wrong. """
+    for time_format in (WATERMARK_TIME_FORMAT, API_TIME_FORMAT):
+        try:
+            return datetime.strptime(time_string, time_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return abort(400)
+
+
+def batch_retrieve_s3(chunk, compress=False):
+    """ Returns the file's data, or a stream of it for files that are streamed (see is_streamed).  If
+    compress is True the data is returned compressed, as a CompressedFile, unless it is streamed or
+    already compressed. """
+    study_object_id = Study.objects.filter(id=chunk["study_id"]).values_list("object_id", flat=True).get()
+    if is_streamed(chunk["file_size"]):
+        return s3_retrieve_stream(chunk["chunk_path"], study_object_id=study_object_id, raw_path=True)
+    data = s3_retrieve(chunk["chunk_path"], study_object_id=study_object_id, raw_path=True)
+    if compress and is_compressible(chunk["chunk_path"]):
+        return deflate(data)
+    return data
 
 
 #########################################################################################
@@ -400,36 +586,35 @@ def determine_time_range_for_db_query(query):
         query['end'] = str_to_datetime(request.values['time_end'])
 
 
-def handle_database_query(study_id, query, registry=None):
+def handle_database_query(study_id, query, registry=None, updated_since=None, ordered=False):
     """
-    Runs the database query and returns a QuerySet.
+    Runs the database query and returns an iterable of chunk dictionaries, ordered by chunk path if
+    ordered is True.  Chunks that are in the registry (a dictionary of chunk paths to chunk hashes)
+    with the same hash are left out, as are chunks last updated at or before updated_since.
     """
     chunk_fields = ["pk", "participant_id", "data_type", "chunk_path", "time_bin", "chunk_hash",
-                    "participant__patient_id", "study_id", "survey_id", "survey__object_id"]
+                    "participant__patient_id", "study_id", "survey_id", "survey__object_id", "file_size"]
 
     chunks = ChunkRegistry.get_chunks_time_range(study_id, **query)
+    if updated_since:
+        chunks = chunks.filter(last_updated__gt=updated_since)
+    if ordered:
+        chunks = chunks.order_by("chunk_path")
 
     if not registry:
         return chunks.values(*chunk_fields)
 
-    # If there is a registry, we need to filter the chunks
-    else:
-        # Get all chunks whose path and hash are both in the registry
-        possible_registered_chunks = (
-            chunks
-            .filter(chunk_path__in=registry, chunk_hash__in=registry.values())
-            .values('pk', 'chunk_path', 'chunk_hash')
-        )
+    # If there is a registry, we need to filter the chunks.  Registries of mature studies have hundreds
+    # of thousands of entries, far too many to send to the database, so the chunks are streamed out of
+    # the database and each one is looked up in the registry (a dictionary) by its path and hash.
+    return unregistered_chunks(chunks.values(*chunk_fields).iterator(), registry)
 
-        # determine those chunks that we do not want present in the download
-        # (get a list of pks that have hashes that don't match the database)
-        registered_chunk_pks = [
-            c['pk'] for c in possible_registered_chunks if registry[c['chunk_path']] == c['chunk_hash']
-        ]
 
-        # add the exclude and return the queryset
-        unregistered_chunks = chunks.exclude(pk__in=registered_chunk_pks)
-        return unregistered_chunks.values(*chunk_fields)
+def unregistered_chunks(chunks, registry):
+    """ Yields the chunks whose path is not in the registry, or whose hash has changed since. """
+    for chunk in chunks:
+        if registry.get(chunk["chunk_path"]) != chunk["chunk_hash"]:
+            yield chunk
 
 
 #########################################################################################
@@ -481,7 +666,7 @@ def data_pipeline_upload():
         return Response(str(e), 400)
     s3_upload(
             creation_args['s3_path'],
-            request.files['file'].read(),
+            request.files['file'],  # read and encrypted as it is uploaded
             Study.objects.get(id=creation_args['study_id']).object_id,
             raw_path=True
     )
@@ -573,46 +758,31 @@ def pipeline_data_download():
 
 #TODO: This is a trivial rewrite of the other zip generator function for minor differences. refactor when you get to django.
 def zip_generator_for_pipeline(files_list):
-    pool = ThreadPool(3)
-    zip_output = StreamingBytesIO()
+    zip_output = UnseekableStreamingBytesIO()
     zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
+    # pipeline_uploads_and_content is a generator of tuples, of the pipeline upload and a stream of the
+    # content of the file, see zip_generator.  Their sizes are not recorded, so all of them are streamed.
+    pipeline_uploads_and_content = fetch_files(
+        batch_retrieve_pipeline_s3, files_list, lambda _: 0, ordered=False
+    )
     try:
-        # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-        # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-        # is the size of the batches that are handed to the pool. We always want to add the next
-        # file to retrieve to the pool asap, so we want a chunk size of 1.
-        # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-        chunks_and_content = pool.imap_unordered(batch_retrieve_pipeline_s3, files_list, chunksize=1)
-        for pipeline_upload, file_contents in chunks_and_content:
+        for pipeline_upload, file_contents in pipeline_uploads_and_content:
             # file_name = determine_file_name(chunk)
-            zip_input.writestr("data/" + pipeline_upload.file_name, file_contents)
-            # These can be large, and we don't want them sticking around in memory as we wait for the yield
+            yield from stream_into_zip(zip_input, zip_output, "data/" + pipeline_upload.file_name, file_contents)
             del file_contents, pipeline_upload
-            yield zip_output.getvalue()  # yield the (compressed) file information
-            zip_output.empty()
         
         # close, then yield all remaining data in the zip.
         zip_input.close()
         yield zip_output.getvalue()
     
-    except DummyError:
-        # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
-        # we don't handle any errors, we just re-raise any error that shows up.
-        # (with statement does not work.)
-        raise
     finally:
-        # We rely on the finally block to ensure that the threadpool will be closed and terminated,
-        # and also to print an error to the log if we need to.
-        pool.close()
-        pool.terminate()
+        pipeline_uploads_and_content.close()
         
         
 def batch_retrieve_pipeline_s3(pipeline_upload):
-    """ Data is returned in the form (chunk_object, file_data). """
+    """ Returns a stream of the file's data. """
     study = Study.objects.get(id = pipeline_upload.study_id)
-    return pipeline_upload, s3_retrieve(pipeline_upload.s3_path,
-                                        study.object_id,
-                                        raw_path=True)
+    return s3_retrieve_stream(pipeline_upload.s3_path, study.object_id, raw_path=True)
 
 
 # class dummy_threadpool():
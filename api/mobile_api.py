@@ -13,7 +13,8 @@ from database.user_models import Participant
 from libs.encryption import decrypt_device_file, DecryptionKeyInvalidError, HandledError
 from libs.http_utils import determine_os_api
 from libs.logging import log_error
-from libs.s3 import get_client_private_key, get_client_public_key_string, s3_upload
+from libs.s3 import (get_client_private_key, get_client_public_key_string, refresh_client_private_key,
+    s3_upload)
 from libs.sentry import make_sentry_client
 from libs.user_authentication import (authenticate_user, authenticate_user_registration,
     minimal_validation)
@@ -107,7 +108,16 @@ def upload(OS_API=""):
     
     client_private_key = get_client_private_key(patient_id, user.study.object_id)
     try:
-        uploaded_file = decrypt_device_file(patient_id, uploaded_file, client_private_key, user)
+        try:
+            decrypted_file = decrypt_device_file(patient_id, uploaded_file, client_private_key, user)
+        except (HandledError, DecryptionKeyInvalidError):
+            # The cached private key may have been replaced since (another process can not clear
+            # this one's cache), if so retry with the current key before the device deletes the file.
+            client_private_key = refresh_client_private_key(patient_id, user.study.object_id)
+            if client_private_key is None:
+                raise
+            decrypted_file = decrypt_device_file(patient_id, uploaded_file, client_private_key, user)
+        uploaded_file = decrypted_file
     except HandledError as e:
         # when decrypting fails, regardless of why, we rely on the decryption code
         # to log it correctly and return 200 OK to get the device to delete the file.
@@ -51,8 +51,71 @@ for mandatory_var in MANDATORY_VARS:
 
 # Environment variables might be unpredictable, so we sanitize the numerical ones as ints.
 constants.DEFAULT_S3_RETRIES = int(constants.DEFAULT_S3_RETRIES)
+constants.S3_MULTIPART_THRESHOLD = int(constants.S3_MULTIPART_THRESHOLD)
+constants.S3_MULTIPART_PART_SIZE = int(constants.S3_MULTIPART_PART_SIZE)
+constants.S3_MULTIPART_CONCURRENCY = int(constants.S3_MULTIPART_CONCURRENCY)
+constants.S3_MAX_POOL_CONNECTIONS = int(constants.S3_MAX_POOL_CONNECTIONS)
+constants.S3_CLIENT_RETRIES = int(constants.S3_CLIENT_RETRIES)
+constants.S3_CONNECT_TIMEOUT = float(constants.S3_CONNECT_TIMEOUT)
+constants.S3_READ_TIMEOUT = float(constants.S3_READ_TIMEOUT)
 constants.CONCURRENT_NETWORK_OPS = int(constants.CONCURRENT_NETWORK_OPS)
 constants.FILE_PROCESS_PAGE_SIZE = int(constants.FILE_PROCESS_PAGE_SIZE)
+constants.FILE_PROCESS_QUEUE_DEPTH = int(constants.FILE_PROCESS_QUEUE_DEPTH)
+constants.FILE_PROCESS_CPU_WORKERS = int(constants.FILE_PROCESS_CPU_WORKERS)
+constants.DATA_ACCESS_MAX_CONCURRENCY = int(constants.DATA_ACCESS_MAX_CONCURRENCY)
+constants.DATA_ACCESS_MAX_BUFFERED_BYTES = int(constants.DATA_ACCESS_MAX_BUFFERED_BYTES)
+constants.DATA_ACCESS_STREAM_THRESHOLD = int(constants.DATA_ACCESS_STREAM_THRESHOLD)
+constants.DATA_ACCESS_WATERMARK_LAG_SECONDS = int(constants.DATA_ACCESS_WATERMARK_LAG_SECONDS)
+constants.CLIENT_PRIVATE_KEY_CACHE_SIZE = int(constants.CLIENT_PRIVATE_KEY_CACHE_SIZE)
+constants.CLIENT_PRIVATE_KEY_CACHE_SECONDS = int(constants.CLIENT_PRIVATE_KEY_CACHE_SECONDS)
+constants.DEVICE_FILE_KEY_CACHE_SIZE = int(constants.DEVICE_FILE_KEY_CACHE_SIZE)
+constants.DEVICE_FILE_KEY_CACHE_SECONDS = int(constants.DEVICE_FILE_KEY_CACHE_SECONDS)
+constants.USE_COLUMNAR_FILE_PROCESSING = str(constants.USE_COLUMNAR_FILE_PROCESSING).upper() == "TRUE"
+constants.WRITE_LEGACY_SERVER_ENCRYPTION = str(constants.WRITE_LEGACY_SERVER_ENCRYPTION).upper() == "TRUE"
+
+if constants.S3_MULTIPART_PART_SIZE < 5 * 1024 * 1024:
+    errors.append("S3_MULTIPART_PART_SIZE must be at least 5 MiB (5242880), S3 rejects smaller parts.")
+
+# The pool is sized for the most S3 requests that one process makes at once:
+#   file processing downloads CONCURRENT_NETWORK_OPS files while uploading CONCURRENT_NETWORK_OPS
+#   chunks, each of which may be uploading S3_MULTIPART_CONCURRENCY parts at once.
+#   the data access api downloads up to DATA_ACCESS_MAX_CONCURRENCY files while streaming one into a zip.
+#   the scripts that copy data use 20 threads.
+if constants.S3_MAX_POOL_CONNECTIONS <= 0:
+    constants.S3_MAX_POOL_CONNECTIONS = max(
+        constants.CONCURRENT_NETWORK_OPS * (1 + constants.S3_MULTIPART_CONCURRENCY),
+        constants.DATA_ACCESS_MAX_CONCURRENCY + 1,
+        20,
+    )
+
+if constants.DATA_ACCESS_MAX_CONCURRENCY < 1:
+    errors.append("DATA_ACCESS_MAX_CONCURRENCY must be at least 1.")
+
+constants.S3_RETRY_MODE = str(constants.S3_RETRY_MODE).lower()
+if constants.S3_RETRY_MODE not in ("adaptive", "standard", "legacy"):
+    errors.append("S3_RETRY_MODE must be one of adaptive, standard or legacy.")
+
+constants.STORAGE_BACKEND = str(constants.STORAGE_BACKEND).lower()
+if constants.STORAGE_BACKEND not in ("s3", "local"):
+    errors.append("STORAGE_BACKEND must be either s3 or local.")
+elif constants.STORAGE_BACKEND == "local" and not os.path.isdir(constants.LOCAL_STORAGE_FOLDER):
+    errors.append("STORAGE_BACKEND is local but LOCAL_STORAGE_FOLDER is not an existing folder.")
+
+# the columnar file processing engine requires numpy, which is only installed on data processing servers.
+if constants.USE_COLUMNAR_FILE_PROCESSING:
+    try:
+        import numpy
+    except ImportError:
+        errors.append("USE_COLUMNAR_FILE_PROCESSING is enabled but numpy is not installed.")
+
+constants.CHUNK_STAGING_COMPRESSION = str(constants.CHUNK_STAGING_COMPRESSION).lower()
+if constants.CHUNK_STAGING_COMPRESSION not in ("zlib", "lz4", "none"):
+    errors.append("CHUNK_STAGING_COMPRESSION must be one of zlib, lz4 or none.")
+elif constants.CHUNK_STAGING_COMPRESSION == "lz4":
+    try:
+        import lz4.frame
+    except ImportError:
+        errors.append("CHUNK_STAGING_COMPRESSION is lz4 but lz4 is not installed.")
 
 # email addresses are parsed from a comma separated list
 # whitespace before and after addresses are stripped
@@ -10,8 +10,32 @@ from config.settings import DOMAIN_NAME
 # Note that this file is _not_ in the gitignore.
 
 ## Networking
-# This value is used in libs.s3, does what it says.
+# This value is used in libs.s3, does what it says.  Retries wait with exponential backoff and jitter,
+# on top of the retries done by the S3 client itself (S3_CLIENT_RETRIES).
 DEFAULT_S3_RETRIES = getenv("DEFAULT_S3_RETRIES") or 3
+# Files larger than S3_MULTIPART_THRESHOLD bytes (after encryption) are uploaded to S3 in parts of
+# S3_MULTIPART_PART_SIZE bytes, S3_MULTIPART_CONCURRENCY parts at a time.  S3 requires parts of at least
+# 5 MiB.  Memory used by an upload is about S3_MULTIPART_PART_SIZE * (S3_MULTIPART_CONCURRENCY + 1).
+S3_MULTIPART_THRESHOLD = getenv("S3_MULTIPART_THRESHOLD") or 16 * 1024 * 1024
+S3_MULTIPART_PART_SIZE = getenv("S3_MULTIPART_PART_SIZE") or 8 * 1024 * 1024
+S3_MULTIPART_CONCURRENCY = getenv("S3_MULTIPART_CONCURRENCY") or 4
+# The number of connections the S3 client keeps open, threads beyond this churn through new connections.
+# 0 (the default) sizes the pool for the concurrency settings of file processing and the data access api
+# (CONCURRENT_NETWORK_OPS, S3_MULTIPART_CONCURRENCY and DATA_ACCESS_MAX_CONCURRENCY).  If the pool is
+# too small a "S3 connection pool saturated" message is printed (see libs.s3).
+S3_MAX_POOL_CONNECTIONS = getenv("S3_MAX_POOL_CONNECTIONS") or 0
+# The S3 client's own retries of throttled and failed requests, with exponential backoff and jitter.
+# "adaptive" also slows the client down while S3 is throttling it, "standard" and "legacy" do not.
+S3_RETRY_MODE = getenv("S3_RETRY_MODE") or "adaptive"
+S3_CLIENT_RETRIES = getenv("S3_CLIENT_RETRIES") or 4
+# Seconds to wait for a connection to S3, and for S3 to send data (on each read, not for a whole file).
+S3_CONNECT_TIMEOUT = getenv("S3_CONNECT_TIMEOUT") or 10
+S3_READ_TIMEOUT = getenv("S3_READ_TIMEOUT") or 60
+# Where files are stored: "s3" (the default), or "local" to keep them in the LOCAL_STORAGE_FOLDER folder
+# on this machine instead, for development and for benchmarking without AWS (see libs.local_storage).
+# The local backend has no versioning and is not shared between machines, never use it in production.
+STORAGE_BACKEND = getenv("STORAGE_BACKEND") or "s3"
+LOCAL_STORAGE_FOLDER = getenv("LOCAL_STORAGE_FOLDER") or ""
 
 ## File processing directives
 # NOTE: these numbers were determined through trial and error on a C4 Large AWS instance.
@@ -20,10 +44,58 @@ CONCURRENT_NETWORK_OPS = getenv("CONCURRENT_NETWORK_OPS") or 10
 #Used in file processing, number of files to be pulled in and processed simultaneously.
 # Higher values reduce s3 usage, reduce processing time, but increase ram requirements.
 FILE_PROCESS_PAGE_SIZE = getenv("FILE_PROCESS_PAGE_SIZE") or 250
+# The number of files that may be downloaded but not yet processed, and the number of chunks that may be
+# built but not yet uploaded, during file processing. This caps the memory used by those two stages
+# independently of FILE_PROCESS_PAGE_SIZE.
+FILE_PROCESS_QUEUE_DEPTH = getenv("FILE_PROCESS_QUEUE_DEPTH") or 20
+# The number of worker processes that csv parsing and chunk serialization run on during file processing.
+# 0 (the default) runs them on the processing thread itself. Set this to the number of spare cores on
+# data processing servers, it is most effective with USE_COLUMNAR_FILE_PROCESSING, whose data is much
+# cheaper to hand over to another process.
+FILE_PROCESS_CPU_WORKERS = getenv("FILE_PROCESS_CPU_WORKERS") or 0
+# Set to "TRUE" to use the numpy-backed columnar csv engine in file processing, which stores rows in
+# contiguous buffers instead of lists of bytes. Substantially reduces memory and cpu usage on dense
+# data streams like the accelerometer. Requires numpy (see requirements_data_processing.txt).
+USE_COLUMNAR_FILE_PROCESSING = getenv("USE_COLUMNAR_FILE_PROCESSING") or "FALSE"
+# How chunks are compressed in memory while they wait to be uploaded during file processing: "zlib"
+# (level 1), "lz4" (requires the lz4 package, see requirements_data_processing.txt) or "none". "none"
+# is fastest, compression trades cpu time for the memory of up to FILE_PROCESS_QUEUE_DEPTH chunks.
+CHUNK_STAGING_COMPRESSION = getenv("CHUNK_STAGING_COMPRESSION") or "zlib"
 
 #This string will be printed into non-error hourly reports to improve error filtering.
 DATA_PROCESSING_NO_ERROR_STRING = getenv("DATA_PROCESSING_NO_ERROR_STRING") or "2HEnBwlawY"
 
+## Data access api
+# Files for a data download are fetched from S3 in parallel, starting with 3 at once and adapting to the
+# throughput S3 delivers, up to DATA_ACCESS_MAX_CONCURRENCY at once.  Fetching pauses while the files
+# downloaded but not yet written to the zip add up to more than DATA_ACCESS_MAX_BUFFERED_BYTES.  Files
+# larger than DATA_ACCESS_STREAM_THRESHOLD bytes are streamed into the zip instead of downloaded whole.
+DATA_ACCESS_MAX_CONCURRENCY = getenv("DATA_ACCESS_MAX_CONCURRENCY") or 32
+DATA_ACCESS_MAX_BUFFERED_BYTES = getenv("DATA_ACCESS_MAX_BUFFERED_BYTES") or 256 * 1024 * 1024
+DATA_ACCESS_STREAM_THRESHOLD = getenv("DATA_ACCESS_STREAM_THRESHOLD") or 16 * 1024 * 1024
+# The high-water mark of a data download (see updated_since in api.data_access_api) is this many seconds
+# before the download.  It must be longer than data processing's database transactions, or files updated
+# while a download runs can be missed by the next one.
+DATA_ACCESS_WATERMARK_LAG_SECONDS = getenv("DATA_ACCESS_WATERMARK_LAG_SECONDS") or 300
+
+## Encryption
+# S3 objects are written in the legacy server encryption format (AES CFB-8) while this is "TRUE", and in
+# the versioned AES CTR format (see libs.encryption) when it is "FALSE".  Both formats are always readable.
+# It is "TRUE" by default for this release, so that servers that cannot read the new format can keep
+# running alongside upgraded ones during a deploy.  Set it to "FALSE" once every server is upgraded.
+WRITE_LEGACY_SERVER_ENCRYPTION = getenv("WRITE_LEGACY_SERVER_ENCRYPTION") or "TRUE"
+
+## Key caching
+# Participant private keys are cached in memory after being retrieved from S3 (see libs.s3), because
+# a device uploads many files in a row. The number of participants whose key is kept per process, and
+# the number of seconds a key is kept for. A size of 0 disables the cache.
+CLIENT_PRIVATE_KEY_CACHE_SIZE = getenv("CLIENT_PRIVATE_KEY_CACHE_SIZE") or 1000
+CLIENT_PRIVATE_KEY_CACHE_SECONDS = getenv("CLIENT_PRIVATE_KEY_CACHE_SECONDS") or 600
+# Devices reuse the same encrypted AES key for many files, the decrypted keys are cached per participant
+# (see decrypt_device_file in libs.encryption). Number of keys kept per process, and seconds kept for.
+DEVICE_FILE_KEY_CACHE_SIZE = getenv("DEVICE_FILE_KEY_CACHE_SIZE") or 5000
+DEVICE_FILE_KEY_CACHE_SECONDS = getenv("DEVICE_FILE_KEY_CACHE_SECONDS") or 3600
+
 
 ## Data streams and survey types ##
 ALLOWED_EXTENSIONS = {'csv', 'json', 'mp4', "wav", 'txt', 'jpg'}
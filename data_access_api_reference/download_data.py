@@ -1,8 +1,12 @@
 import io
 import json
 import os
+import struct
 import zipfile
+import zlib
 
+from base64 import b64decode, b64encode
+from datetime import datetime, timedelta, timezone
 from os import path
 
 try:
@@ -60,7 +64,7 @@ def make_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_id
     """
     Behavior
     This function will download the data from the server, decompress it, and WRITE IT TO FILES IN YOUR CURRENT WORKING DIRECTORY.
-    If the data in the current working directory includes a "registry.dat" file, the server will use the contents of it to only download files that are new, potentially greatly speeding up your requests.
+    The files already downloaded are recorded in a "master_registry.bin" file in the current working directory, the server will use it to only download files that are new or updated since, potentially greatly speeding up your requests.  When the same users, data streams and times are requested again only a watermark (the time of the last request) needs to be sent, when they change the whole registry is sent.  (A "master_registry" file from older versions of this script is converted.)
 
     Study ID
     study_id is required for any query. The ID of a given study is displayed immediately under the name of the study on the study's page on your website. study_id is a string; it will look like this: 55f9d1a597013e3f50ffb4c7
@@ -112,35 +116,107 @@ def make_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_id
         # time_end = time_end.strftime(API_TIME_FORMAT)
         values['time_end'] = time_end
 
-    if path.exists("master_registry"):
-        with open("master_registry") as f:
-            old_registry = json.load(f)
-            f.close()
-            values["registry"] = json.dumps(old_registry)
+    values['registry_format'] = "binary"
+    query = registry_query(study_id, user_ids, data_streams, time_start, time_end)
+    old_registry, watermark = load_master_registry(query)
+    if watermark is not None:
+        # the server only needs the watermark, files updated since then are new to us.
+        files = {"registry": ("registry.bin", encode_registry({}, watermark))}
+    elif old_registry:
+        files = {"registry": ("registry.bin", encode_registry(old_registry))}
     else:
-        old_registry = {}
+        files = None
 
     print("sending request, receiving data, this could take some time.")
-    response = requests.post(url, data=values)
+    response = requests.post(url, data=values, files=files)
     data = response.content
     print("Data received.  Unpacking and overwriting any updated files into", path.abspath('.'))
 
     z = zipfile.ZipFile(io.BytesIO(data))
     z.extractall()
 
-    with open("registry") as f:
-        new_registry = json.load(f)
-        f.close()
+    with open("registry.bin", "rb") as f:
+        new_registry, new_watermark = decode_registry(f.read())
 
     old_registry.update(new_registry)
-    with open("master_registry", "w") as f:
-        json.dump(old_registry, f)
-    os.remove("registry")
+    with open("master_registry.bin", "wb") as f:
+        f.write(encode_registry(old_registry, new_watermark))
+    with open("master_registry_query", "w") as f:
+        f.write(query)
+    os.remove("registry.bin")
+    os.remove("manifest.json")  # its high-water mark is the watermark in the registry
+    if path.exists("master_registry"):
+        os.remove("master_registry")
     print("Operations complete.")
     # Uncomment the following line to have the function return a list of newly updated files.
     # return [name.filename for name in z.filelist if name.filename != "registry"]
 
 
+def registry_query(study_id, user_ids, data_streams, time_start, time_end):
+    """ The parameters that select which files are downloaded, as a string. """
+    return json.dumps([study_id, sorted(user_ids or []), sorted(data_streams or []), time_start, time_end])
+
+
+def load_master_registry(query):
+    """ Returns the registry of downloaded files and the watermark, converting a json registry from older
+    versions of this script (which has no watermark).  The watermark is only returned if it is from a
+    request with the same query, a request for other files may include files last updated before it. """
+    if path.exists("master_registry.bin"):
+        with open("master_registry.bin", "rb") as f:
+            registry, watermark = decode_registry(f.read())
+        previous_query = None
+        if path.exists("master_registry_query"):
+            with open("master_registry_query") as f:
+                previous_query = f.read()
+        return registry, (watermark if previous_query == query else None)
+    if path.exists("master_registry"):
+        with open("master_registry") as f:
+            return json.load(f), None
+    return {}, None
+
+
+# The registry format, a copy of libs/download_registry.py on the server, see there for details.
+REGISTRY_MAGIC = b"BEIWEREG"
+REGISTRY_VERSION = 1
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_registry(registry, watermark=None):
+    watermark = 0 if watermark is None else (watermark - EPOCH) // timedelta(microseconds=1)
+    body = [struct.pack(">QI", watermark, len(registry))]
+    previous_path = b""
+    for file_path, chunk_hash in sorted(registry.items()):
+        file_path = file_path.encode()
+        shared = min(len(path.commonprefix([file_path, previous_path])), 0xFFFF)
+        body.append(struct.pack(">HH", shared, len(file_path) - shared))
+        body.append(file_path[shared:])
+        digest = b64decode(chunk_hash) if chunk_hash else bytes(16)
+        if len(digest) != 16:
+            raise Exception("invalid chunk hash %s for %s" % (chunk_hash, file_path.decode()))
+        body.append(digest)
+        previous_path = file_path
+    return REGISTRY_MAGIC + bytes((REGISTRY_VERSION,)) + zlib.compress(b"".join(body))
+
+
+def decode_registry(data):
+    if data[:len(REGISTRY_MAGIC) + 1] != REGISTRY_MAGIC + bytes((REGISTRY_VERSION,)):
+        raise Exception("unknown registry format")
+    body = zlib.decompress(data[len(REGISTRY_MAGIC) + 1:])
+    watermark, count = struct.unpack_from(">QI", body)
+    position = struct.calcsize(">QI")
+    registry = {}
+    file_path = b""
+    for _ in range(count):
+        shared, suffix_length = struct.unpack_from(">HH", body, position)
+        position += 4
+        file_path = file_path[:shared] + body[position:position + suffix_length]
+        position += suffix_length
+        chunk_hash = body[position:position + 16]
+        position += 16
+        registry[file_path.decode()] = "" if chunk_hash == bytes(16) else b64encode(chunk_hash).decode()
+    return registry, (EPOCH + timedelta(microseconds=watermark) if watermark else None)
+
+
 def get_users_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY):
     """ Provides a list of user ids enrolled in the given study. """
     url = API_URL_BASE + 'get-users/v1'
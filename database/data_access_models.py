@@ -2,8 +2,10 @@ import json
 import random
 import string
 from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
 
 from django.db import models
+from django.db.models import Case, Value, When
 from django.utils import timezone
 from django_extensions.db.fields.json import JSONField
 
@@ -17,6 +19,12 @@ from libs.s3 import s3_list_files, s3_retrieve
 from libs.security import chunk_hash
 
 
+# the number of rows updated by a single query in ChunkRegistry.bulk_update_chunk_hashes
+BULK_UPDATE_BATCH_SIZE = 500
+# the number of values in a single IN clause in ChunkRegistry.get_chunks_by_path (sqlite allows 999)
+BULK_QUERY_BATCH_SIZE = 900
+
+
 class FileProcessingLockedError(Exception): pass
 class UnchunkableDataTypeError(Exception): pass
 class ChunkableDataTypeError(Exception): pass
@@ -48,6 +56,10 @@ class ChunkRegistry(AbstractModel):
 
     is_chunkable = models.BooleanField()
     chunk_path = models.CharField(max_length=256, db_index=True, unique=True)
+    # The hash of the contents of a chunk.  Chunks last written before file processing stopped
+    # hashing its zlib-compressed copy of the contents keep a hash of those bytes until they are next
+    # written.  Hashes are only ever compared with hashes sent out in download registries, so such a
+    # hash stays valid, and a registry holding it still matches until the chunk changes.
     chunk_hash = models.CharField(max_length=25, blank=True)
 
     # removed: data_type used to have choices of ALL_DATA_STREAMS, but this generated migrations
@@ -59,19 +71,41 @@ class ChunkRegistry(AbstractModel):
     participant = models.ForeignKey('Participant', on_delete=models.PROTECT, related_name='chunk_registries', db_index=True)
     survey = models.ForeignKey('Survey', blank=True, null=True, on_delete=models.PROTECT, related_name='chunk_registries', db_index=True)
 
+    # The size of the decrypted contents of the file.  Chunks last written before file processing
+    # stopped recording the size of its zlib-compressed copy of the contents record that size, until
+    # they are next written or scripts/populate_chunk_file_size.py is run.
     file_size = models.IntegerField(null=True, default=None)
 
+    class Meta:
+        # for data access api downloads of the chunks of a study updated since a time (updated_since)
+        indexes = [models.Index(fields=["study", "last_updated"], name="chunk_study_last_updated_idx")]
+
     def s3_retrieve(self):
         return s3_retrieve(self.chunk_path, self.study.object_id)
 
     @classmethod
     def register_chunked_data(cls, data_type, time_bin, chunk_path, file_contents, study_id,
                               participant_id, survey_id=None):
-        
+        chunk = cls.new_chunked_data(
+            data_type, time_bin, chunk_path, chunk_hash(file_contents).decode(), len(file_contents),
+            study_id, participant_id, survey_id,
+        )
+        chunk.save(force_insert=True)
+
+    @classmethod
+    def bulk_register_chunked_data(cls, chunks_params: List[dict]):
+        """ Creates many chunked data entries in a single query, chunks_params is a list of dicts
+        of the arguments to new_chunked_data.  (Note that bulk_create does not call full_clean.) """
+        cls.objects.bulk_create(
+            [cls.new_chunked_data(**chunk_params) for chunk_params in chunks_params]
+        )
+
+    @classmethod
+    def new_chunked_data(cls, data_type, time_bin, chunk_path, chunk_hash_str, file_size, study_id,
+                         participant_id, survey_id=None):
+        """ Returns a new, unsaved, chunked data ChunkRegistry. """
         if data_type not in CHUNKABLE_FILES:
             raise UnchunkableDataTypeError
-
-        chunk_hash_str = chunk_hash(file_contents).decode()
         
         time_bin = int(time_bin) * CHUNK_TIMESLICE_QUANTUM
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(time_bin), timezone.utc)
@@ -85,7 +119,7 @@ class ChunkRegistry(AbstractModel):
         # timezone so it should be generalizable) is to add UTC as a timezone when storing a naive
         # datetime in the database.
         
-        cls.objects.create(
+        return cls(
             is_chunkable=True,
             chunk_path=chunk_path,
             chunk_hash=chunk_hash_str,
@@ -94,13 +128,13 @@ class ChunkRegistry(AbstractModel):
             study_id=study_id,
             participant_id=participant_id,
             survey_id=survey_id,
-            file_size=len(file_contents),
+            file_size=file_size,
         )
     
     @classmethod
     def register_unchunked_data(cls, data_type, unix_timestamp, chunk_path, study_id, participant_id,
-                                file_contents, survey_id=None):
-        # see comment in register_chunked_data above
+                                file_size, survey_id=None):
+        # see comment in new_chunked_data above
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(unix_timestamp), timezone.utc)
         
         if data_type in CHUNKABLE_FILES:
@@ -115,17 +149,17 @@ class ChunkRegistry(AbstractModel):
             study_id=study_id,
             participant_id=participant_id,
             survey_id=survey_id,
-            file_size=len(file_contents),
+            file_size=file_size,
         )
 
     @classmethod
-    def update_registered_unchunked_data(cls, data_type, chunk_path, file_contents):
+    def update_registered_unchunked_data(cls, data_type, chunk_path, file_size):
         """ Updates the data in case a user uploads an unchunkable file more than once,
         and updates the file size just in case it changed. """
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         chunk = cls.objects.get(chunk_path=chunk_path)
-        chunk.file_size = len(file_contents)
+        chunk.file_size = file_size
         chunk.save()
 
 
@@ -148,10 +182,42 @@ class ChunkRegistry(AbstractModel):
             query['time_bin__lte'] = end
         return cls.objects.filter(**query)
 
+    @classmethod
+    def get_chunks_by_path(cls, chunk_paths: Iterable[str]) -> Dict[str, "ChunkRegistry"]:
+        """ Returns a dict of {chunk_path: ChunkRegistry} for the chunk paths that exist, querying
+        in batches of BULK_QUERY_BATCH_SIZE paths. """
+        chunk_paths = list(set(chunk_paths))
+        ret = {}
+        for i in range(0, len(chunk_paths), BULK_QUERY_BATCH_SIZE):
+            for chunk in cls.objects.filter(chunk_path__in=chunk_paths[i:i + BULK_QUERY_BATCH_SIZE]):
+                ret[chunk.chunk_path] = chunk
+        return ret
+
     def update_chunk_hash(self, data_to_hash):
-        self.chunk_hash = chunk_hash(data_to_hash)
+        self.chunk_hash = chunk_hash(data_to_hash).decode()
         self.save()
 
+    @classmethod
+    def bulk_update_chunk_hashes(cls, hashes_and_sizes: Dict[int, Tuple[str, int]]):
+        """ Updates the chunk hash and file size of many chunks, takes a dict of
+        {pk: (chunk_hash, file_size)}.  Django 1.11 has no bulk_update, so each batch is a single
+        UPDATE using CASE expressions.  (last_updated is auto_now, which .update() does not apply.) """
+        pks = list(hashes_and_sizes)
+        now = timezone.now()
+        for i in range(0, len(pks), BULK_UPDATE_BATCH_SIZE):
+            batch = pks[i:i + BULK_UPDATE_BATCH_SIZE]
+            cls.objects.filter(pk__in=batch).update(
+                chunk_hash=Case(
+                    *[When(pk=pk, then=Value(hashes_and_sizes[pk][0])) for pk in batch],
+                    output_field=models.CharField(),
+                ),
+                file_size=Case(
+                    *[When(pk=pk, then=Value(hashes_and_sizes[pk][1])) for pk in batch],
+                    output_field=models.IntegerField(),
+                ),
+                last_updated=now,
+            )
+
     @classmethod
     def get_updated_users_for_study(cls, study, date_of_last_activity):
         """ Returns a list of patient ids that have had new or updated ChunkRegistry data
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0025_auto_20200106_2153'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chunkregistry',
+            index=models.Index(fields=['study', 'last_updated'], name='chunk_study_last_updated_idx'),
+        ),
+    ]
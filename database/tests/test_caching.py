@@ -0,0 +1,31 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from libs.caching import ExpiringLRUCache
+
+
+class ExpiringLRUCacheTests(SimpleTestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = ExpiringLRUCache(max_size=2, ttl_seconds=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+
+    def test_expiry(self):
+        cache = ExpiringLRUCache(max_size=2, ttl_seconds=60)
+        with patch("libs.caching.monotonic", return_value=1000):
+            cache.set("a", 1)
+        with patch("libs.caching.monotonic", return_value=1059):
+            self.assertEqual(cache.get("a"), 1)
+        with patch("libs.caching.monotonic", return_value=1060):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled(self):
+        cache = ExpiringLRUCache(max_size=0, ttl_seconds=60)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
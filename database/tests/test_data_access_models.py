@@ -0,0 +1,156 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from config.constants import ACCELEROMETER, GPS
+from database.data_access_models import (BULK_QUERY_BATCH_SIZE, BULK_UPDATE_BATCH_SIZE,
+    ChunkRegistry)
+from database.study_models import Study
+from database.user_models import Participant
+from libs.file_processing import register_uploaded_chunks
+from libs.security import chunk_hash
+
+
+# 2020-01-26T00:00:00 UTC, in hourly bins
+TIME_BIN = 1579996800 // 3600
+
+
+class ChunkRegistryBulkTests(TestCase):
+
+    def setUp(self):
+        self.study = Study.create_with_object_id(
+            name="bulk test study", encryption_key="aabbccddeeffgghhiijjkkllmmnnoopp"
+        )
+        self.patient_id, _ = Participant.create_with_password(study=self.study)
+        self.participant = Participant.objects.get(patient_id=self.patient_id)
+
+    def chunk_params(self, number, data_type=ACCELEROMETER):
+        contents = b"contents %d" % number
+        return {
+            "data_type": data_type,
+            "time_bin": TIME_BIN + number,
+            "chunk_path": "%s/%s/%s/%d.csv" % (self.study.object_id, self.patient_id, data_type, number),
+            "chunk_hash_str": chunk_hash(contents).decode(),
+            "file_size": len(contents),
+            "study_id": self.study.pk,
+            "participant_id": self.participant.pk,
+        }
+
+    def register(self, count):
+        params = [self.chunk_params(i) for i in range(count)]
+        ChunkRegistry.bulk_register_chunked_data(params)
+        return params
+
+    def test_bulk_register_chunked_data(self):
+        params = self.register(3)
+        chunks = {chunk.chunk_path: chunk for chunk in ChunkRegistry.objects.all()}
+        self.assertEqual(sorted(chunks), sorted(p["chunk_path"] for p in params))
+        for p in params:
+            chunk = chunks[p["chunk_path"]]
+            self.assertTrue(chunk.is_chunkable)
+            self.assertEqual(chunk.chunk_hash, p["chunk_hash_str"])
+            self.assertEqual(chunk.file_size, p["file_size"])
+            self.assertEqual(chunk.participant_id, self.participant.pk)
+            self.assertEqual(int(chunk.time_bin.timestamp()) // 3600, p["time_bin"])
+
+    def test_get_chunks_by_path_across_batches(self):
+        params = self.register(BULK_QUERY_BATCH_SIZE + 1)
+        paths = [p["chunk_path"] for p in params]
+        missing = ["%s/missing/%d.csv" % (self.study.object_id, i) for i in range(BULK_QUERY_BATCH_SIZE)]
+        # duplicates are queried once
+        chunks = ChunkRegistry.get_chunks_by_path(paths + missing + paths[:10])
+        self.assertEqual(sorted(chunks), sorted(paths))
+        self.assertTrue(all(chunk.chunk_path == path for path, chunk in chunks.items()))
+        self.assertEqual(ChunkRegistry.get_chunks_by_path([]), {})
+
+    def test_bulk_update_chunk_hashes_across_batches(self):
+        self.register(BULK_UPDATE_BATCH_SIZE + 1)
+        long_ago = timezone.now() - timedelta(days=1)
+        ChunkRegistry.objects.update(last_updated=long_ago)
+        chunks = list(ChunkRegistry.objects.order_by("pk"))
+        updated = chunks[1:]  # the first is left alone, the rest span two batches
+        hashes_and_sizes = {
+            chunk.pk: (chunk_hash(b"new contents %d" % chunk.pk).decode(), 1000 + chunk.pk) for chunk in updated
+        }
+
+        ChunkRegistry.bulk_update_chunk_hashes(hashes_and_sizes)
+
+        untouched = ChunkRegistry.objects.get(pk=chunks[0].pk)
+        self.assertEqual((untouched.chunk_hash, untouched.file_size), (chunks[0].chunk_hash, chunks[0].file_size))
+        self.assertEqual(untouched.last_updated, long_ago)
+        for chunk in ChunkRegistry.objects.filter(pk__in=hashes_and_sizes):
+            self.assertEqual((chunk.chunk_hash, chunk.file_size), hashes_and_sizes[chunk.pk])
+            self.assertGreater(chunk.last_updated, long_ago)
+
+    def test_register_uploaded_chunks_new_and_existing(self):
+        self.register(2)
+        existing = list(ChunkRegistry.objects.order_by("pk"))
+        ChunkRegistry.objects.update(last_updated=timezone.now() - timedelta(days=1))
+        new = self.chunk_params(5, data_type=GPS)
+        upload_results = [
+            {
+                "chunk": existing[0],
+                "chunk_hash": chunk_hash(b"updated").decode(),
+                "file_size": 7,
+            },
+            {
+                "chunk": {
+                    "study_id": self.study.object_id,
+                    "user_id": self.patient_id,
+                    "data_type": new["data_type"],
+                    "chunk_path": new["chunk_path"],
+                    "time_bin": new["time_bin"],
+                    "survey_id": None,
+                },
+                "chunk_hash": new["chunk_hash_str"],
+                "file_size": new["file_size"],
+            },
+        ]
+
+        register_uploaded_chunks(upload_results)
+
+        self.assertEqual(ChunkRegistry.objects.count(), 3)
+        updated = ChunkRegistry.objects.get(pk=existing[0].pk)
+        self.assertEqual((updated.chunk_hash, updated.file_size), (chunk_hash(b"updated").decode(), 7))
+        self.assertGreater(updated.last_updated, ChunkRegistry.objects.get(pk=existing[1].pk).last_updated)
+        created = ChunkRegistry.objects.get(chunk_path=new["chunk_path"])
+        self.assertEqual((created.chunk_hash, created.file_size), (new["chunk_hash_str"], new["file_size"]))
+        self.assertEqual((created.study_id, created.participant_id), (self.study.pk, self.participant.pk))
+
+    def new_chunk_result(self, number, data_type=ACCELEROMETER):
+        params = self.chunk_params(number, data_type=data_type)
+        return {
+            "chunk": {
+                "study_id": self.study.object_id,
+                "user_id": self.patient_id,
+                "data_type": params["data_type"],
+                "chunk_path": params["chunk_path"],
+                "time_bin": params["time_bin"],
+                "survey_id": None,
+            },
+            "chunk_hash": params["chunk_hash_str"],
+            "file_size": params["file_size"],
+            "exception": None,
+            "traceback": None,
+        }
+
+    def test_register_uploaded_chunks_fails_only_bad_chunks(self):
+        self.register(1)
+        upload_results = [
+            self.new_chunk_result(0),  # already registered, fails the bulk insert
+            self.new_chunk_result(1),
+            self.new_chunk_result(2),
+            self.new_chunk_result(2),  # uploaded twice
+        ]
+
+        register_uploaded_chunks(upload_results)
+
+        self.assertIsNotNone(upload_results[0]["exception"])
+        self.assertIsNone(upload_results[1]["exception"])
+        self.assertIsNotNone(upload_results[2]["exception"])
+        self.assertIsNotNone(upload_results[3]["exception"])
+        self.assertEqual(
+            sorted(ChunkRegistry.objects.values_list("chunk_path", flat=True)),
+            sorted([self.chunk_params(0)["chunk_path"], self.chunk_params(1)["chunk_path"]]),
+        )
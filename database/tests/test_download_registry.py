@@ -0,0 +1,27 @@
+from datetime import datetime, timezone
+
+from django.test import SimpleTestCase
+
+from libs.download_registry import decode_registry, encode_registry, InvalidRegistry
+from libs.security import chunk_hash
+
+
+class DownloadRegistryTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        registry = {
+            "study/participant/gps/2020-01-01 00:00:00.csv": chunk_hash(b"a").decode(),
+            "study/participant/gps/2020-01-01 01:00:00.csv": chunk_hash(b"b").decode(),
+            "study/participant/accelerometer/2020-01-01 00:00:00.csv": "",
+        }
+        watermark = datetime(2020, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc)
+        self.assertEqual(decode_registry(encode_registry(registry, watermark)), (registry, watermark))
+        self.assertEqual(decode_registry(encode_registry({})), ({}, None))
+
+    def test_invalid(self):
+        data = encode_registry({"path": chunk_hash(b"a").decode()})
+        for invalid in (b"", b'{"path": "hash"}', data[:-4]):
+            with self.assertRaises(InvalidRegistry):
+                decode_registry(invalid)
+        with self.assertRaises(InvalidRegistry):
+            encode_registry({"path": "not a hash"})
@@ -0,0 +1,42 @@
+from django.test import SimpleTestCase
+
+from libs.encryption import (decrypt_stream_with_server_key, decrypt_with_server_key,
+    decrypted_server_size, encrypt_stream_with_server_key, encrypt_with_server_key,
+    SERVER_ENCRYPTION_CTR, SERVER_ENCRYPTION_HEADER_LENGTH, SERVER_ENCRYPTION_LEGACY,
+    SERVER_ENCRYPTION_MAGIC, server_encryption_version, UnknownServerEncryptionVersion)
+
+KEY = b"aabbccddefggiijjkklmnoppqqrrsstt"
+
+
+class ServerEncryptionTests(SimpleTestCase):
+
+    def test_round_trip_both_formats(self):
+        for legacy, version in ((True, SERVER_ENCRYPTION_LEGACY), (False, SERVER_ENCRYPTION_CTR)):
+            for data in (b"", b"a", b"THIS IS TEST DATA" * 100):
+                encrypted = encrypt_with_server_key(data, KEY, legacy=legacy)
+                self.assertEqual(server_encryption_version(encrypted), version)
+                self.assertEqual(decrypt_with_server_key(encrypted, KEY), data)
+                self.assertEqual(
+                    decrypted_server_size(len(encrypted), encrypted[:SERVER_ENCRYPTION_HEADER_LENGTH]), len(data)
+                )
+
+    def test_stream_decryption(self):
+        data = b"THIS IS TEST DATA" * 100
+        for legacy in (True, False):
+            encrypted = encrypt_with_server_key(data, KEY, legacy=legacy)
+            for block_size in (1, 7, 16, 30, len(encrypted)):
+                blocks = [encrypted[i:i + block_size] for i in range(0, len(encrypted), block_size)]
+                self.assertEqual(b"".join(decrypt_stream_with_server_key(blocks, KEY)), data)
+
+    def test_stream_encryption(self):
+        data = b"THIS IS TEST DATA" * 100
+        for legacy in (True, False):
+            for block_size in (1, 7, 16, 30, len(data)):
+                blocks = [data[i:i + block_size] for i in range(0, len(data), block_size)]
+                encrypted = b"".join(encrypt_stream_with_server_key(blocks, KEY, legacy=legacy))
+                self.assertEqual(len(encrypted), len(encrypt_with_server_key(data, KEY, legacy=legacy)))
+                self.assertEqual(decrypt_with_server_key(encrypted, KEY), data)
+
+    def test_unknown_version(self):
+        with self.assertRaises(UnknownServerEncryptionVersion):
+            server_encryption_version(SERVER_ENCRYPTION_MAGIC + b"\xff" + bytes(16))
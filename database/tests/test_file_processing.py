@@ -0,0 +1,63 @@
+from django.test import SimpleTestCase
+
+from libs.columnar_chunk import ColumnarChunk
+from libs.csv_serializer import split_csv_header
+from libs.file_processing import binify_csv_rows
+
+
+# 2020-01-26T00:00:00 UTC, the start of an hourly bin
+HOUR_START = 1579996800000
+
+
+class ColumnarChunkTests(SimpleTestCase):
+
+    def test_parse_drops_empty_rows(self):
+        chunk = ColumnarChunk.from_csv_body(b"%d,1\n\n,2\n%d,3" % (HOUR_START, HOUR_START + 5))
+        self.assertEqual(chunk.timestamps.tolist(), [HOUR_START, HOUR_START + 5])
+        self.assertEqual(list(chunk.rows()), [b"%d,1" % HOUR_START, b"%d,3" % (HOUR_START + 5)])
+
+    def test_binify(self):
+        chunk = ColumnarChunk.from_csv_body(
+            b"%d,a\n%d,b\n%d,c\n" % (HOUR_START + 3600000, HOUR_START, HOUR_START + 1)
+        )
+        bins = chunk.binify()
+        self.assertEqual(sorted(bins), [HOUR_START // 3600000, HOUR_START // 3600000 + 1])
+        self.assertEqual(len(bins[HOUR_START // 3600000]), 2)
+
+    def test_binify_matches_row_based_binify(self):
+        # 13 digit timestamps, and ones of other lengths that are binned by their first 10 characters
+        timestamps = [
+            b"%d" % (HOUR_START + 3600000), b"%d" % HOUR_START, b"%d" % (HOUR_START // 1000),
+            b"%d" % (HOUR_START * 1000 + 7), b"0%d" % HOUR_START, b"%d" % (HOUR_START + 1), b"42",
+        ]
+        for body_timestamps in (timestamps, sorted(timestamps, key=int)):
+            body = b"".join(b"%s,%d\n" % (timestamp, i) for i, timestamp in enumerate(body_timestamps))
+            rows = [line.split(b",") for line in body.splitlines()]
+            expected = {
+                data_bin[3]: [b",".join(row) for _, row in bin_rows]
+                for data_bin, bin_rows in binify_csv_rows(rows, "study", "user", "accel", b"header").items()
+            }
+            bins = ColumnarChunk.from_csv_body(body).binify()
+            self.assertEqual({time_bin: list(chunk.rows()) for time_bin, chunk in bins.items()}, expected)
+
+    def test_sorted_deduplicated(self):
+        chunk = ColumnarChunk.concatenate([
+            ColumnarChunk.from_csv_body(b"3,a\n1,b\n"),
+            ColumnarChunk.from_csv_body(b"1,b\n2,c\n1,d\n"),
+        ])
+        self.assertEqual(chunk.sorted_deduplicated().to_csv(b"header"), b"header\n1,b\n1,d\n2,c\n3,a")
+
+    def test_utc_time_column(self):
+        header, body = split_csv_header(b"timestamp,x\n%d,7\n%d" % (HOUR_START + 1, HOUR_START))
+        self.assertEqual(header, b"timestamp,x")
+        chunk = ColumnarChunk.from_csv_body(body).with_utc_time_column()
+        self.assertEqual(
+            list(chunk.rows()),
+            [b"%d,2020-01-26T00:00:00.001,7" % (HOUR_START + 1), b"%d,2020-01-26T00:00:00.000" % HOUR_START]
+        )
+
+    def test_merge_matches_full_sort(self):
+        old = ColumnarChunk.from_csv_body(b"1,a\n2,b\n2,c\n4,d\n")
+        new = ColumnarChunk.from_csv_body(b"3,e\n2,b\n0,f\n2,g\n")
+        expected = ColumnarChunk.concatenate((old, new)).sorted_deduplicated().to_csv(b"header")
+        self.assertEqual(ColumnarChunk.merge(old, new).to_csv(b"header"), expected)
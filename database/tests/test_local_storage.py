@@ -0,0 +1,60 @@
+from tempfile import TemporaryDirectory
+
+from botocore.exceptions import ClientError
+from django.test import SimpleTestCase
+
+from libs.local_storage import LocalS3Client
+
+
+class LocalS3ClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = TemporaryDirectory()
+        self.client = LocalS3Client(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_put_get_and_range(self):
+        self.client.put_object(Body=b"0123456789", Bucket="bucket", Key="study/patient/file.csv")
+        body = self.client.get_object(Bucket="bucket", Key="study/patient/file.csv")['Body']
+        self.assertEqual(list(body.iter_chunks(4)), [b"0123", b"4567", b"89"])
+        body.close()
+        response = self.client.get_object(Bucket="bucket", Key="study/patient/file.csv", Range="bytes=2-4")
+        self.assertEqual(response['Body'].read(), b"234")
+        self.assertEqual(response['ContentRange'], "bytes 2-4/10")
+        response['Body'].close()
+
+    def test_missing_key(self):
+        with self.assertRaises(ClientError) as context:
+            self.client.get_object(Bucket="bucket", Key="study/patient/missing.csv")
+        self.assertEqual(context.exception.response['Error']['Code'], "NoSuchKey")
+
+    def test_multipart_upload(self):
+        upload_id = self.client.create_multipart_upload(Bucket="bucket", Key="a/b")['UploadId']
+        # uploads are on disk, so other processes (with their own clients) can upload parts
+        self.client = LocalS3Client(self.folder.name)
+        parts = [
+            {'ETag': self.client.upload_part(
+                Body=data, Bucket="bucket", Key="a/b", UploadId=upload_id, PartNumber=number
+            )['ETag'], 'PartNumber': number}
+            for number, data in ((2, b"world"), (1, b"hello "))
+        ]
+        parts.sort(key=lambda part: part['PartNumber'])
+        self.client.complete_multipart_upload(
+            Bucket="bucket", Key="a/b", UploadId=upload_id, MultipartUpload={'Parts': parts}
+        )
+        body = self.client.get_object(Bucket="bucket", Key="a/b")['Body']
+        self.assertEqual(body.read(), b"hello world")
+        body.close()
+
+    def test_list_and_delete(self):
+        for key in ("study/p1/x", "study/p1/y", "study/p2/x", "other/x"):
+            self.client.put_object(Body=b"", Bucket="bucket", Key=key)
+        pages = self.client.get_paginator('list_objects_v2').paginate(Bucket="bucket", Prefix="study/p1")
+        self.assertEqual([item['Key'] for page in pages for item in page['Contents']],
+                         ["study/p1/x", "study/p1/y"])
+        self.client.delete_objects(Bucket="bucket", Delete={'Objects': [{'Key': "study/p1/x"}]})
+        pages = self.client.get_paginator('list_object_versions').paginate(Bucket="bucket", Prefix="study/")
+        self.assertEqual([item['Key'] for page in pages for item in page['Versions']],
+                         ["study/p1/y", "study/p2/x"])
@@ -0,0 +1,41 @@
+from threading import Lock
+from time import sleep
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from libs.s3_async import s3_delete_versions_many, s3_retrieve_many
+
+
+class S3AsyncTests(SimpleTestCase):
+
+    def test_retrieve_many_is_ordered_and_bounded(self):
+        lock = Lock()
+        running = []
+        most_running = []
+
+        def fake_retrieve(key_path, study_object_id, raw_path=False, number_retries=0):
+            with lock:
+                running.append(key_path)
+                most_running.append(len(running))
+            sleep(0.01)
+            with lock:
+                running.remove(key_path)
+            return key_path.encode()
+
+        key_paths = ["file_%d" % i for i in range(20)]
+        with patch("libs.s3_async.s3_retrieve", fake_retrieve):
+            results = s3_retrieve_many(key_paths, "study", max_pending=3)
+        self.assertEqual(results, [key_path.encode() for key_path in key_paths])
+        self.assertLessEqual(max(most_running), 3)
+
+    def test_errors_are_raised_from_facades(self):
+        def fake_delete_versions(key_path):
+            if key_path == "bad":
+                raise ValueError(key_path)
+            return ["version of " + key_path]
+
+        with patch("libs.s3_async.s3_delete_versions", fake_delete_versions):
+            self.assertEqual(s3_delete_versions_many(["a", "b"]), [["version of a"], ["version of b"]])
+            with self.assertRaises(ValueError):
+                s3_delete_versions_many(["a", "bad", "b"])
@@ -0,0 +1,63 @@
+from random import random
+from threading import Lock
+from time import sleep
+
+from django.test import SimpleTestCase
+
+from libs.threaded_pipeline import AdaptiveConcurrency, imap_adaptive
+
+
+class ImapAdaptiveTests(SimpleTestCase):
+
+    def test_ordered_results(self):
+        def slow_double(x):
+            sleep(random() * 0.005)
+            return x * 2
+
+        concurrency = AdaptiveConcurrency(initial=3, minimum=1, maximum=8)
+        results = list(imap_adaptive(slow_double, range(50), lambda x: 1, 100, concurrency, ordered=True))
+        self.assertEqual(results, [(x, x * 2) for x in range(50)])
+
+    def test_cost_bound(self):
+        lock = Lock()
+        running = []
+        most_running = []
+
+        def fetch(x):
+            with lock:
+                running.append(x)
+                most_running.append(len(running))
+            sleep(0.005)
+            with lock:
+                running.remove(x)
+            return x
+
+        concurrency = AdaptiveConcurrency(initial=8, minimum=1, maximum=8)
+        results = imap_adaptive(fetch, range(20), lambda x: 100, 250, concurrency, ordered=False)
+        self.assertEqual(sorted(x for x, _ in results), list(range(20)))
+        self.assertLessEqual(max(most_running), 2)
+
+    def test_item_larger_than_max_cost(self):
+        concurrency = AdaptiveConcurrency(initial=3, minimum=1, maximum=3)
+        results = list(imap_adaptive(str, [1], lambda x: 1000, 10, concurrency))
+        self.assertEqual(results, [(1, "1")])
+
+    def test_unyielded_results_are_closed(self):
+        class Result:
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        results = []
+
+        def fetch(x):
+            results.append(Result())
+            return results[-1]
+
+        concurrency = AdaptiveConcurrency(initial=10, minimum=1, maximum=10)
+        generator = imap_adaptive(fetch, range(10), lambda x: 1, 100, concurrency, ordered=False)
+        _, yielded = next(generator)
+        generator.close()
+        self.assertFalse(yielded.closed)  # closing it is the consumer's job
+        self.assertTrue(all(result.closed for result in results if result is not yielded))
@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class ExpiringLRUCache:
+    """
+    A small thread safe cache for use inside a single process.  It holds at most max_size entries,
+    evicting the least recently used one when full, and an entry expires ttl_seconds after it was
+    set.  A max_size of 0 disables the cache, nothing is ever stored.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key: (expiry, value)
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expiry, value = self._entries[key]
+            except KeyError:
+                return default
+            if expiry <= monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
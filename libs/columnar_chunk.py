@@ -0,0 +1,313 @@
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from config.constants import CHUNK_TIMESLICE_QUANTUM
+
+
+NEWLINE = ord(b"\n")
+COMMA = ord(b",")
+ZERO = ord(b"0")
+PERIOD = ord(b".")
+
+# the width of a second formatted as API_TIME_FORMAT, and of the inserted UTC time column with its
+# leading comma and milliseconds.
+SECOND_WIDTH = len("YYYY-MM-DDTHH:MM:SS")
+UTC_COLUMN_WIDTH = SECOND_WIDTH + len(",.mmm")
+
+# Timestamps are java millisecond timestamps, the bin of a row is its timestamp in seconds divided
+# by the chunk timeslice quantum.  As in file_processing.binify_csv_rows, that is only identical to
+# binify_from_timecode (which takes the first 10 characters of the timestamp as seconds) for 13 digit
+# timestamps, the bins of any others are found the way binify_from_timecode does.
+MILLISECONDS_PER_BIN = 1000 * CHUNK_TIMESLICE_QUANTUM
+MIN_MILLISECOND_TIMECODE = 10 ** 12
+MAX_MILLISECOND_TIMECODE = 10 ** 13 - 1
+TIMECODE_WIDTH = 13
+
+
+class ColumnarChunk:
+    """
+    A columnar representation of the rows of a csv file, used by file processing instead of lists
+    of lists of bytes. Every row is stored in one contiguous bytes buffer, each row is terminated
+    by a newline, and the (parsed) first column of every row is stored in a numpy int64 array.
+
+        timestamps: int64 array, the millisecond timestamp of each row.
+        buffer: bytes, the rows of the csv, each row is followed by a newline.
+        offsets: int64 array of length n + 1, row i is buffer[offsets[i]:offsets[i + 1] - 1].
+
+    Binning, sorting and deduplication are all operations on the timestamps array, row contents
+    are only touched when a new buffer has to be assembled.
+    """
+    __slots__ = ("timestamps", "buffer", "offsets")
+
+    def __init__(self, timestamps: np.ndarray, buffer: bytes, offsets: np.ndarray):
+        self.timestamps = timestamps
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=np.int64), b"", np.zeros(1, dtype=np.int64))
+
+    @classmethod
+    def from_csv_body(cls, body: bytes) -> "ColumnarChunk":
+        """ Parses the rows of a csv (everything after the header line). Lines that are empty or
+        have an empty first column are dropped, which matches the original row based code. """
+        if b"\r" in body:
+            body = body.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        if body and not body.endswith(b"\n"):
+            body += b"\n"
+        if not body:
+            return cls.empty()
+
+        raw = np.frombuffer(body, dtype=np.uint8)
+        line_ends = np.flatnonzero(raw == NEWLINE)
+        line_starts = np.empty_like(line_ends)
+        line_starts[0] = 0
+        line_starts[1:] = line_ends[:-1] + 1
+
+        # the first column of a line ends at the first comma on that line, or at the end of the line
+        commas = np.append(np.flatnonzero(raw == COMMA), len(body))
+        field_ends = np.minimum(commas[np.searchsorted(commas, line_starts)], line_ends)
+        field_lengths = field_ends - line_starts
+
+        keep = field_lengths > 0
+        if not keep.all():
+            line_starts, line_ends, field_lengths = \
+                line_starts[keep], line_ends[keep], field_lengths[keep]
+            if not len(line_starts):
+                return cls.empty()
+
+        timestamps = _parse_integers(raw, body, line_starts, field_lengths)
+
+        if keep.all():
+            offsets = np.append(line_starts, len(body))
+            return cls(timestamps, body, offsets)
+
+        buffer, offsets = _gather(body, line_starts, line_ends + 1)
+        return cls(timestamps, buffer, offsets)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[List[bytes]]) -> "ColumnarChunk":
+        """ Builds a chunk from csv rows that are lists of bytes, used after the csv fixes that
+        need to modify individual rows. """
+        return cls.from_csv_body(b"\n".join(b",".join(row) for row in rows if row and row[0]))
+
+    @classmethod
+    def concatenate(cls, chunks: Iterable["ColumnarChunk"]) -> "ColumnarChunk":
+        chunks = [chunk for chunk in chunks if len(chunk)]
+        if not chunks:
+            return cls.empty()
+        if len(chunks) == 1:
+            return chunks[0]
+
+        offsets = [np.zeros(1, dtype=np.int64)]
+        shift = 0
+        for chunk in chunks:
+            offsets.append(chunk.offsets[1:] + shift)
+            shift += len(chunk.buffer)
+
+        return cls(
+            np.concatenate([chunk.timestamps for chunk in chunks]),
+            b"".join(chunk.buffer for chunk in chunks),
+            np.concatenate(offsets),
+        )
+
+    @classmethod
+    def merge(cls, old: "ColumnarChunk", new: "ColumnarChunk") -> "ColumnarChunk":
+        """ Merges new rows into an existing chunk, then deduplicates. The existing chunk is
+        expected to already be sorted (chunks on S3 are), only the new rows are sorted here, and the
+        merge itself is a single linear pass. On equal timestamps rows from the existing chunk come
+        first, identical to a stable sort of the concatenation of the two. """
+        if not old.is_sorted():
+            return cls.concatenate((old, new)).sorted_deduplicated()
+        if not new.is_sorted():
+            new = new.take(np.argsort(new.timestamps, kind="stable"))
+
+        # the position of each new row in the output is the number of old rows that precede it
+        # plus the number of new rows that precede it.
+        new_positions = np.searchsorted(old.timestamps, new.timestamps, side="right")
+        new_positions += np.arange(len(new), dtype=new_positions.dtype)
+        order = np.empty(len(old) + len(new), dtype=np.int64)
+        is_new = np.zeros(len(order), dtype=bool)
+        is_new[new_positions] = True
+        order[new_positions] = np.arange(len(old), len(order))
+        order[~is_new] = np.arange(len(old))
+        return cls.concatenate((old, new)).take(order).sorted_deduplicated()
+
+    def rows(self) -> Iterable[bytes]:
+        """ Yields every row, without its trailing newline. """
+        view = memoryview(self.buffer)
+        for start, end in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist()):
+            yield bytes(view[start:end - 1])
+
+    def take(self, indices: np.ndarray) -> "ColumnarChunk":
+        """ Returns a new chunk containing the rows at the provided indices, in that order. """
+        starts = self.offsets[indices]
+        ends = self.offsets[indices + 1]
+        buffer, offsets = _gather(self.buffer, starts, ends)
+        return ColumnarChunk(self.timestamps[indices], buffer, offsets)
+
+    def slice(self, start: int, end: int) -> "ColumnarChunk":
+        """ Returns the rows from start to end as a new chunk, a contiguous piece of the buffer. """
+        if start == 0 and end == len(self):
+            return self
+        offsets = self.offsets[start:end + 1]
+        return ColumnarChunk(
+            self.timestamps[start:end].copy(), self.buffer[offsets[0]:offsets[-1]], offsets - offsets[0]
+        )
+
+    def is_sorted(self) -> bool:
+        return bool(np.all(self.timestamps[1:] >= self.timestamps[:-1]))
+
+    def binify(self) -> Dict[int, "ColumnarChunk"]:
+        """ Splits the rows into hourly (CHUNK_TIMESLICE_QUANTUM) bins, row order is preserved
+        within each bin. """
+        if not len(self):
+            return {}
+        bins = self.timestamps // MILLISECONDS_PER_BIN
+        irregular = self._irregular_timestamps()
+        for index in irregular.tolist():
+            bins[index] = int(self._first_field(index)[:10]) // CHUNK_TIMESLICE_QUANTUM
+
+        if not len(irregular) and self.is_sorted():
+            # the bins are contiguous, their boundaries are found by a searchsorted on the bin edges.
+            unique_bins = np.unique(bins)
+            edges = np.searchsorted(self.timestamps, unique_bins[1:] * MILLISECONDS_PER_BIN)
+            bounds = [0] + edges.tolist() + [len(self)]
+            return {
+                int(time_bin): self.slice(start, end)
+                for time_bin, start, end in zip(unique_bins.tolist(), bounds[:-1], bounds[1:])
+            }
+
+        unique_bins, inverse = np.unique(bins, return_inverse=True)
+        if len(unique_bins) == 1:
+            return {int(unique_bins[0]): self}
+
+        order = np.argsort(inverse, kind="stable")
+        groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+        return {int(time_bin): self.take(group) for time_bin, group in zip(unique_bins, groups)}
+
+    def _irregular_timestamps(self) -> np.ndarray:
+        """ The indices of rows whose timestamp is not a plain 13 digit timecode.  A timestamp in the
+        13 digit range is written with at least 13 characters, so it is exactly 13 if its row has a
+        comma or the end of the row after them. """
+        in_range = (self.timestamps >= MIN_MILLISECOND_TIMECODE) & (self.timestamps <= MAX_MILLISECOND_TIMECODE)
+        ends = self.offsets[:-1] + TIMECODE_WIDTH
+        after = np.frombuffer(self.buffer, dtype=np.uint8)[np.minimum(ends, len(self.buffer) - 1)]
+        regular = in_range & (ends < self.offsets[1:]) & ((after == COMMA) | (after == NEWLINE))
+        return np.flatnonzero(~regular)
+
+    def _first_field(self, index: int) -> bytes:
+        row = self.buffer[self.offsets[index]:self.offsets[index + 1] - 1]
+        return row.split(b",", 1)[0]
+
+    def sorted_deduplicated(self) -> "ColumnarChunk":
+        """ Sorts rows by timestamp (stable), then drops any row that is an exact duplicate of an
+        earlier row. Duplicates must share a timestamp, so only runs of rows with identical
+        timestamps are compared byte-wise. """
+        chunk = self if self.is_sorted() else self.take(np.argsort(self.timestamps, kind="stable"))
+        timestamps = chunk.timestamps
+        if len(timestamps) < 2:
+            return chunk
+
+        boundaries = np.flatnonzero(timestamps[1:] != timestamps[:-1]) + 1
+        run_starts = np.concatenate(([0], boundaries))
+        run_ends = np.concatenate((boundaries, [len(timestamps)]))
+        repeated = (run_ends - run_starts) > 1
+        if not repeated.any():
+            return chunk
+
+        keep = np.ones(len(timestamps), dtype=bool)
+        view = memoryview(chunk.buffer)
+        offsets = chunk.offsets.tolist()
+        for run_start, run_end in zip(run_starts[repeated].tolist(), run_ends[repeated].tolist()):
+            seen = set()
+            for i in range(run_start, run_end):
+                row = bytes(view[offsets[i]:offsets[i + 1]])
+                if row in seen:
+                    keep[i] = False
+                else:
+                    seen.add(row)
+
+        if keep.all():
+            return chunk
+        return chunk.take(np.flatnonzero(keep))
+
+    def with_utc_time_column(self) -> "ColumnarChunk":
+        """ Returns a new chunk with the human readable UTC time of each row inserted as its second
+        column, the formatting is identical to convert_unix_to_human_readable_timestamps.  Each
+        distinct second is formatted once, the millisecond digits are filled in arithmetically and
+        the column is inserted into the buffer in a single numpy operation. """
+        if not len(self):
+            return self
+        seconds, milliseconds = np.divmod(self.timestamps, 1000)
+        unique_seconds, second_index = np.unique(seconds, return_inverse=True)
+        formatted_seconds = np.datetime_as_string(unique_seconds.astype("datetime64[s]"), unit="s")
+        if (np.char.str_len(formatted_seconds) != SECOND_WIDTH).any():
+            # matches the ValueError of datetime.utcfromtimestamp in the row based code
+            raise ValueError("timestamp out of range in chunk")
+        formatted_seconds = formatted_seconds.astype("S%d" % SECOND_WIDTH).view(np.uint8)
+
+        # the inserted bytes of each row: ",YYYY-MM-DDTHH:MM:SS.mmm"
+        column = np.empty((len(self), UTC_COLUMN_WIDTH), dtype=np.uint8)
+        column[:, 0] = COMMA
+        column[:, 1:SECOND_WIDTH + 1] = formatted_seconds.reshape(-1, SECOND_WIDTH)[second_index]
+        column[:, SECOND_WIDTH + 1] = PERIOD
+        column[:, SECOND_WIDTH + 2] = ZERO + milliseconds // 100
+        column[:, SECOND_WIDTH + 3] = ZERO + milliseconds // 10 % 10
+        column[:, SECOND_WIDTH + 4] = ZERO + milliseconds % 10
+
+        # the column goes right after the first field of each row
+        raw = np.frombuffer(self.buffer, dtype=np.uint8)
+        starts = self.offsets[:-1]
+        line_ends = self.offsets[1:] - 1
+        commas = np.append(np.flatnonzero(raw == COMMA), len(self.buffer))
+        field_ends = np.minimum(commas[np.searchsorted(commas, starts)], line_ends)
+        buffer = np.insert(raw, np.repeat(field_ends, UTC_COLUMN_WIDTH), column.ravel()).tobytes()
+
+        offsets = self.offsets + UTC_COLUMN_WIDTH * np.arange(len(self) + 1, dtype=np.int64)
+        return ColumnarChunk(self.timestamps, buffer, offsets)
+
+    def to_csv(self, header: bytes) -> bytes:
+        """ Returns the full csv file, header included, without a trailing newline. """
+        if not len(self):
+            return header
+        # the buffer is already newline separated, join accepts the memoryview without a copy.
+        return b"\n".join((header, memoryview(self.buffer)[:-1]))
+
+
+def _gather(buffer: bytes, starts: np.ndarray, ends: np.ndarray) -> Tuple[bytes, np.ndarray]:
+    """ Concatenates buffer[starts[i]:ends[i]] for every i, returns the new buffer and offsets. """
+    view = memoryview(buffer)
+    new_buffer = b"".join([view[start:end] for start, end in zip(starts.tolist(), ends.tolist())])
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(ends - starts, out=offsets[1:])
+    return new_buffer, offsets
+
+
+def _parse_integers(raw: np.ndarray, body: bytes, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """ Parses the base 10 integers at raw[starts[i]:starts[i] + lengths[i]], one digit position at
+    a time across all rows. Anything that is not plain digits falls back to python's int(), which
+    has the same (error raising) behavior as the row based code. """
+    values = np.zeros(len(starts), dtype=np.int64)
+    width = int(lengths.max())
+    # 18 digits is the most that can be guaranteed to fit in an int64.
+    if width <= 18:
+        last_index = len(raw) - 1
+        for position in range(width):
+            in_field = lengths > position
+            digits = raw[np.minimum(starts + position, last_index)].astype(np.int64) - ZERO
+            if np.any(in_field & ((digits < 0) | (digits > 9))):
+                break
+            values = np.where(in_field, values * 10 + digits, values)
+        else:
+            return values
+
+    return np.array(
+        [int(body[start:start + length]) for start, length in zip(starts.tolist(), lengths.tolist())],
+        dtype=np.int64,
+    )
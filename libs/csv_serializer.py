@@ -0,0 +1,64 @@
+"""
+Shared csv serialization.  Output is always assembled with a single b"\n".join over a generator, so
+serializing a csv is linear in its size; rows are never concatenated onto a growing bytes object.
+"""
+from itertools import chain
+from typing import Generator, Iterable, List, Tuple
+
+
+def serialize_csv(header: bytes, lines: Iterable[bytes], deduplicate=True) -> bytes:
+    """ Takes a header and an iterable of already-joined csv lines, returns the full csv without a
+    trailing newline.  Duplicate lines are dropped (order preserving) unless deduplicate is False. """
+    if deduplicate:
+        lines = deduplicated(lines)
+    return b"\n".join(chain((header,), lines))
+
+
+def serialize_csv_rows(header: bytes, rows: Iterable[List[bytes]], deduplicate=True) -> bytes:
+    """ As serialize_csv, but rows are lists of the bytes of each column. """
+    return serialize_csv(header, join_rows(rows), deduplicate=deduplicate)
+
+
+def join_rows(rows: Iterable[List[bytes]]) -> Generator[bytes, None, None]:
+    for row in rows:
+        try:
+            yield b",".join(row)
+        except TypeError:
+            print("######################################################################")
+            print("could not join row: %r" % (row,))
+            print("######################################################################")
+            raise
+
+
+def deduplicated(lines: Iterable[bytes]) -> Generator[bytes, None, None]:
+    """ Order preserving deduplication. """
+    seen = set()
+    seen_add = seen.add
+    for line in lines:
+        if line not in seen:
+            seen_add(line)
+            yield line
+
+
+def split_csv_header(csv_string: bytes) -> Tuple[bytes, bytes]:
+    """ Separates the header line of a csv from its body. """
+    header_end = csv_string.find(b"\n")
+    if header_end == -1:
+        return csv_string, b""
+    return csv_string[:header_end], csv_string[header_end + 1:]
+
+
+def iterate_csv_lines(csv_body: bytes) -> Generator[bytes, None, None]:
+    """ Lazily yields the non-empty lines of a csv body, unlike splitlines this does not create a
+    list of every line up front. """
+    find = csv_body.find
+    start = 0
+    while True:
+        end = find(b"\n", start)
+        if end == -1:
+            if start < len(csv_body):
+                yield csv_body[start:]
+            return
+        if end > start:
+            yield csv_body[start:end]
+        start = end + 1
@@ -0,0 +1,93 @@
+"""
+The compact binary registry used by the data access api for incremental downloads.  A registry maps the
+chunk paths that a client already has to their chunk hashes, and carries a watermark, a
+ChunkRegistry.last_updated time up to which the client has downloaded every chunk.
+
+The format is REGISTRY_MAGIC, a version byte, and then zlib compressed:
+    the watermark, as an unsigned 8 byte integer of microseconds since the epoch (0 for no watermark)
+    the number of entries, 4 bytes
+    the entries, sorted by path, each of which is:
+        2 bytes: the length of the prefix that the path shares with the previous entry's path
+        2 bytes: the length of the rest of the path, followed by the rest of the path (utf-8)
+        16 bytes: the chunk hash, which is a base64 encoded md5 digest, decoded (zeros for no hash)
+All integers are big-endian.  Chunk paths share long prefixes (study id, participant id, data stream),
+so they take a few bytes each, a registry is around a sixth of the size of the json one.
+
+data_access_api_reference/download_data.py contains a copy of this code, keep them in sync.
+"""
+import struct
+import zlib
+from base64 import b64decode, b64encode
+from binascii import Error as Base64Error
+from datetime import datetime, timedelta, timezone
+from os.path import commonprefix
+from typing import Dict, Optional, Tuple
+
+REGISTRY_MAGIC = b"BEIWEREG"
+REGISTRY_VERSION = 1
+
+_HEADER = struct.Struct(">QI")
+_ENTRY = struct.Struct(">HH")
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_NO_HASH = bytes(16)
+
+
+class InvalidRegistry(Exception): pass
+
+
+def encode_registry(registry: Dict[str, str], watermark: Optional[datetime] = None) -> bytes:
+    """ Encodes a dictionary of chunk paths to chunk hashes, and optionally a (timezone aware) watermark. """
+    watermark = 0 if watermark is None else (watermark - _EPOCH) // timedelta(microseconds=1)
+    body = [_HEADER.pack(watermark, len(registry))]
+    previous_path = b""
+    for path, chunk_hash in sorted(registry.items()):
+        path = path.encode()
+        shared = min(len(commonprefix([path, previous_path])), 0xFFFF)
+        body.append(_ENTRY.pack(shared, len(path) - shared))
+        body.append(path[shared:])
+        body.append(_encode_hash(chunk_hash))
+        previous_path = path
+    return REGISTRY_MAGIC + bytes((REGISTRY_VERSION,)) + zlib.compress(b"".join(body))
+
+
+def decode_registry(data: bytes) -> Tuple[Dict[str, str], Optional[datetime]]:
+    """ Returns the registry dictionary and the watermark (None if there is none) of an encoded registry.
+    Raises InvalidRegistry if data is not a registry. """
+    if not data.startswith(REGISTRY_MAGIC):
+        raise InvalidRegistry("not a registry")
+    if data[len(REGISTRY_MAGIC):len(REGISTRY_MAGIC) + 1] != bytes((REGISTRY_VERSION,)):
+        raise InvalidRegistry("unknown registry version")
+    try:
+        body = zlib.decompress(data[len(REGISTRY_MAGIC) + 1:])
+        watermark, count = _HEADER.unpack_from(body)
+        position = _HEADER.size
+        registry = {}
+        path = b""
+        for _ in range(count):
+            shared, suffix_length = _ENTRY.unpack_from(body, position)
+            position += _ENTRY.size
+            path = path[:shared] + body[position:position + suffix_length]
+            position += suffix_length
+            chunk_hash = body[position:position + 16]
+            position += 16
+            if len(chunk_hash) != 16:
+                raise InvalidRegistry("registry is truncated")
+            registry[path.decode()] = "" if chunk_hash == _NO_HASH else b64encode(chunk_hash).decode()
+    except (zlib.error, struct.error, UnicodeDecodeError) as e:
+        raise InvalidRegistry(str(e))
+
+    if watermark == 0:
+        return registry, None
+    return registry, _EPOCH + timedelta(microseconds=watermark)
+
+
+def _encode_hash(chunk_hash: str) -> bytes:
+    if not chunk_hash:
+        return _NO_HASH
+    try:
+        digest = b64decode(chunk_hash, validate=True)
+    except Base64Error:
+        digest = b""
+    if len(digest) != 16:
+        raise InvalidRegistry("invalid chunk hash %s" % chunk_hash)
+    return digest
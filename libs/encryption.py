@@ -1,16 +1,22 @@
 import json
 import traceback
+from binascii import a2b_base64
+from itertools import chain
 from os import urandom
+from typing import Generator, Iterable, List, Optional
 
 from Crypto.Cipher import AES
 from Crypto.PublicKey import RSA
+from Crypto.Util import Counter
 from flask import request
 
-from config.constants import ASYMMETRIC_KEY_LENGTH
+from config.constants import (ASYMMETRIC_KEY_LENGTH, DEVICE_FILE_KEY_CACHE_SECONDS,
+    DEVICE_FILE_KEY_CACHE_SIZE, WRITE_LEGACY_SERVER_ENCRYPTION)
 from config.settings import IS_STAGING
 from database.profiling_models import (DecryptionKeyError, EncryptionErrorMetadata,
     LineEncryptionError)
 from database.study_models import Study
+from libs.caching import ExpiringLRUCache
 from libs.logging import log_error
 from .security import decode_base64, encode_base64, PaddingException
 
@@ -21,6 +27,7 @@ class HandledError(Exception): pass
 class InvalidIV(Exception): pass
 class InvalidData(Exception): pass
 class DefinitelyInvalidFile(Exception): pass
+class UnknownServerEncryptionVersion(Exception): pass
 
 
 # The private keys are stored server-side (S3), and the public key is sent to the device.
@@ -66,14 +73,24 @@ def get_RSA_cipher(key: bytes) -> RSA._RSAobj:
 ################################################################################
 
 
-def encrypt_for_server(input_string, study_object_id) -> bytes:
+# Server side encryption formats.  Legacy objects have no header, they are a random 16 byte iv
+# followed by AES CFB ciphertext with 8 bit segments, which costs a whole block operation per byte.
+# Versioned objects start with SERVER_ENCRYPTION_MAGIC and a version byte.  Version 1 is AES CTR, the
+# header is followed by the 16 byte initial counter block and then the ciphertext.  The magic is 8
+# bytes long so the chance of a legacy iv starting with it is negligible.
+SERVER_ENCRYPTION_MAGIC = b"\x89BEIWE\r\n"
+SERVER_ENCRYPTION_LEGACY = 0
+SERVER_ENCRYPTION_CTR = 1
+SERVER_ENCRYPTION_HEADER_LENGTH = len(SERVER_ENCRYPTION_MAGIC) + 1
+
+
+def encrypt_for_server(input_string, study_object_id, legacy=None) -> bytes:
     """
-    Encrypts config using the ENCRYPTION_KEY, prepends the generated initialization vector.
-    Use this function on an entire file (as a string).
+    Encrypts config using the ENCRYPTION_KEY, prepends the header and generated initialization vector.
+    Use this function on an entire file (as a string).  See encrypt_with_server_key for legacy.
     """
     encryption_key = Study.objects.get(object_id=study_object_id).encryption_key.encode()  # bytes
-    iv = urandom(16)  # bytes
-    return iv + AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).encrypt(input_string)
+    return encrypt_with_server_key(input_string, encryption_key, legacy=legacy)
 
 
 def decrypt_server(data: bytes, study_object_id: str) -> bytes:
@@ -81,13 +98,134 @@ def decrypt_server(data: bytes, study_object_id: str) -> bytes:
     encryption_key = Study.objects.filter(
         object_id=study_object_id
     ).values_list('encryption_key', flat=True).get().encode()
-    iv = data[:16]
-    data = data[16:]
-    return AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).decrypt(data)
+    return decrypt_with_server_key(data, encryption_key)
+
+
+def encrypt_server_stream(blocks: Iterable[bytes], study_object_id: str, legacy=None) -> Generator:
+    """ As encrypt_for_server, but takes the data as an iterable of blocks of any size and returns a
+    generator of encrypted blocks.  The study's key is looked up immediately. """
+    encryption_key = Study.objects.get(object_id=study_object_id).encryption_key.encode()  # bytes
+    return encrypt_stream_with_server_key(blocks, encryption_key, legacy=legacy)
+
+
+def decrypt_server_stream(blocks: Iterable[bytes], study_object_id: str) -> Generator:
+    """ As decrypt_server, but takes the encrypted data as an iterable of blocks of any size and returns
+    a generator of decrypted blocks.  The study's key is looked up immediately. """
+    encryption_key = Study.objects.filter(
+        object_id=study_object_id
+    ).values_list('encryption_key', flat=True).get().encode()
+    return decrypt_stream_with_server_key(blocks, encryption_key)
+
+
+def encrypt_with_server_key(data: bytes, encryption_key: bytes, legacy=None) -> bytes:
+    """ Encrypts data in the current server format, or in the legacy format if legacy is True.
+    legacy defaults to the WRITE_LEGACY_SERVER_ENCRYPTION setting. """
+    if legacy is None:
+        legacy = WRITE_LEGACY_SERVER_ENCRYPTION
+    iv = urandom(16)
+    if legacy:
+        return iv + AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).encrypt(data)
+    header = SERVER_ENCRYPTION_MAGIC + bytes([SERVER_ENCRYPTION_CTR])
+    return header + iv + _server_ctr_cipher(encryption_key, iv).encrypt(data)
+
+
+def decrypt_with_server_key(data: bytes, encryption_key: bytes) -> bytes:
+    """ Decrypts data in either server format, the format is detected from the header. """
+    version = server_encryption_version(data)
+    if version == SERVER_ENCRYPTION_LEGACY:
+        return AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=data[:16]).decrypt(data[16:])
+    iv = data[SERVER_ENCRYPTION_HEADER_LENGTH:SERVER_ENCRYPTION_HEADER_LENGTH + 16]
+    return _server_ctr_cipher(encryption_key, iv).decrypt(data[SERVER_ENCRYPTION_HEADER_LENGTH + 16:])
+
+
+def decrypt_stream_with_server_key(blocks: Iterable[bytes], encryption_key: bytes) -> Generator:
+    """ Decrypts an iterable of encrypted blocks in either server format, yielding decrypted blocks.
+    Only one block is held at a time (plus the header, which has to be read before anything else). """
+    blocks = iter(blocks)
+    buffer = b""
+    for block in blocks:
+        buffer += block
+        if len(buffer) >= SERVER_ENCRYPTION_HEADER_LENGTH + 16:
+            break
+
+    if server_encryption_version(buffer) == SERVER_ENCRYPTION_LEGACY:
+        cipher = AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=buffer[:16])
+        buffer = buffer[16:]
+    else:
+        iv = buffer[SERVER_ENCRYPTION_HEADER_LENGTH:SERVER_ENCRYPTION_HEADER_LENGTH + 16]
+        cipher = _server_ctr_cipher(encryption_key, iv)
+        buffer = buffer[SERVER_ENCRYPTION_HEADER_LENGTH + 16:]
+
+    for block in _whole_aes_blocks(chain((buffer,), blocks)):
+        yield cipher.decrypt(block)
+
+
+def encrypt_stream_with_server_key(blocks: Iterable[bytes], encryption_key: bytes, legacy=None) -> Generator:
+    """ As encrypt_with_server_key, but takes an iterable of blocks of any size and yields encrypted
+    blocks, the header and initialization vector first. """
+    if legacy is None:
+        legacy = WRITE_LEGACY_SERVER_ENCRYPTION
+    iv = urandom(16)
+    if legacy:
+        cipher = AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv)
+        yield iv
+    else:
+        cipher = _server_ctr_cipher(encryption_key, iv)
+        yield SERVER_ENCRYPTION_MAGIC + bytes([SERVER_ENCRYPTION_CTR]) + iv
+    for block in _whole_aes_blocks(blocks):
+        yield cipher.encrypt(block)
+
+
+def _whole_aes_blocks(blocks: Iterable[bytes]) -> Generator:
+    # Both server ciphers are stateful, consecutive calls continue where the last left off.  Blocks are
+    # cut to whole AES blocks so that no cipher ever has to carry a partial block between calls, only
+    # the last block may be partial.
+    leftover = b""
+    for block in blocks:
+        if leftover:
+            block = leftover + block
+        usable = len(block) - len(block) % 16
+        leftover = block[usable:]
+        if usable:
+            yield block[:usable] if leftover else block
+    if leftover:
+        yield leftover
+
+
+def _server_ctr_cipher(encryption_key: bytes, iv: bytes):
+    # the whole iv is the initial value of a 128 bit counter, it may wrap around on (very) long data.
+    counter = Counter.new(128, initial_value=int.from_bytes(iv, "big"), allow_wraparound=True)
+    return AES.new(encryption_key, AES.MODE_CTR, counter=counter)
+
+
+def server_encryption_version(header: bytes) -> int:
+    """ The format of server encrypted data, given (at least) its first SERVER_ENCRYPTION_HEADER_LENGTH
+    bytes.  Returns SERVER_ENCRYPTION_LEGACY for data without a header. """
+    if header[:len(SERVER_ENCRYPTION_MAGIC)] != SERVER_ENCRYPTION_MAGIC:
+        return SERVER_ENCRYPTION_LEGACY
+    version = header[len(SERVER_ENCRYPTION_MAGIC)]
+    if version != SERVER_ENCRYPTION_CTR:
+        raise UnknownServerEncryptionVersion(version)
+    return version
+
+
+def decrypted_server_size(encrypted_size: int, header: bytes) -> int:
+    """ The size of data encrypted by encrypt_for_server, given the size of the encrypted data and (at
+    least) its first SERVER_ENCRYPTION_HEADER_LENGTH bytes.  Neither format pads, the only overhead is
+    the header, if any, and the initialization vector. """
+    if server_encryption_version(header) == SERVER_ENCRYPTION_LEGACY:
+        return encrypted_size - 16
+    return encrypted_size - SERVER_ENCRYPTION_HEADER_LENGTH - 16
 
 
 ########################### User/Device Decryption #############################
 
+# Decrypted AES keys of device files, keyed by (patient_id, the encrypted key line of the file), along
+# with the private key they were decrypted with.  Devices reuse a key for many files, a cache hit skips
+# the RSA private key operation.  A key decrypted with a participant's replaced private key is garbage,
+# entries are only used with the same private key (object, see libs.s3.get_client_private_key).
+_device_file_key_cache = ExpiringLRUCache(DEVICE_FILE_KEY_CACHE_SIZE, DEVICE_FILE_KEY_CACHE_SECONDS)
+
 
 def decrypt_device_file(patient_id, original_data: bytes, private_key_cipher, user) -> bytes:
     """ Runs the line-by-line decryption of a file encrypted by a device.
@@ -133,17 +271,29 @@ def decrypt_device_file(patient_id, original_data: bytes, private_key_cipher, us
         create_decryption_key_error(traceback.format_exc())
         raise DecryptionKeyInvalidError("invalid decryption key. %s" % decode_error)
 
-    try:
-        base64_key = private_key_cipher.decrypt(decoded_key)
-        decrypted_key = decode_base64(base64_key)
-    except (TypeError, IndexError, PaddingException) as decr_error:
-        create_decryption_key_error(traceback.format_exc())
-        raise DecryptionKeyInvalidError("invalid decryption key. %s" % decr_error)
+    key_cache_key = (patient_id, file_data[0])
+    cached_cipher, decrypted_key = _device_file_key_cache.get(key_cache_key, (None, None))
+    if cached_cipher is not private_key_cipher:
+        try:
+            base64_key = private_key_cipher.decrypt(decoded_key)
+            decrypted_key = decode_base64(base64_key)
+        except (TypeError, IndexError, PaddingException) as decr_error:
+            create_decryption_key_error(traceback.format_exc())
+            raise DecryptionKeyInvalidError("invalid decryption key. %s" % decr_error)
+        _device_file_key_cache.set(key_cache_key, (private_key_cipher, decrypted_key))
+
+    # Well formed lines are all decrypted at once, only the others go through decrypt_device_line
+    # (and its error handling) below.
+    batch_decrypted_lines = decrypt_device_lines(decrypted_key, file_data)
 
     for i, line in enumerate(file_data):
         # we need to skip the first line (the decryption key), but need real index values in i
         if i == 0:
             continue
+
+        if batch_decrypted_lines[i] is not None:
+            good_lines.append(batch_decrypted_lines[i])
+            continue
         
         if line is None:
             # this case causes weird behavior inside decrypt_device_line, so we test for it instead.
@@ -254,6 +404,53 @@ def decrypt_device_file(patient_id, original_data: bytes, private_key_cipher, us
     return b"\n".join(good_lines)
 
 
+# url safe base64 to standard base64, see decode_base64
+URL_SAFE_BASE64_TRANSLATION = bytes.maketrans(b"-_", b"+/")
+
+
+def decrypt_device_lines(key: bytes, lines: List[bytes]) -> List[Optional[bytes]]:
+    """ Batch version of decrypt_device_line, returns the decrypted lines in order.  Lines that are
+    not well formed (no single colon, bad base64, an iv that is not 16 bytes or data that is not
+    a multiple of 16 bytes) are None, they need decrypt_device_line to find out what is wrong.
+
+    Every line is encrypted with the same key, so all well formed lines are decrypted with a single
+    AES CBC call over the concatenation of each line's iv and data.  In CBC the first block of a
+    line is xored with the block before it, which is the line's iv, as it would be if the line
+    were decrypted alone.  The decrypted ivs are garbage and are skipped. """
+    results = [None] * len(lines)
+    if not key or len(key) not in (16, 24, 32):
+        return results
+
+    pieces = []
+    positions = []  # (index of line, start of its data, end of its data) in the decrypted buffer
+    position = 0
+    for i, line in enumerate(lines):
+        if not line or line.count(b":") != 1:
+            continue
+        iv, data = line.translate(URL_SAFE_BASE64_TRANSLATION).split(b":")
+        try:
+            iv = a2b_base64(iv)
+            data = a2b_base64(data)
+        except ValueError:
+            continue
+        if len(iv) != 16 or not data or len(data) % 16:
+            continue
+        pieces.append(iv)
+        pieces.append(data)
+        positions.append((i, position + 16, position + 16 + len(data)))
+        position += 16 + len(data)
+
+    if not pieces:
+        return results
+
+    decrypted = AES.new(key, mode=AES.MODE_CBC, IV=bytes(16)).decrypt(b"".join(pieces))
+    del pieces
+    for i, start, end in positions:
+        # PKCS5 padding, as in decrypt_device_line
+        results[i] = decrypted[start:end - decrypted[end - 1]]
+    return results
+
+
 def decrypt_device_line(patient_id, key, data: bytes) -> bytes:
     """ Config is expected to be 3 colon separated values.
         value 1 is the symmetric key, encrypted with the patient's public key.
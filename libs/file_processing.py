@@ -1,33 +1,55 @@
-import codecs
 import gc
+import heapq
 import sys
 import traceback
+import zlib
+from bisect import bisect_left
 from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import datetime
-from multiprocessing.pool import ThreadPool
-from pprint import pprint
-from typing import DefaultDict, Generator, List, Tuple
+from itertools import islice
+from multiprocessing import get_context
+from operator import itemgetter, le
+from threading import Lock
+from typing import Callable, DefaultDict, Generator, Iterable, List, Tuple
 
 from botocore.exceptions import ReadTimeoutError
 from cronutils.error_handler import ErrorHandler
 from django.core.exceptions import ValidationError
+from django.db import transaction
 
 # noinspection PyUnresolvedReferences
 from config import load_django
 from config.constants import (ACCELEROMETER, ANDROID_LOG_FILE, API_TIME_FORMAT, CALL_LOG,
-    CHUNK_TIMESLICE_QUANTUM, CHUNKABLE_FILES, CHUNKS_FOLDER, CONCURRENT_NETWORK_OPS,
-    DATA_PROCESSING_NO_ERROR_STRING, FILE_PROCESS_PAGE_SIZE, IDENTIFIERS, IOS_LOG_FILE,
-    SURVEY_DATA_FILES, SURVEY_TIMINGS, UPLOAD_FILE_TYPE_MAPPING, WIFI)
+    CHUNK_STAGING_COMPRESSION, CHUNK_TIMESLICE_QUANTUM, CHUNKABLE_FILES, CHUNKS_FOLDER, CONCURRENT_NETWORK_OPS,
+    DATA_PROCESSING_NO_ERROR_STRING, FILE_PROCESS_CPU_WORKERS, FILE_PROCESS_PAGE_SIZE, FILE_PROCESS_QUEUE_DEPTH,
+    IDENTIFIERS, IOS_LOG_FILE, SURVEY_DATA_FILES, SURVEY_TIMINGS, UPLOAD_FILE_TYPE_MAPPING,
+    USE_COLUMNAR_FILE_PROCESSING, WIFI)
 from database.data_access_models import ChunkRegistry, FileProcessLock, FileToProcess
+from database.profiling_models import UploadTracking
 from database.study_models import Survey
 from database.user_models import Participant
-from libs.s3 import s3_retrieve, s3_upload
+from libs.csv_serializer import (iterate_csv_lines, serialize_csv, serialize_csv_rows,
+    split_csv_header)
+from libs.s3 import s3_get_size, s3_retrieve, s3_upload
+from libs.security import chunk_hash
+from libs.threaded_pipeline import BoundedWorkQueue, imap_bounded
+
+if USE_COLUMNAR_FILE_PROCESSING:
+    from libs.columnar_chunk import ColumnarChunk
+if CHUNK_STAGING_COMPRESSION == "lz4":
+    import lz4.frame
 
 
 class EverythingWentFine(Exception): pass
 class ProcessingOverlapError(Exception): pass
 
 
+# see get_cpu_pool
+_cpu_pool = None
+_cpu_pool_lock = Lock()
+
+
 """########################## Hourly Update Tasks ###########################"""
 
 
@@ -100,13 +122,18 @@ def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, skip_co
     In a single call to this function, count files will be processed, starting from file number
     skip_count. The first skip_count files are expected to be files that have previously errored
     in file processing.
+
+    Downloading, processing and uploading overlap: files are downloaded on a pool of threads while
+    earlier files are processed, and (in upload_binified_data) finished chunks are uploaded while
+    later chunks are built.  No more than FILE_PROCESS_QUEUE_DEPTH files are ever held downloaded-
+    but-unprocessed, so memory use for raw files does not grow with the page size.
+
+    If FILE_PROCESS_CPU_WORKERS is set, csv parsing and chunk serialization run on a pool of that
+    many processes instead of on this one, so that a single participant can use multiple cores.
     """
     # Declare a defaultdict containing a tuple of two double ended queues (deque, pronounced "deck")
     all_binified_data = defaultdict(lambda: (deque(), deque()))
     ftps_to_remove = set()
-    # The ThreadPool enables downloading multiple files simultaneously from the network, and continuing
-    # to download files as other files are being processed, making the code as a whole run faster.
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
     survey_id_dict = {}
 
     # A Django query with a slice (e.g. .all()[x:y]) makes a LIMIT query, so it
@@ -118,9 +145,12 @@ def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, skip_co
 
     files_to_process = participant.files_to_process.exclude(deleted=True).all()
 
-    for data in pool.map(batch_retrieve_for_processing,
-                         files_to_process[skip_count:count+skip_count],
-                         chunksize=1):
+    # Files are downloaded on CONCURRENT_NETWORK_OPS threads, in order, and downloading continues
+    # while earlier files are processed, but stalls if processing falls FILE_PROCESS_QUEUE_DEPTH behind.
+    for data in imap_bounded(batch_retrieve_for_processing,
+                             files_to_process[skip_count:count+skip_count],
+                             threads=CONCURRENT_NETWORK_OPS,
+                             max_pending=FILE_PROCESS_QUEUE_DEPTH):
         with error_handler:
             # If we encountered any errors in retrieving the files for processing, they have been
             # lumped together into data['exception']. Raise them here to the error handler and
@@ -130,13 +160,16 @@ def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, skip_co
                 print(data['traceback'])
                 ################################################################
                 # YOU ARE SEEING THIS EXCEPTION WITHOUT A STACK TRACE
-                # BECAUSE IT OCCURRED INSIDE POOL.MAP ON ANOTHER THREAD
+                # BECAUSE IT OCCURRED INSIDE THE DOWNLOAD STAGE ON ANOTHER THREAD
                 ################################################################
                 raise data['exception']
 
             if data['chunkable']:
-                # case: chunkable data files
-                newly_binified_data, survey_id_hash = process_csv_data(data)
+                # case: chunkable data files, already processed in the download stage if there is a cpu pool
+                if data['binified'] is not None:
+                    newly_binified_data, survey_id_hash = data['binified']
+                else:
+                    newly_binified_data, survey_id_hash = process_csv_data(data)
                 if data['data_type'] in SURVEY_DATA_FILES:
                     survey_id_dict[survey_id_hash] = resolve_survey_id_from_file_name(data['ftp']["s3_file_path"])
 
@@ -157,7 +190,7 @@ def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, skip_co
                         data['ftp']['s3_file_path'],
                         data['ftp']['study'].pk,
                         data['ftp']['participant'].pk,
-                        data['file_contents'],
+                        data['file_size'],
                     )
                     ftps_to_remove.add(data['ftp']['id'])
                 except ValidationError as ve:
@@ -172,15 +205,13 @@ def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, skip_co
                         ChunkRegistry.update_registered_unchunked_data(
                             data['data_type'],
                             data['ftp']['s3_file_path'],
-                            data['file_contents'],
+                            data['file_size'],
                         )
                         ftps_to_remove.add(data['ftp']['id'])
                     else:
                         # any other errors, add
                         raise
 
-    pool.close()
-    pool.terminate()
     more_ftps_to_remove, number_bad_files = upload_binified_data(all_binified_data, error_handler, survey_id_dict)
     ftps_to_remove.update(more_ftps_to_remove)
     # Actually delete the processed FTPs from the database
@@ -193,23 +224,36 @@ def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, skip_co
 def upload_binified_data(binified_data, error_handler, survey_id_dict):
     """ Takes in binified csv data and handles uploading/downloading+updating
         older data to/from S3 for each chunk.
+        Each chunk is handed to the upload threads as soon as it is built, at most
+        FILE_PROCESS_QUEUE_DEPTH built chunks wait for upload at a time.
         Returns a set of concatenations that have succeeded and can be removed.
         Returns the number of failed FTPS so that we don't retry them.
-        Raises any errors on the passed in ErrorHandler."""
+        Raises any errors on the passed in ErrorHandler, including those of chunks that failed to
+        build (on the cpu pool) or upload, whose FTPs are failed like any other."""
     failed_ftps = set([])
     ftps_to_retire = set([])
-    upload_these = []
+    # the ftps of each chunk handed to the uploader, in submission order (the order of its results)
+    uploaded_ftps = []
+
+    # Every chunk path of the page is checked against the database in one query.
+    existing_chunks = ChunkRegistry.get_chunks_by_path(
+        construct_s3_chunk_path(study_id, user_id, data_type, time_bin)
+        for study_id, user_id, data_type, time_bin, _ in binified_data
+    )
+
+    uploader = BoundedWorkQueue(batch_upload, threads=CONCURRENT_NETWORK_OPS, max_pending=FILE_PROCESS_QUEUE_DEPTH)
     for data_bin, (data_rows_deque, ftp_deque) in binified_data.items():
         with error_handler:
             try:
                 study_id, user_id, data_type, time_bin, original_header = data_bin
-                # data_rows_deque may be a generator; here it is evaluated
+                updated_header = insert_utc_time_header(original_header)
+                # The rows are handed over to build_chunk_contents, the bin's deque is released.
                 rows = list(data_rows_deque)
-                updated_header = convert_unix_to_human_readable_timestamps(original_header, rows)
+                data_rows_deque.clear()
                 chunk_path = construct_s3_chunk_path(study_id, user_id, data_type, time_bin)
 
-                if ChunkRegistry.objects.filter(chunk_path=chunk_path).exists():
-                    chunk = ChunkRegistry.objects.get(chunk_path=chunk_path)
+                if chunk_path in existing_chunks:
+                    chunk = existing_chunks[chunk_path]
                     try:
                         s3_file_data = s3_retrieve(chunk_path, study_id, raw_path=True)
                     except ReadTimeoutError as e:
@@ -224,7 +268,8 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
                             raise ChunkFailedToExist("chunk %s does not actually point to a file, deleting DB entry, should run correctly on next index." % chunk_path)
                         raise  # Raise original error if not 404 s3 error
 
-                    old_header, old_rows = csv_to_list(s3_file_data)
+                    old_header, _, old_body = s3_file_data.partition(b"\n")
+                    del s3_file_data
 
                     if old_header != updated_header:
                         # To handle the case where a file was on an hour boundary and placed in
@@ -235,19 +280,14 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
                         raise HeaderMismatchException('%s\nvs.\n%s\nin\n%s' %
                                                       (old_header, updated_header, chunk_path) )
 
-                    old_rows = [_ for _ in old_rows]
-                    # This is O(1), which is why we use a deque (double-ended queue)
-                    old_rows.extend(rows)
-                    del rows
-                    ensure_sorted_by_timestamp(old_rows)
-                    new_contents = construct_csv_string(updated_header, old_rows)
-                    del old_rows
-
-                    upload_these.append((chunk, chunk_path, codecs.encode(new_contents, "zip"), study_id))
+                    new_contents = submit_chunk_build(original_header, rows, old_body)
+                    del old_body, rows
+                    uploader.submit((chunk, chunk_path, new_contents, study_id))
+                    uploaded_ftps.append(ftp_deque)
                     del new_contents
                 else:
-                    ensure_sorted_by_timestamp(rows)
-                    new_contents = construct_csv_string(updated_header, rows)
+                    new_contents = submit_chunk_build(original_header, rows)
+                    del rows
                     if data_type in SURVEY_DATA_FILES:
                         # We need to keep a mapping of files to survey ids, that is handled here.
                         survey_id_hash = study_id, user_id, data_type, original_header
@@ -263,7 +303,9 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
                         "survey_id": survey_id
                     }
 
-                    upload_these.append((chunk_params, chunk_path, codecs.encode(new_contents, "zip"), study_id))
+                    uploader.submit((chunk_params, chunk_path, new_contents, study_id))
+                    uploaded_ftps.append(ftp_deque)
+                    del new_contents
             except Exception as e:
                 # Here we catch any exceptions that may have arisen, as well as the ones that we raised
                 # ourselves (e.g. HeaderMismatchException). Whichever FTP we were processing when the
@@ -279,15 +321,18 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
                 # retireable (i.e. completed) FTPs.
                 ftps_to_retire.update(ftp_deque)
 
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
-    errors = pool.map(batch_upload, upload_these, chunksize=1)
-    for err_ret in errors:
+    upload_results = uploader.finish()
+
+    # Database entries are written for every chunk that made it to S3 before any error is raised,
+    # chunks that fail to register are failed below like those that failed to upload.
+    register_uploaded_chunks([ret for ret in upload_results if not ret['exception']])
+    for err_ret, ftp_deque in zip(upload_results, uploaded_ftps):
         if err_ret['exception']:
-            print(err_ret['traceback'])
-            raise err_ret['exception']
+            failed_ftps.update(ftp_deque)
+            with error_handler:
+                print(err_ret['traceback'])
+                raise err_ret['exception']
 
-    pool.close()
-    pool.terminate()
     # The things in ftps to retire that are not in failed ftps.
     # len(failed_ftps) will become the number of files to skip in the next iteration.
     return ftps_to_retire.difference(failed_ftps), len(failed_ftps)
@@ -343,20 +388,137 @@ def ensure_sorted_by_timestamp(l: list):
     l.sort(key=lambda x: int(x[0]))
 
 
+def merge_into_existing_csv(header: bytes, old_body: bytes, new_rows: List[Tuple[int, List[bytes]]]) -> bytes:
+    """ Existing chunks are already sorted by timestamp, new_rows are (timestamp, row) pairs that
+    must be sorted too, the two are streamed through a merge straight into the output.  If the
+    existing chunk turns out not to be sorted we fall back to sorting everything. """
+    try:
+        merged_lines = merge_sorted_csv_lines(
+            _timestamped_lines(iterate_csv_lines(old_body)),
+            ((timestamp, b",".join(row)) for timestamp, row in new_rows),
+        )
+        # merge_sorted_csv_lines already deduplicates
+        return serialize_csv(header, merged_lines, deduplicate=False)
+    except UnsortedChunkError:
+        print("encountered an unsorted chunk, sorting all rows.")
+        old_rows = [line.split(b",") for line in iterate_csv_lines(old_body)]
+        old_rows.extend(row for _, row in new_rows)
+        ensure_sorted_by_timestamp(old_rows)
+        return construct_csv_string(header, old_rows)
+
+
+def merge_sorted_csv_lines(*sorted_lines: Iterable[Tuple[int, bytes]]) -> Generator[bytes, None, None]:
+    """ A k-way merge of iterables of (timestamp, csv line) pairs that are each sorted by timestamp,
+    dropping any duplicate lines.  On equal timestamps lines from earlier iterables come first,
+    identical to a stable sort of their concatenation.  Duplicate lines must have the same
+    timestamp, so only the lines of the current timestamp need to be remembered. """
+    seen = set()
+    current_timestamp = None
+    for timestamp, line in heapq.merge(*sorted_lines, key=itemgetter(0)):
+        if timestamp != current_timestamp:
+            seen.clear()
+            current_timestamp = timestamp
+        if line in seen:
+            continue
+        seen.add(line)
+        yield line
+
+
+def _timestamped_lines(lines: Iterable[bytes]) -> Generator[Tuple[int, bytes], None, None]:
+    """ Pairs each line with its timestamp, and checks that the lines are actually sorted.
+    Raises UnsortedChunkError if they are not. """
+    previous_timestamp = None
+    for line in lines:
+        timestamp = int(line.partition(b",")[0])
+        if previous_timestamp is not None and timestamp < previous_timestamp:
+            raise UnsortedChunkError()
+        previous_timestamp = timestamp
+        yield timestamp, line
+
+
+def build_chunk_contents(header: bytes, rows: list, old_body: bytes = None) -> bytes:
+    """ Adds the UTC time column to the rows of a bin and serializes them, merged into old_body (the
+        body of the existing chunk) if there is one.  header is the original header of the bin.
+        Returns the contents of the chunk, staged by stage_chunk_contents. """
+    if USE_COLUMNAR_FILE_PROCESSING:
+        # rows contains ColumnarChunks, not rows
+        new_rows = ColumnarChunk.concatenate(rows).with_utc_time_column()
+        header = insert_utc_time_header(header)
+        if old_body is None:
+            contents = new_rows.sorted_deduplicated().to_csv(header)
+        else:
+            contents = ColumnarChunk.merge(ColumnarChunk.from_csv_body(old_body), new_rows).to_csv(header)
+    else:
+        # rows contains (timestamp, row) pairs, see binify_csv_rows
+        rows.sort(key=itemgetter(0))
+        header = add_utc_time_column(header, rows)
+        if old_body is None:
+            contents = construct_csv_string(header, map(itemgetter(1), rows))
+        else:
+            # the body of the existing chunk is merged as bytes, it is never split into rows.
+            contents = merge_into_existing_csv(header, old_body, rows)
+    return stage_chunk_contents(contents)
+
+
+def stage_chunk_contents(contents: bytes) -> bytes:
+    """ Chunks wait in memory between being built and being uploaded, CHUNK_STAGING_COMPRESSION
+        determines whether and how they are compressed in the meantime. """
+    if CHUNK_STAGING_COMPRESSION == "zlib":
+        return zlib.compress(contents, 1)
+    if CHUNK_STAGING_COMPRESSION == "lz4":
+        return lz4.frame.compress(contents)
+    return contents
+
+
+def unstage_chunk_contents(staged_contents: bytes) -> bytes:
+    """ Reverses stage_chunk_contents. """
+    if CHUNK_STAGING_COMPRESSION == "zlib":
+        return zlib.decompress(staged_contents)
+    if CHUNK_STAGING_COMPRESSION == "lz4":
+        return lz4.frame.decompress(staged_contents)
+    return staged_contents
+
+
+def submit_chunk_build(header: bytes, rows: list, old_body: bytes = None):
+    """ Runs build_chunk_contents, on the cpu pool if there is one.  In that case the return value
+        is a Future, batch_upload waits on it. """
+    if FILE_PROCESS_CPU_WORKERS:
+        return get_cpu_pool().submit(build_chunk_contents, header, rows, old_body)
+    return build_chunk_contents(header, rows, old_body)
+
+
 def convert_unix_to_human_readable_timestamps(header: bytes, rows: list) -> List[bytes]:
     """ Adds a new column to the end which is the unix time represented in
     a human readable time format.  Returns an appropriately modified header. """
+    utc_time = utc_time_formatter()
     for row in rows:
-        unix_millisecond = int(row[0])
-        time_string = unix_time_to_string(unix_millisecond // 1000)
-        # this line 0-pads millisecond values that have leading 0s.
-        time_string += b".%03d" % (unix_millisecond % 1000)
-        row.insert(1, time_string)
+        row.insert(1, utc_time(int(row[0])))
+    return insert_utc_time_header(header)
+
+
+def add_utc_time_column(header: bytes, timestamped_rows: Iterable[Tuple[int, List[bytes]]]) -> bytes:
+    """ As convert_unix_to_human_readable_timestamps, for (timestamp, row) pairs whose timestamps
+    have already been parsed. """
+    utc_time = utc_time_formatter()
+    for timestamp, row in timestamped_rows:
+        row.insert(1, utc_time(timestamp))
+    return insert_utc_time_header(header)
+
+
+def insert_utc_time_header(header: bytes) -> bytes:
+    """ Inserts the "UTC time" column name as the second column of a header. """
     header = header.split(b",")
     header.insert(1, b"UTC time")
     return b",".join(header)
 
 
+# The bin of a millisecond timestamp is timestamp // MILLISECONDS_PER_BIN.  That is only identical to
+# binify_from_timecode for timestamps of exactly 13 characters with a value in this range, i.e. 13 digits.
+MILLISECONDS_PER_BIN = 1000 * CHUNK_TIMESLICE_QUANTUM
+MIN_MILLISECOND_TIMECODE = 10 ** 12
+MAX_MILLISECOND_TIMECODE = 10 ** 13 - 1
+
+
 def binify_from_timecode(unix_ish_time_code_string: bytes) -> int:
     """ Takes a unix-ish time code (accepts unix millisecond), and returns an
         integer value of the bin it should go in. """
@@ -375,13 +537,38 @@ def binify_csv_rows(rows_list: list, study_id: str, user_id: str, data_type: str
     """ Assumes a clean csv with element 0 in the rows column as a unix(ish) timestamp.
         Sorts data points into the appropriate bin based on the rounded down hour
         value of the entry's unix(ish) timestamp. (based CHUNK_TIMESLICE_QUANTUM)
-        Returns a dict of form {(study_id, user_id, data_type, time_bin, header):rows_lists}. """
+        Each timestamp is parsed exactly once, rows are stored as (timestamp, row) pairs so that
+        sorting and the UTC time column reuse it.  Files are almost always already sorted, their
+        bins are then found by bisecting the timestamps instead of row by row.
+        Returns a dict of form {(study_id, user_id, data_type, time_bin, header): deque of (timestamp, row)}. """
+    # discovered August 7 2017, looks like there was an empty line at the end
+    # of a file? row was a [''].
+    rows_list = [row for row in rows_list if row and row[0]]
+    timestamps = [int(row[0]) for row in rows_list]
     ret = defaultdict(deque)
-    for row in rows_list:
-        # discovered August 7 2017, looks like there was an empty line at the end
-        # of a file? row was a [''].
-        if row and row[0]:
-            ret[(study_id, user_id, data_type, binify_from_timecode(row[0]), header)].append(row)
+    if not rows_list:
+        return ret
+
+    if (MIN_MILLISECOND_TIMECODE <= timestamps[0] and timestamps[-1] <= MAX_MILLISECOND_TIMECODE
+            and all(map(le, timestamps, islice(timestamps, 1, None)))
+            and set(map(len, map(itemgetter(0), rows_list))) == {13}):
+        # sorted, and every timestamp is a plain 13 digit millisecond timecode
+        start = 0
+        while start < len(timestamps):
+            time_bin = timestamps[start] // MILLISECONDS_PER_BIN
+            end = bisect_left(timestamps, (time_bin + 1) * MILLISECONDS_PER_BIN, start)
+            ret[(study_id, user_id, data_type, time_bin, header)] = deque(
+                zip(timestamps[start:end], rows_list[start:end])
+            )
+            start = end
+        return ret
+
+    for timestamp, row in zip(timestamps, rows_list):
+        if len(row[0]) == 13 and MIN_MILLISECOND_TIMECODE <= timestamp <= MAX_MILLISECOND_TIMECODE:
+            time_bin = timestamp // MILLISECONDS_PER_BIN
+        else:
+            time_bin = binify_from_timecode(row[0])
+        ret[(study_id, user_id, data_type, time_bin, header)].append((timestamp, row))
     return ret
 
 
@@ -391,7 +578,10 @@ def append_binified_csvs(old_binified_rows: DefaultDict[tuple, deque],
     """ Appends binified rows to an existing binified row data structure.
         Should be in-place. """
     for data_bin, rows in new_binified_rows.items():
-        old_binified_rows[data_bin][0].extend(rows)  # Add data rows
+        if USE_COLUMNAR_FILE_PROCESSING:
+            old_binified_rows[data_bin][0].append(rows)  # Add the ColumnarChunk
+        else:
+            old_binified_rows[data_bin][0].extend(rows)  # Add data rows
         old_binified_rows[data_bin][1].append(file_to_process['id'])  # Add ftp
 
 
@@ -400,57 +590,125 @@ def process_csv_data(data: dict):
     """ Constructs a binified dict of a given list of a csv rows,
         catches csv files with known problems and runs the correct logic.
         Returns None If the csv has no data in it. """
-    participant = data['ftp']['participant']
+    return binify_file_contents(file_data_for_binification(data))
+
+
+def file_data_for_binification(data: dict) -> dict:
+    """ Moves the file contents, and the few details about the file that binify_file_contents
+        needs, out of a batch_retrieve_for_processing dict into a dict of bytes and strings that
+        can be sent to a worker process of the cpu pool (see get_cpu_pool). """
+    return {
+        "file_contents": data.pop('file_contents'),
+        "data_type": data["data_type"],
+        "file_path": data['ftp']['s3_file_path'],
+        "os_type": data['ftp']['participant'].os_type,
+        "study_object_id": data['ftp']['study'].object_id.encode(),
+        "patient_id": data['ftp']['participant'].patient_id,
+    }
+
+
+def binify_file_contents(file_data: dict):
+    """ The body of process_csv_data, takes the output of file_data_for_binification. """
+    if USE_COLUMNAR_FILE_PROCESSING:
+        return binify_file_contents_columnar(file_data)
 
-    if participant.os_type == Participant.ANDROID_API:
+    data_type = file_data["data_type"]
+    file_path = file_data["file_path"]
+    os_type = file_data["os_type"]
+
+    if os_type == Participant.ANDROID_API:
         # Do fixes for Android
-        if data["data_type"] == ANDROID_LOG_FILE:
-            data['file_contents'] = fix_app_log_file(data['file_contents'], data['ftp']['s3_file_path'])
+        if data_type == ANDROID_LOG_FILE:
+            file_data['file_contents'] = fix_app_log_file(file_data['file_contents'], file_path)
 
-        header, csv_rows_list = csv_to_list(data['file_contents'])
-        if data["data_type"] != ACCELEROMETER:
+        header, csv_rows_list = csv_to_list(file_data['file_contents'])
+        if data_type != ACCELEROMETER:
             # If the data is not accelerometer data, convert the generator to a list.
             # For accelerometer data, the data is massive and so we don't want it all
             # in memory at once.
             csv_rows_list = [r for r in csv_rows_list]
 
-        if data["data_type"] == CALL_LOG:
+        if data_type == CALL_LOG:
             header = fix_call_log_csv(header, csv_rows_list)
-        if data["data_type"] == WIFI:
-            header = fix_wifi_csv(header, csv_rows_list, data['ftp']['s3_file_path'])
+        if data_type == WIFI:
+            header = fix_wifi_csv(header, csv_rows_list, file_path)
     else:
         # Do fixes for iOS
-        header, csv_rows_list = csv_to_list(data['file_contents'])
-        if data["data_type"] != ACCELEROMETER:
+        header, csv_rows_list = csv_to_list(file_data['file_contents'])
+        if data_type != ACCELEROMETER:
             csv_rows_list = [r for r in csv_rows_list]
 
     # Memory saving measure: this data is now stored in its entirety in csv_rows_list
-    del data['file_contents']
+    del file_data['file_contents']
 
     # Do these fixes for data whether from Android or iOS
-    if data["data_type"] == IDENTIFIERS:
-        header = fix_identifier_csv(header, csv_rows_list, data['ftp']['s3_file_path'])
-    if data["data_type"] == SURVEY_TIMINGS:
-        header = fix_survey_timings(header, csv_rows_list, data['ftp']['s3_file_path'])
+    if data_type == IDENTIFIERS:
+        header = fix_identifier_csv(header, csv_rows_list, file_path)
+    if data_type == SURVEY_TIMINGS:
+        header = fix_survey_timings(header, csv_rows_list, file_path)
 
     header = b",".join([column_name.strip() for column_name in header.split(b",")])
     if csv_rows_list:
         return (
             # return item 1: the data as a defaultdict
             binify_csv_rows(
-                csv_rows_list,
-                data['ftp']['study'].object_id.encode(),
-                data['ftp']['participant'].patient_id,
-                data["data_type"],
-                header
+                csv_rows_list, file_data["study_object_id"], file_data["patient_id"], data_type, header
             ),
             # return item 2: the tuple that we use as a key for the defaultdict
-            (data['ftp']['study'].object_id.encode(), data['ftp']['participant'].patient_id, data["data_type"], header)
+            (file_data["study_object_id"], file_data["patient_id"], data_type, header)
         )
     else:
         return None, None
 
 
+def binify_file_contents_columnar(file_data: dict):
+    """ The columnar equivalent of binify_file_contents, returns the same structure but with a
+        ColumnarChunk in place of each deque of rows.  Files that do not need per-row fixes are
+        parsed straight from their bytes, no per-row lists are ever created. """
+    data_type = file_data["data_type"]
+    file_path = file_data["file_path"]
+    os_type = file_data["os_type"]
+
+    if os_type == Participant.ANDROID_API and data_type == ANDROID_LOG_FILE:
+        file_data['file_contents'] = fix_app_log_file(file_data['file_contents'], file_path)
+
+    needs_row_fixes = data_type in (IDENTIFIERS, SURVEY_TIMINGS) or (
+        os_type == Participant.ANDROID_API and data_type in (CALL_LOG, WIFI)
+    )
+
+    if needs_row_fixes:
+        header, csv_rows_list = csv_to_list(file_data['file_contents'])
+        del file_data['file_contents']
+        csv_rows_list = [r for r in csv_rows_list]
+        if data_type == CALL_LOG:
+            header = fix_call_log_csv(header, csv_rows_list)
+        if data_type == WIFI:
+            header = fix_wifi_csv(header, csv_rows_list, file_path)
+        if data_type == IDENTIFIERS:
+            header = fix_identifier_csv(header, csv_rows_list, file_path)
+        if data_type == SURVEY_TIMINGS:
+            header = fix_survey_timings(header, csv_rows_list, file_path)
+        chunk = ColumnarChunk.from_rows(csv_rows_list)
+        del csv_rows_list
+    else:
+        header, body = split_csv_header(file_data['file_contents'])
+        del file_data['file_contents']
+        chunk = ColumnarChunk.from_csv_body(body)
+        del body
+
+    header = b",".join([column_name.strip() for column_name in header.split(b",")])
+    if not len(chunk):
+        return None, None
+
+    study_object_id = file_data["study_object_id"]
+    patient_id = file_data["patient_id"]
+    return (
+        {(study_object_id, patient_id, data_type, time_bin, header): binned_chunk
+         for time_bin, binned_chunk in chunk.binify().items()},
+        (study_object_id, patient_id, data_type, header),
+    )
+
+
 """############################ CSV Fixes #####################################"""
 
 
@@ -526,7 +784,7 @@ def fix_app_log_file(file_contents, file_path):
                 new_rows.append((new_rows[-1][0], row))
                 continue
 
-    return b"timestamp, event\n" + b"\n".join(b",".join(row) for row in new_rows)
+    return serialize_csv_rows(b"timestamp, event", new_rows, deduplicate=False)
 
 
 """###################################### CSV Utils ##################################"""
@@ -557,37 +815,10 @@ def csv_to_list(csv_string: bytes) -> (bytes, Generator):
     return header, split_yielder(lines)
 
 
-def construct_csv_string(header: bytes, rows_list: List[bytes]) -> bytes:
-    """ Takes a header list and a csv and returns a single string of a csv.
-        Now handles unicode errors.  :D :D :D """
-    # The old, compact list comprehension was, it turned out, both nonperformant and of an
-    # incomprehensible memory order. This is ~1.5x faster, and has a much clearer memory order.
-
-    def deduplicate(seq):
-        # highly optimized order preserving deduplication function.
-        seen = set()
-        seen_add = seen.add
-        return [x for x in seq if not (x in seen or seen_add(x))]
-
-    rows = []
-    for row_items in rows_list:
-
-        try:
-            rows.append(b",".join(row_items))
-        except TypeError:
-            print("######################################################################3")
-            pprint(row_items)
-            print("######################################################################3")
-            raise
-
-    del rows_list, row_items
-
-    # we need to ensure no duplicates
-    rows = deduplicate(rows)
-    ret = header
-    for row in rows:
-        ret += b"\n" + row
-    return ret
+def construct_csv_string(header: bytes, rows_list: List[List[bytes]]) -> bytes:
+    """ Takes a header list and a csv and returns a single string of a csv, with duplicate rows
+        removed.  (Rows used to be concatenated one at a time, which was quadratic in chunk size.) """
+    return serialize_csv_rows(header, rows_list)
 
 
 def clean_java_timecode(java_time_code_string: bytes) -> int:
@@ -599,6 +830,28 @@ def unix_time_to_string(unix_time: int) -> bytes:
     return datetime.utcfromtimestamp(unix_time).strftime(API_TIME_FORMAT).encode()
 
 
+# ".000" through ".999", 0-padded millisecond suffixes of human readable timestamps
+MILLISECOND_SUFFIXES = [b".%03d" % millisecond for millisecond in range(1000)]
+
+
+def utc_time_formatter() -> Callable[[int], bytes]:
+    """ Returns a function that formats unix millisecond timestamps as human readable UTC time with
+        milliseconds.  Sensor data has many rows per second, so the formatted second is memoized and
+        only the millisecond suffix is added per row.  The memo is not bounded, use a new formatter
+        for each chunk. """
+    seconds = {}
+
+    def format_utc_time(unix_millisecond: int) -> bytes:
+        second, millisecond = divmod(unix_millisecond, 1000)
+        try:
+            prefix = seconds[second]
+        except KeyError:
+            prefix = seconds[second] = unix_time_to_string(second)
+        return prefix + MILLISECOND_SUFFIXES[millisecond]
+
+    return format_utc_time
+
+
 """ Batch Operations """
 
 
@@ -615,6 +868,8 @@ def batch_retrieve_for_processing(ftp_as_object: FileToProcess) -> dict:
         "data_type": data_type,
         'exception': None,
         "file_contents": "",
+        "file_size": None,
+        "binified": None,
         "traceback": None,
         'chunkable': data_type in CHUNKABLE_FILES,
     }
@@ -622,8 +877,18 @@ def batch_retrieve_for_processing(ftp_as_object: FileToProcess) -> dict:
     # Try to retrieve the file contents. If any errors are raised, store them to be raised by the
     # parent function
     try:
+        if not ret['chunkable']:
+            # Unchunkable files (audio, images) are only registered, their contents are never needed.
+            ret['file_size'] = get_unchunked_file_size(ftp)
+            return ret
+
         # print(ftp['s3_file_path'] + ", getting data...")
         ret['file_contents'] = s3_retrieve(ftp['s3_file_path'], ftp["study"].object_id.encode(), raw_path=True)
+        if FILE_PROCESS_CPU_WORKERS:
+            # This thread waits on the worker process without holding the GIL.
+            ret['binified'] = get_cpu_pool().submit(
+                binify_file_contents, file_data_for_binification(ret)
+            ).result()
     except Exception as e:
         traceback.print_exc()
         ret['traceback'] = sys.exc_info()
@@ -631,45 +896,66 @@ def batch_retrieve_for_processing(ftp_as_object: FileToProcess) -> dict:
     return ret
 
 
+def get_unchunked_file_size(ftp: dict) -> int:
+    """ Gets the size of an unchunkable file without downloading it.  Uploads are tracked with
+        their size, files without an UploadTracking entry fall back to an S3 HEAD request. """
+    study_prefix = ftp['study'].object_id + "/"
+    file_path = ftp['s3_file_path']
+    # UploadTracking paths do not contain the study folder
+    tracked_path = file_path[len(study_prefix):] if file_path.startswith(study_prefix) else file_path
+    file_size = UploadTracking.objects.filter(
+        participant=ftp['participant'], file_path=tracked_path
+    ).order_by("-timestamp").values_list("file_size", flat=True).first()
+    if file_size is None:
+        file_size = s3_get_size(file_path, ftp['study'].object_id, raw_path=True)
+    return file_size
+
+
+def get_cpu_pool() -> ProcessPoolExecutor:
+    """ The pool of FILE_PROCESS_CPU_WORKERS processes that csv parsing and chunk serialization run
+        on, so that they are not serialized by the GIL.  Created on first use and kept for the life
+        of the process.  Work is handed over as bytes and bins of rows, never as database objects.
+
+        The pool is first used from the download threads, and its worker processes are started as
+        work arrives, so they are never forked from this (threaded) process: they are forked from a
+        forkserver, and share none of this process's locks or database connections. """
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = ProcessPoolExecutor(
+                max_workers=FILE_PROCESS_CPU_WORKERS, mp_context=get_context("forkserver")
+            )
+    return _cpu_pool
+
+
 def batch_upload(upload: Tuple[dict, str, bytes, str]):
-    """ Used for mapping an s3_upload function.  the tuple is unpacked, can only have one parameter. """
-    ret = {'exception': None, 'traceback': None}
+    """ Used for mapping an s3_upload function.  the tuple is unpacked, can only have one parameter.
+        The ChunkRegistry is not touched here, the return value is passed (as part of a list) to
+        register_uploaded_chunks. """
+    ret = {'exception': None, 'traceback': None, 'chunk': None, 'chunk_hash': None, 'file_size': None}
     try:
         if len(upload) != 4:
             # upload should have length 4; this is for debugging if it doesn't
             print("upload length not equal to 4: ",upload)
-        chunk, chunk_path, new_contents, study_object_id = upload
+        chunk, chunk_path, staged_contents, study_object_id = upload
         del upload
+        if isinstance(staged_contents, Future):
+            staged_contents = staged_contents.result()
 
         if "b'" in chunk_path:
             raise Exception(chunk_path)
 
-        s3_upload(chunk_path, codecs.decode(new_contents, "zip"), study_object_id, raw_path=True)
+        new_contents = unstage_chunk_contents(staged_contents)
+        del staged_contents
+        s3_upload(chunk_path, new_contents, study_object_id, raw_path=True)
         # print("data uploaded!", chunk_path)
 
-        if isinstance(chunk, ChunkRegistry):
-            # If the contents are being appended to an existing ChunkRegistry object
-            chunk.file_size = len(new_contents)
-            chunk.update_chunk_hash(new_contents)
-
-        else:
-            # If a new ChunkRegistry object is being created
-            # Convert the ID's used in the S3 file names into primary keys for making ChunkRegistry FKs
-            participant_pk, study_pk = Participant.objects.filter(patient_id=chunk['user_id']).values_list('pk', 'study_id').get()
-            if chunk['survey_id']:
-                survey_pk = Survey.objects.filter(object_id=chunk['survey_id']).values_list('pk', flat=True).get()
-            else:
-                survey_pk = None
-
-            ChunkRegistry.register_chunked_data(
-                chunk['data_type'],
-                chunk['time_bin'],
-                chunk['chunk_path'],
-                new_contents,  # unlikely to be huge
-                study_pk,
-                participant_pk,
-                survey_pk,
-            )
+        # hashing happens here so that it is spread across the threads of the pool.  The hash and
+        # size are of the contents of the chunk, not of the staged copy (whose compression is
+        # configurable), see ChunkRegistry.chunk_hash for chunks hashed before this.
+        ret['chunk'] = chunk
+        ret['chunk_hash'] = chunk_hash(new_contents).decode()
+        ret['file_size'] = len(new_contents)
 
     # it broke. print stacktrace for debugging
     except Exception as e:
@@ -680,9 +966,98 @@ def batch_upload(upload: Tuple[dict, str, bytes, str]):
     return ret
 
 
+def register_uploaded_chunks(upload_results: List[dict]):
+    """ Creates and updates the ChunkRegistry entries of uploaded chunks (the return values of
+        batch_upload), in bulk and inside a single transaction.
+        Nothing is raised here, a chunk that cannot be registered gets the exception and traceback
+        set on its upload result, as a failed upload does, so that only the files of that chunk are
+        retried.  If the bulk transaction fails (bulk_create does not call full_clean) every chunk
+        is registered in a transaction of its own.  Chunks that share a chunk path are never
+        registered: their uploads all wrote the same S3 file. """
+    results_by_path = defaultdict(list)
+    for ret in upload_results:
+        chunk = ret['chunk']
+        chunk_path = chunk.chunk_path if isinstance(chunk, ChunkRegistry) else chunk['chunk_path']
+        results_by_path[chunk_path].append(ret)
+
+    to_register = []
+    for chunk_path, rets in results_by_path.items():
+        if len(rets) == 1:
+            to_register.append(rets[0])
+            continue
+        for ret in rets:
+            try:
+                raise DuplicateChunkPath("%s chunks were uploaded to %s" % (len(rets), chunk_path))
+            except DuplicateChunkPath:
+                set_upload_exception(ret)
+
+    try:
+        with transaction.atomic():
+            bulk_register_uploaded_chunks(to_register)
+    except Exception:
+        traceback.print_exc()
+        for ret in to_register:
+            try:
+                with transaction.atomic():
+                    bulk_register_uploaded_chunks([ret])
+            except Exception:
+                set_upload_exception(ret)
+
+
+def set_upload_exception(ret: dict):
+    """ Sets the exception being handled on an upload result (see batch_upload). """
+    traceback.print_exc()
+    ret['traceback'] = sys.exc_info()
+    ret['exception'] = ret['traceback'][1]
+
+
+def bulk_register_uploaded_chunks(upload_results: List[dict]):
+    """ The queries of register_uploaded_chunks.  Participant and survey primary keys are resolved
+        once for the whole batch instead of once per chunk. """
+    new_chunks = [ret for ret in upload_results if not isinstance(ret['chunk'], ChunkRegistry)]
+    updated_chunks = [ret for ret in upload_results if isinstance(ret['chunk'], ChunkRegistry)]
+
+    # Convert the ID's used in the S3 file names into primary keys for making ChunkRegistry FKs
+    participant_pks = {}
+    survey_pks = {}
+    if new_chunks:
+        patient_ids = {ret['chunk']['user_id'] for ret in new_chunks}
+        participant_pks = {
+            patient_id: (participant_pk, study_pk) for patient_id, participant_pk, study_pk in
+            Participant.objects.filter(patient_id__in=patient_ids).values_list('patient_id', 'pk', 'study_id')
+        }
+        survey_object_ids = {ret['chunk']['survey_id'] for ret in new_chunks if ret['chunk']['survey_id']}
+        if survey_object_ids:
+            survey_pks = dict(
+                Survey.objects.filter(object_id__in=survey_object_ids).values_list('object_id', 'pk')
+            )
+
+    new_chunks_params = []
+    for ret in new_chunks:
+        chunk = ret['chunk']
+        participant_pk, study_pk = participant_pks[chunk['user_id']]
+        new_chunks_params.append({
+            "data_type": chunk['data_type'],
+            "time_bin": chunk['time_bin'],
+            "chunk_path": chunk['chunk_path'],
+            "chunk_hash_str": ret['chunk_hash'],
+            "file_size": ret['file_size'],
+            "study_id": study_pk,
+            "participant_id": participant_pk,
+            "survey_id": survey_pks[chunk['survey_id']] if chunk['survey_id'] else None,
+        })
+
+    ChunkRegistry.bulk_register_chunked_data(new_chunks_params)
+    ChunkRegistry.bulk_update_chunk_hashes(
+        {ret['chunk'].pk: (ret['chunk_hash'], ret['file_size']) for ret in updated_chunks}
+    )
+
+
 """ Exceptions """
 class HeaderMismatchException(Exception): pass
 class ChunkFailedToExist(Exception): pass
+class DuplicateChunkPath(Exception): pass
+class UnsortedChunkError(Exception): pass
 
 
 # This is useful for performance testing, replace the real threadpool with this one and everything
@@ -7,6 +7,7 @@ from config.constants import (
 )
 from libs.file_processing import process_file_chunks
 from libs.s3 import s3_list_files, s3_delete, s3_upload
+from libs.s3_async import s3_list_files_many
 from database.data_access_models import ChunkRegistry, FileProcessLock, FileToProcess
 from database.study_models import Study
 from database.user_models import Participant
@@ -36,7 +37,7 @@ def reindex_all_files_to_process():
     
     # Get a list of all S3 files to replace in the database
     print('{!s} pulling new files to process...'.format(datetime.now()))
-    files_lists = pool.map(s3_list_files, Study.objects.values_list('object_id', flat=True))
+    files_lists = s3_list_files_many(Study.objects.values_list('object_id', flat=True))
     
     # For each such file, create an FTP object
     print("putting new files to process...")
@@ -79,7 +80,7 @@ def reindex_specific_data_type(data_type):
     pool.map(s3_delete, relevant_indexed_files)
 
     print("pulling files to process...")
-    files_lists = pool.map(s3_list_files, Study.objects.values_list('object_id', flat=True))
+    files_lists = s3_list_files_many(Study.objects.values_list('object_id', flat=True))
     for i, l in enumerate(files_lists):
         print('{!s} {:d} of {:d}, {:d} files'.format(datetime.now(), i + 1, Study.objects.count(), len(l)))
         for fp in l:
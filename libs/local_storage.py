@@ -0,0 +1,246 @@
+"""
+A stand-in for the boto3 S3 client that stores files on local disk, used by libs.s3 when
+STORAGE_BACKEND is "local".  It lets file processing and the data access api run (and be
+benchmarked) on a single machine without AWS.
+
+Only the parts of the client api that this codebase uses are implemented.  A bucket is a folder under
+the root folder and a key is a file path inside it, so a key cannot also be the "folder" of other keys.
+There is no versioning, every file has a single version with VersionId "null", as in an unversioned
+bucket.  Reads are memory-mapped, data is copied out of the page cache one requested block at a time.
+Errors that S3 would report are raised as botocore ClientErrors with S3's error codes, and multipart
+uploads are kept on disk, so they work across processes like S3's do.
+"""
+import mmap
+import os
+from os.path import dirname, exists, isdir, join, relpath
+from tempfile import mkstemp
+from typing import Generator
+from uuid import uuid4
+
+from botocore.exceptions import ClientError
+
+
+class LocalStorageError(Exception): pass
+
+
+def _client_error(operation_name: str, code: str, message: str, status_code: int) -> ClientError:
+    """ The exception boto3 raises for an error response from S3. """
+    return ClientError(
+        {'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': status_code}},
+        operation_name,
+    )
+
+
+def _read_files(file_paths) -> Generator:
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            yield f.read()
+
+
+class LocalObjectBody:
+    """ The Body of a get_object response, like botocore's StreamingBody. """
+
+    def __init__(self, file_path: str, start: int = 0, end: int = None):
+        self._file = open(file_path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # empty files cannot be memory-mapped
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._position = start
+        self._end = size if end is None else min(end, size)
+
+    def read(self, amt: int = None) -> bytes:
+        end = self._end if amt is None else min(self._position + amt, self._end)
+        data = self._map[self._position:end]
+        self._position = end
+        return data
+
+    def iter_chunks(self, chunk_size: int = 1024 * 1024) -> Generator:
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+
+class LocalPaginator:
+    def __init__(self, client: "LocalS3Client", operation_name: str):
+        self.client = client
+        self.operation_name = operation_name
+
+    def paginate(self, Bucket: str, Prefix: str = "") -> Generator:
+        """ Pages of (at most) 1000 keys, with either Contents or Versions like S3's. """
+        keys = sorted(self.client._list_keys(Bucket, Prefix))
+        for i in range(0, max(len(keys), 1), 1000):
+            page_keys = keys[i:i + 1000]
+            if not page_keys:
+                yield {'KeyCount': 0}
+            elif self.operation_name == 'list_objects_v2':
+                yield {'Contents': [{'Key': key, 'Size': self.client._size(Bucket, key)} for key in page_keys]}
+            elif self.operation_name == 'list_object_versions':
+                yield {'Versions': [{'Key': key, 'VersionId': "null", 'IsLatest': True} for key in page_keys]}
+            else:
+                raise LocalStorageError("no paginator for %s" % self.operation_name)
+
+
+class LocalS3Client:
+    """ Implements the subset of the boto3 S3 client used in libs.s3 and the scripts. """
+
+    def __init__(self, root_folder: str):
+        self.root_folder = root_folder
+
+    def _path(self, bucket: str, key: str) -> str:
+        path = join(self.root_folder, bucket, key)
+        # keys are not allowed to escape the bucket
+        if relpath(path, join(self.root_folder, bucket)).startswith(".."):
+            raise LocalStorageError("invalid key %s" % key)
+        return path
+
+    def _size(self, bucket: str, key: str) -> int:
+        return os.stat(self._path(bucket, key)).st_size
+
+    def _write(self, path: str, parts):
+        """ Writes atomically, readers see either the old file or the whole new one. """
+        os.makedirs(dirname(path), exist_ok=True)
+        descriptor, temp_path = mkstemp(dir=dirname(path), prefix=".upload_")
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                for part in parts:
+                    f.write(part)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _list_keys(self, bucket: str, prefix: str) -> Generator:
+        bucket_folder = join(self.root_folder, bucket)
+        # only walk the folder the prefix is in
+        start_folder = join(bucket_folder, prefix.rsplit("/", 1)[0]) if "/" in prefix else bucket_folder
+        if not isdir(start_folder):
+            return
+        for folder, _, file_names in os.walk(start_folder):
+            for file_name in file_names:
+                if file_name.startswith(".upload_"):
+                    continue
+                key = relpath(join(folder, file_name), bucket_folder)
+                if key.startswith(prefix):
+                    yield key
+
+    def _check_exists(self, operation_name: str, path: str, key: str):
+        if not exists(path):
+            raise _client_error(operation_name, "NoSuchKey", "The specified key does not exist: %s" % key, 404)
+
+    @staticmethod
+    def _etag(path: str) -> str:
+        """ Changes whenever the file is written, as S3's ETags do. """
+        stat = os.stat(path)
+        return '"%x-%x-%x"' % (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _check_if_match(self, operation_name: str, path: str, key: str, if_match: str = None):
+        """ Implements the IfMatch condition of reads and writes. """
+        if if_match is None:
+            return
+        self._check_exists(operation_name, path, key)
+        if self._etag(path) != if_match:
+            raise _client_error(operation_name, "PreconditionFailed", "At least one of the pre-conditions you "
+                                "specified did not hold", 412)
+
+    def put_object(self, Body, Bucket: str, Key: str, IfMatch: str = None, **kwargs) -> dict:
+        path = self._path(Bucket, Key)
+        self._check_if_match('PutObject', path, Key, IfMatch)
+        self._write(path, [Body])
+        return {'ETag': self._etag(path)}
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None, IfMatch: str = None, **kwargs) -> dict:
+        path = self._path(Bucket, Key)
+        self._check_exists('GetObject', path, Key)
+        self._check_if_match('GetObject', path, Key, IfMatch)
+        if Range is None:
+            body = LocalObjectBody(path)
+            return {'Body': body, 'ContentLength': body._end, 'ETag': self._etag(path)}
+        # only the "bytes=start-end" form is used
+        start, end = Range[len("bytes="):].split("-")
+        size = os.stat(path).st_size
+        start, end = int(start), min(int(end), size - 1)
+        return {
+            'Body': LocalObjectBody(path, start, end + 1),
+            'ContentLength': end + 1 - start,
+            'ContentRange': "bytes %d-%d/%d" % (start, end, size),
+            'ETag': self._etag(path),
+        }
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        path = self._path(Bucket, Key)
+        if not exists(path):
+            # head requests have no body, so S3 can only send the status code
+            raise _client_error('HeadObject', "404", "Not Found", 404)
+        return {'ContentLength': self._size(Bucket, Key), 'ETag': self._etag(path)}
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs) -> dict:
+        upload_id = uuid4().hex
+        os.makedirs(self._parts_folder(upload_id))
+        # the upload's bucket and key, so that any process can check them
+        self._write(join(self._parts_folder(upload_id), "target"), [("%s\n%s" % (Bucket, Key)).encode()])
+        return {'UploadId': upload_id}
+
+    def _parts_folder(self, upload_id: str) -> str:
+        return join(self.root_folder, ".multipart", upload_id)
+
+    def _check_upload(self, operation_name: str, Bucket: str, Key: str, UploadId: str):
+        try:
+            with open(join(self._parts_folder(UploadId), "target")) as f:
+                target = f.read()
+        except (FileNotFoundError, ValueError):
+            target = None
+        if target != "%s\n%s" % (Bucket, Key):
+            raise _client_error(
+                operation_name, "NoSuchUpload", "The specified upload does not exist: %s" % UploadId, 404
+            )
+
+    def upload_part(self, Body, Bucket: str, Key: str, UploadId: str, PartNumber: int, **kwargs) -> dict:
+        self._check_upload('UploadPart', Bucket, Key, UploadId)
+        self._write(join(self._parts_folder(UploadId), str(PartNumber)), [Body])
+        return {'ETag': '"%s-%s"' % (UploadId, PartNumber)}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict,
+                                  IfMatch: str = None, **kwargs) -> dict:
+        self._check_upload('CompleteMultipartUpload', Bucket, Key, UploadId)
+        self._check_if_match('CompleteMultipartUpload', self._path(Bucket, Key), Key, IfMatch)
+        part_paths = [join(self._parts_folder(UploadId), str(part['PartNumber']))
+                      for part in MultipartUpload['Parts']]
+        for part_path in part_paths:
+            if not exists(part_path):
+                raise _client_error(
+                    'CompleteMultipartUpload', "InvalidPart", "A part was not uploaded: %s" % part_path, 400
+                )
+        self._write(self._path(Bucket, Key), _read_files(part_paths))
+        self.abort_multipart_upload(Bucket, Key, UploadId)
+        return {'ETag': self._etag(self._path(Bucket, Key))}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str, **kwargs) -> dict:
+        parts_folder = self._parts_folder(UploadId)
+        if exists(parts_folder):
+            for file_name in os.listdir(parts_folder):
+                os.unlink(join(parts_folder, file_name))
+            os.rmdir(parts_folder)
+        return {}
+
+    def get_paginator(self, operation_name: str) -> LocalPaginator:
+        return LocalPaginator(self, operation_name)
+
+    def delete_objects(self, Bucket: str, Delete: dict, **kwargs) -> dict:
+        deleted = []
+        for s3_object in Delete['Objects']:
+            path = self._path(Bucket, s3_object['Key'])
+            if exists(path):
+                os.unlink(path)
+            deleted.append({'Key': s3_object['Key'], 'VersionId': s3_object.get('VersionId')})
+        return {'Deleted': deleted}
+
+    def list_buckets(self) -> dict:
+        return {'Buckets': [{'Name': name} for name in os.listdir(self.root_folder)
+                            if not name.startswith(".")]}
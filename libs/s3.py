@@ -1,47 +1,329 @@
+import logging
+from collections import deque
+from io import BytesIO
+from itertools import chain
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Callable, Generator, Iterable, Optional, Tuple
+
 import boto3
 import Crypto
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-from config.constants import DEFAULT_S3_RETRIES
+from config.constants import (CLIENT_PRIVATE_KEY_CACHE_SECONDS, CLIENT_PRIVATE_KEY_CACHE_SIZE,
+    DEFAULT_S3_RETRIES, S3_CLIENT_RETRIES, S3_CONNECT_TIMEOUT, S3_MAX_POOL_CONNECTIONS,
+    S3_MULTIPART_CONCURRENCY, S3_MULTIPART_PART_SIZE, S3_MULTIPART_THRESHOLD, S3_READ_TIMEOUT,
+    S3_RETRY_MODE, LOCAL_STORAGE_FOLDER, STORAGE_BACKEND)
 from config.settings import (BEIWE_SERVER_AWS_ACCESS_KEY_ID, BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
     S3_BUCKET, S3_REGION_NAME)
 from libs import encryption
+from libs.caching import ExpiringLRUCache
+from libs.local_storage import LocalS3Client
+from libs.threaded_pipeline import BoundedWorkQueue
 
 
 class S3VersionException(Exception): pass
-
-conn = boto3.client('s3',
-                    aws_access_key_id=BEIWE_SERVER_AWS_ACCESS_KEY_ID,
-                    aws_secret_access_key=BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
-                    region_name=S3_REGION_NAME)
-
-
-def s3_upload(key_path: str, data_string: bytes, study_object_id: str, raw_path=False) -> None:
+class S3DeletionException(Exception): pass
+
+# The size of the blocks that s3_retrieve_stream reads from S3, and so of the blocks it yields.
+S3_STREAM_BLOCK_SIZE = 1024 * 1024
+
+# Our own retries (DEFAULT_S3_RETRIES) wait a random time of up to RETRY_BACKOFF_BASE * 2**attempt
+# seconds, capped at RETRY_BACKOFF_CAP, so that threads that failed together do not retry together.
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_CAP = 20
+
+# The one S3 client, it is thread safe and shared by every thread in the process.  With the "local"
+# STORAGE_BACKEND it is a stand-in that keeps files on local disk (see libs.local_storage).
+if STORAGE_BACKEND == "local":
+    conn = LocalS3Client(LOCAL_STORAGE_FOLDER)
+else:
+    conn = boto3.client('s3',
+                        aws_access_key_id=BEIWE_SERVER_AWS_ACCESS_KEY_ID,
+                        aws_secret_access_key=BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
+                        region_name=S3_REGION_NAME,
+                        config=Config(
+                            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                            retries={'max_attempts': S3_CLIENT_RETRIES, 'mode': S3_RETRY_MODE},
+                            connect_timeout=S3_CONNECT_TIMEOUT,
+                            read_timeout=S3_READ_TIMEOUT,
+                        ))
+
+
+class ConnectionPoolSaturationMonitor(logging.Handler):
+    """ When every connection in its pool is in use, urllib3 (under boto3) opens an extra connection
+    and logs a warning as it discards it afterwards.  This counts those warnings and prints a message
+    at most every report_interval seconds, a pool that is often saturated should be made larger
+    (S3_MAX_POOL_CONNECTIONS) or used by fewer threads. """
+
+    def __init__(self, pool_size: int, report_interval: float = 60):
+        super().__init__(level=logging.WARNING)
+        self.pool_size = pool_size
+        self.report_interval = report_interval
+        self.saturation_count = 0
+        self._unreported_count = 0
+        self._last_report = None
+        self._count_lock = Lock()
+
+    def emit(self, record):
+        if not record.getMessage().startswith("Connection pool is full"):
+            return
+        with self._count_lock:
+            self.saturation_count += 1
+            self._unreported_count += 1
+            now = monotonic()
+            if self._last_report is not None and now - self._last_report < self.report_interval:
+                return
+            unreported_count, self._unreported_count, self._last_report = self._unreported_count, 0, now
+        print("S3 connection pool saturated: %s connections beyond the pool size of %s were needed"
+              % (unreported_count, self.pool_size))
+
+
+connection_pool_monitor = ConnectionPoolSaturationMonitor(S3_MAX_POOL_CONNECTIONS)
+logging.getLogger("urllib3.connectionpool").addHandler(connection_pool_monitor)
+
+
+def _retry(function, description: str, number_retries: int):
+    """ Calls function, retrying number_retries times on any exception with backoff and jitter.  A failed
+    condition (see _is_precondition_failure) will fail again, it is raised immediately. """
+    for attempt in range(number_retries + 1):
+        try:
+            return function()
+        except Exception as e:
+            if attempt >= number_retries or _is_precondition_failure(e):
+                raise
+            print("%s failed, retrying" % description)
+            sleep(uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** attempt)))
+
+
+def _is_precondition_failure(error: Exception) -> bool:
+    """ Whether error is S3 refusing a request made with IfMatch because the file has changed, or
+    is being changed by another request. """
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in (
+        "PreconditionFailed", "ConditionalRequestConflict"
+    )
+
+
+def s3_upload(key_path: str, data_string, study_object_id: str, raw_path=False) -> None:
+    """ Encrypts and uploads data_string, which can be bytes, an iterable of blocks of bytes or a
+    file-like object.  Iterables and file-like objects are encrypted as they are read.  Files larger
+    than S3_MULTIPART_THRESHOLD are uploaded in parts, several at a time. """
     if not raw_path:
         key_path = study_object_id + "/" + key_path
-    data = encryption.encrypt_for_server(data_string, study_object_id)
-    conn.put_object(Body=data, Bucket=S3_BUCKET, Key=key_path)#, ContentType='string')
+    if isinstance(data_string, str):
+        data_string = data_string.encode()
+    if isinstance(data_string, (bytes, bytearray)) and len(data_string) < S3_MULTIPART_THRESHOLD:
+        data = encryption.encrypt_for_server(data_string, study_object_id)
+        conn.put_object(Body=data, Bucket=S3_BUCKET, Key=key_path)#, ContentType='string')
+        return
+
+    encrypted_blocks = encryption.encrypt_server_stream(_source_blocks(data_string), study_object_id)
+    _do_upload_stream(S3_BUCKET, key_path, encrypted_blocks)
+
+
+def _do_upload_stream(bucket_name, key_path, encrypted_blocks: Iterable[bytes], **conditions):
+    """ Uploads already encrypted blocks, as a multipart upload if they add up to more than
+    S3_MULTIPART_THRESHOLD.  conditions (e.g. IfMatch) are passed to the request that writes the file. """
+    parts = _regroup_blocks(encrypted_blocks, S3_MULTIPART_PART_SIZE)
+    # read parts until the file is known to be larger than the threshold, small files are put whole.
+    first_parts, size = deque(), 0
+    for part in parts:
+        first_parts.append(part)
+        size += len(part)
+        if size > S3_MULTIPART_THRESHOLD:
+            break
+    else:
+        conn.put_object(Body=b"".join(first_parts), Bucket=bucket_name, Key=key_path, **conditions)
+        return
+    del part
+    _do_multipart_upload(bucket_name, key_path, chain(_drain(first_parts), parts), **conditions)
+
+
+def _source_blocks(source) -> Iterable[bytes]:
+    """ The data given to s3_upload as an iterable of blocks. """
+    if isinstance(source, (bytes, bytearray)):
+        return (source[i:i + S3_STREAM_BLOCK_SIZE] for i in range(0, len(source), S3_STREAM_BLOCK_SIZE))
+    if hasattr(source, "read"):
+        return iter(lambda: source.read(S3_STREAM_BLOCK_SIZE), b"")
+    return source
+
+
+def _regroup_blocks(blocks: Iterable[bytes], part_size: int) -> Generator:
+    """ Joins blocks into parts of at least part_size bytes, only the last part can be smaller. """
+    part, size = [], 0
+    for block in blocks:
+        part.append(block)
+        size += len(block)
+        if size >= part_size:
+            yield b"".join(part)
+            part, size = [], 0
+    if part:
+        yield b"".join(part)
+
+
+def _drain(items: deque) -> Generator:
+    # yields items while removing them, so they are not kept alive by the deque.
+    while items:
+        yield items.popleft()
+
+
+def _do_multipart_upload(bucket_name, key_path, parts: Iterable[bytes], **conditions):
+    """ Uploads parts as a multipart upload, S3_MULTIPART_CONCURRENCY at a time.  Reading parts blocks
+    while that many are uploading, so at most that many (plus one) are in memory.  The upload is
+    aborted if anything fails, S3 would otherwise keep (and charge for) the uploaded parts.
+    conditions are checked when the upload is completed. """
+    upload_id = conn.create_multipart_upload(Bucket=bucket_name, Key=key_path)['UploadId']
+    try:
+        with BoundedWorkQueue(_do_upload_part, S3_MULTIPART_CONCURRENCY, S3_MULTIPART_CONCURRENCY) as uploader:
+            for part_number, part in enumerate(parts, start=1):
+                uploader.submit((bucket_name, key_path, upload_id, part_number, part))
+                del part
+            uploaded_parts = uploader.finish()
+        conn.complete_multipart_upload(
+            Bucket=bucket_name, Key=key_path, UploadId=upload_id, MultipartUpload={'Parts': uploaded_parts},
+            **conditions
+        )
+    except BaseException:
+        conn.abort_multipart_upload(Bucket=bucket_name, Key=key_path, UploadId=upload_id)
+        raise
+
+
+def _do_upload_part(part_info, number_retries=DEFAULT_S3_RETRIES) -> dict:
+    """ Run-logic to upload one part of a multipart upload, part_info is
+    (bucket_name, key_path, upload_id, part_number, part). """
+    bucket_name, key_path, upload_id, part_number, part = part_info
+    response = _retry(
+        lambda: conn.upload_part(
+            Body=part, Bucket=bucket_name, Key=key_path, UploadId=upload_id, PartNumber=part_number
+        ),
+        "s3 part upload of part %s of %s" % (part_number, key_path),
+        number_retries,
+    )
+    return {'ETag': response['ETag'], 'PartNumber': part_number}
 
 
 def s3_retrieve(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES) -> bytes:
     """ Takes an S3 file path (key_path), and a study ID.  Takes an optional argument, raw_path,
     which defaults to false.  When set to false the path is prepended to place the file in the
-    appropriate study_id folder. """
+    appropriate study_id folder.
+    The file is decrypted as it is downloaded, so the encrypted and decrypted data are never both
+    fully in memory. """
+    contents = BytesIO()
+    for block in s3_retrieve_stream(key_path, study_object_id, raw_path=raw_path, number_retries=number_retries):
+        contents.write(block)
+    return contents.getvalue()  # BytesIO hands over its buffer here, this does not copy it
+
+
+def s3_retrieve_stream(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES,
+                       block_size=S3_STREAM_BLOCK_SIZE) -> "S3Stream":
+    """ As s3_retrieve, but returns an iterator of decrypted blocks of the file, which are decrypted
+    as they arrive from S3.  The request is made when the first block is read, so a stream that is
+    waiting to be read holds no connection.  Close it if it is not read to the end. """
     if not raw_path:
         key_path = study_object_id + "/" + key_path
-    encrypted_data = _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body'].read()
-    return encryption.decrypt_server(encrypted_data, study_object_id)
 
-
-def _do_retrieve(bucket_name, key_path, number_retries=DEFAULT_S3_RETRIES):
-    """ Run-logic to do a data retrieval for a file in an S3 bucket."""
+    def open_stream():
+        body = _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body']
+        try:
+            return encryption.decrypt_server_stream(body.iter_chunks(block_size), study_object_id), body
+        except Exception:
+            body.close()
+            raise
+
+    return S3Stream(open_stream)
+
+
+class S3Stream:
+    """ Iterator over the decrypted blocks of an S3 file.  open_stream makes the request, it is called
+    when the first block is read and returns the blocks and the response body.  The connection is
+    closed when the stream is exhausted or closed. """
+
+    def __init__(self, open_stream: Callable[[], Tuple[Generator, Any]]):
+        self.open_stream = open_stream
+        self.blocks = None
+        self.body = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            if self.blocks is None:
+                if self.open_stream is None:
+                    raise StopIteration  # closed before it was read
+                self.blocks, self.body = self.open_stream()
+            return next(self.blocks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self.open_stream = None
+        if self.blocks is not None:
+            self.blocks.close()
+            self.body.close()
+
+
+def s3_get_size(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES) -> int:
+    """ Gets the size of the decrypted contents of an S3 file, only the encryption header of the file
+    is downloaded.  raw_path works as in s3_retrieve. """
+    if not raw_path:
+        key_path = study_object_id + "/" + key_path
+    response = _do_retrieve_header(S3_BUCKET, key_path, number_retries=number_retries)
+    # ContentRange looks like "bytes 0-8/12345", the total size follows the slash.
+    encrypted_size = int(response['ContentRange'].rsplit("/", 1)[1])
+    return encryption.decrypted_server_size(encrypted_size, response['Body'].read())
+
+
+def s3_reencrypt(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES) -> bool:
+    """ Rewrites an S3 file stored in the legacy server encryption format in the current format, the
+    file is streamed through (large files are uploaded in parts) rather than held in memory.
+    Files already in the current format are left alone, only their header is downloaded.
+    The file is only read and rewritten if it is unchanged since its header was read (its ETag still
+    matches), a file that is rewritten meanwhile (e.g. a chunk that file processing added data to) is
+    skipped rather than overwritten with the stale copy.
+    Returns whether the file was rewritten.  raw_path works as in s3_retrieve. """
+    if not raw_path:
+        key_path = study_object_id + "/" + key_path
+    response = _do_retrieve_header(S3_BUCKET, key_path, number_retries=number_retries)
+    header = response['Body'].read()
+    if encryption.server_encryption_version(header) != encryption.SERVER_ENCRYPTION_LEGACY:
+        return False
+    etag = response['ETag']
     try:
-        return conn.get_object(Bucket=bucket_name, Key=key_path, ResponseContentType='string')
-    except Exception:
-        if number_retries > 0:
-            print("s3_retrieve failed, retrying on %s" % key_path)
-            return _do_retrieve(bucket_name, key_path, number_retries=number_retries - 1)
-        
+        body = _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries, IfMatch=etag)['Body']
+        try:
+            blocks = encryption.decrypt_server_stream(body.iter_chunks(S3_STREAM_BLOCK_SIZE), study_object_id)
+            encrypted_blocks = encryption.encrypt_server_stream(blocks, study_object_id, legacy=False)
+            _do_upload_stream(S3_BUCKET, key_path, encrypted_blocks, IfMatch=etag)
+        finally:
+            body.close()
+    except ClientError as e:
+        if _is_precondition_failure(e):
+            return False
         raise
+    return True
+
+
+def _do_retrieve_header(bucket_name, key_path, number_retries=DEFAULT_S3_RETRIES):
+    """ Run-logic to retrieve only the server encryption header of a file in an S3 bucket."""
+    byte_range = "bytes=0-%d" % (encryption.SERVER_ENCRYPTION_HEADER_LENGTH - 1)
+    return _retry(
+        lambda: conn.get_object(Bucket=bucket_name, Key=key_path, Range=byte_range),
+        "s3 header retrieval on %s" % key_path,
+        number_retries,
+    )
+
+
+def _do_retrieve(bucket_name, key_path, number_retries=DEFAULT_S3_RETRIES, **conditions):
+    """ Run-logic to do a data retrieval for a file in an S3 bucket."""
+    return _retry(
+        lambda: conn.get_object(Bucket=bucket_name, Key=key_path, ResponseContentType='string', **conditions),
+        "s3_retrieve on %s" % key_path,
+        number_retries,
+    )
 
 
 def s3_list_files(prefix, as_generator=False):
@@ -108,15 +390,40 @@ def _do_list_files_generator(page_iterator):
 def s3_delete(key_path):
     raise Exception("NO DONT DELETE")
 
+
+def s3_delete_versions(key_path) -> list:
+    """ Permanently deletes every version of the file at key_path (a full S3 path), returns the
+    VersionIds that were deleted.  Used to purge data, there is no way to recover the file. """
+    versions = s3_list_versions(key_path)
+    # delete_objects accepts at most 1000 objects per request, and reports the objects it failed to
+    # delete in its response instead of raising.
+    for i in range(0, len(versions), 1000):
+        response = conn.delete_objects(
+            Bucket=S3_BUCKET, Delete={'Objects': versions[i:i + 1000], 'Quiet': False}
+        )
+        if response.get('Errors'):
+            raise S3DeletionException("failed to delete %s: %s" % (key_path, ", ".join(
+                "%s (%s: %s)" % (error.get('VersionId'), error.get('Code'), error.get('Message'))
+                for error in response['Errors']
+            )))
+    return [version['VersionId'] for version in versions]
+
 ################################################################################
 ######################### Client Key Management ################################
 ################################################################################
 
+# Private keys are retrieved on every upload, they are cached by (study_id, patient_id) as (the key file,
+# the key).  Invalidation on key creation only reaches this process, other processes find out that their
+# key was replaced when decryption with it fails (see refresh_client_private_key).
+_client_private_key_cache = ExpiringLRUCache(CLIENT_PRIVATE_KEY_CACHE_SIZE, CLIENT_PRIVATE_KEY_CACHE_SECONDS)
+
+
 def create_client_key_pair(patient_id, study_id):
     """Generate key pairing, push to database, return sanitized key for client."""
     public, private = encryption.generate_key_pairing()
     s3_upload("keys/" + patient_id + "_private", private, study_id)
     s3_upload("keys/" + patient_id + "_public", public, study_id)
+    _client_private_key_cache.pop((study_id, patient_id))
 
 
 def get_client_public_key_string(patient_id, study_id) -> str:
@@ -132,6 +439,29 @@ def get_client_public_key(patient_id, study_id) -> Crypto.PublicKey.RSA._RSAobj:
 
 
 def get_client_private_key(patient_id, study_id) -> Crypto.PublicKey.RSA._RSAobj:
-    """Grabs a user's private key file from s3."""
+    """Grabs a user's private key file from s3, or from the cache if it was recently grabbed."""
+    cache_key = (study_id, patient_id)
+    cached = _client_private_key_cache.get(cache_key)
+    if cached is None:
+        key = s3_retrieve("keys/" + patient_id +"_private", study_id)
+        cached = key, encryption.get_RSA_cipher(key)
+        _client_private_key_cache.set(cache_key, cached)
+    return cached[1]
+
+
+def refresh_client_private_key(patient_id, study_id) -> Optional[Crypto.PublicKey.RSA._RSAobj]:
+    """ For when decryption with a participant's private key failed: the key may have been cached
+    before create_client_key_pair replaced it in another process.  The key is grabbed from s3 again,
+    it is returned if it is not the one that was cached.  Returns None if it is the same key, or if no
+    key was cached, retrying with it would fail the same way. """
+    cache_key = (study_id, patient_id)
+    cached = _client_private_key_cache.pop(cache_key)
+    if cached is None:
+        return None
     key = s3_retrieve("keys/" + patient_id +"_private", study_id)
-    return encryption.get_RSA_cipher(key)
+    if key == cached[0]:
+        _client_private_key_cache.set(cache_key, cached)
+        return None
+    private_key = encryption.get_RSA_cipher(key)
+    _client_private_key_cache.set(cache_key, (key, private_key))
+    return private_key
@@ -0,0 +1,91 @@
+"""
+Asyncio versions of the libs.s3 storage functions, for code that wants many S3 requests in flight at
+once without managing threads, plus synchronous facades that run a batch of them for existing code.
+
+boto3 is blocking, so the requests run on one thread pool shared by the whole process and sized to
+the S3 client's connection pool (S3_MAX_POOL_CONNECTIONS).  Any number of coroutines can be awaited
+at once, requests beyond the pool size wait in the pool's queue instead of each taking a thread or
+opening a connection.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterable, List, Tuple
+
+from config.constants import DEFAULT_S3_RETRIES, S3_MAX_POOL_CONNECTIONS
+from libs.s3 import (s3_delete_versions, s3_get_size, s3_list_files, s3_retrieve, s3_upload)
+
+_executor = ThreadPoolExecutor(max_workers=S3_MAX_POOL_CONNECTIONS)
+
+
+async def _run(function: Callable, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(function, *args, **kwargs))
+
+
+async def s3_retrieve_async(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES) -> bytes:
+    return await _run(s3_retrieve, key_path, study_object_id, raw_path=raw_path, number_retries=number_retries)
+
+
+async def s3_upload_async(key_path: str, data_string, study_object_id: str, raw_path=False) -> None:
+    return await _run(s3_upload, key_path, data_string, study_object_id, raw_path=raw_path)
+
+
+async def s3_get_size_async(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES) -> int:
+    return await _run(s3_get_size, key_path, study_object_id, raw_path=raw_path, number_retries=number_retries)
+
+
+async def s3_list_files_async(prefix) -> List[str]:
+    return await _run(s3_list_files, prefix)
+
+
+async def s3_delete_versions_async(key_path) -> List[str]:
+    return await _run(s3_delete_versions, key_path)
+
+
+def run_sync(coroutine):
+    """ Runs a coroutine to completion from synchronous code and returns its result.  Uses a new event
+    loop, so it works on any thread, but not from inside a coroutine. """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def gather_bounded(coroutine_function: Callable, arguments: Iterable[Tuple], max_pending: int) -> list:
+    """ Awaits coroutine_function(*args) for every tuple in arguments, at most max_pending at a time,
+    and returns the results in order.  Any exception is raised once the running calls finish. """
+    semaphore = asyncio.Semaphore(max_pending)
+
+    async def bounded(args):
+        async with semaphore:
+            return await coroutine_function(*args)
+
+    return await asyncio.gather(*(bounded(args) for args in arguments))
+
+
+#
+# Synchronous facades, each runs a batch of requests concurrently and returns the results in order.
+#
+
+def s3_retrieve_many(key_paths: Iterable[str], study_object_id, raw_path=False,
+                     max_pending=S3_MAX_POOL_CONNECTIONS) -> List[bytes]:
+    """ Keep max_pending modest, every retrieved file is held in memory until all are done. """
+    return run_sync(gather_bounded(
+        s3_retrieve_async, ((key_path, study_object_id, raw_path) for key_path in key_paths), max_pending
+    ))
+
+
+def s3_get_size_many(key_paths: Iterable[str], study_object_id, raw_path=False,
+                     max_pending=S3_MAX_POOL_CONNECTIONS) -> List[int]:
+    return run_sync(gather_bounded(
+        s3_get_size_async, ((key_path, study_object_id, raw_path) for key_path in key_paths), max_pending
+    ))
+
+
+def s3_list_files_many(prefixes: Iterable[str], max_pending=S3_MAX_POOL_CONNECTIONS) -> List[List[str]]:
+    return run_sync(gather_bounded(s3_list_files_async, ((prefix,) for prefix in prefixes), max_pending))
+
+
+def s3_delete_versions_many(key_paths: Iterable[str], max_pending=S3_MAX_POOL_CONNECTIONS) -> List[List[str]]:
+    return run_sync(gather_bounded(s3_delete_versions_async, ((key_path,) for key_path in key_paths), max_pending))
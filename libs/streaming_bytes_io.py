@@ -1,4 +1,4 @@
-from io import BytesIO, StringIO
+from io import BytesIO, StringIO, UnsupportedOperation
 
 
 class StreamingBytesIO(BytesIO):
@@ -55,3 +55,17 @@ class StreamingStringsIO(StringIO):
         """ Sets the position explicitly, required for compatibility with Python 3 Zipfile """
         self._position = args[0]
         return super(StreamingStringsIO, self).seek(0)
+
+
+class UnseekableStreamingBytesIO(StreamingBytesIO):
+    """
+    A StreamingBytesIO that Zipfile treats as unseekable.  Zipfile then follows each file with a data
+    descriptor instead of seeking back to rewrite the file's header once its size and crc are known,
+    which allows a file to be written into the zip in pieces, emptying the stream in between.
+    """
+
+    def seek(self, *args, **kwargs):
+        raise UnsupportedOperation("seek")
+
+    def seekable(self):
+        return False
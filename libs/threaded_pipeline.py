@@ -0,0 +1,202 @@
+"""
+Tools for overlapping the stages of a multi-stage job (e.g. download -> process -> upload) while
+keeping memory bounded: a stage never has more than a fixed number of items in flight, no matter
+how many items there are in total.
+"""
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+from typing import Callable, Generator, Iterable, List
+
+
+def imap_bounded(function: Callable, iterable: Iterable, threads: int, max_pending: int) -> Generator:
+    """ Like ThreadPool.imap (results are returned in order), but at most max_pending results are
+    outstanding at any time, counting both running calls and finished results that have not been
+    consumed yet.  A slow consumer therefore stalls the producers instead of accumulating results. """
+    max_pending = max(max_pending, 1)
+    executor = ThreadPoolExecutor(max_workers=threads)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+class BoundedWorkQueue:
+    """ Runs function on submitted items on a pool of threads.  submit blocks once max_pending items
+    are queued or running, so the submitting thread can never get far ahead of the workers.
+    Call finish to wait for all work and collect the results (in submission order). """
+
+    def __init__(self, function: Callable, threads: int, max_pending: int):
+        self.function = function
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.slots = BoundedSemaphore(max(max_pending, 1))
+        self.futures = []
+
+    def submit(self, item):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.function, item)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def finish(self) -> List:
+        try:
+            return [future.result() for future in self.futures]
+        finally:
+            self.executor.shutdown(wait=True)
+            self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # on error, let running work complete but do not collect it
+        self.executor.shutdown(wait=True)
+
+
+class AdaptiveConcurrency:
+    """ Chooses how many network operations to run at once by hill climbing on throughput.  Every
+    window (at least min_window_seconds, and at least as many completions as the current limit) the
+    throughput is compared to the last window's: the limit keeps moving in the same direction while
+    throughput improves, and turns around when it gets worse.  When going up stops helping the limit
+    stays put, when going down does not hurt it keeps going down.  A window whose typical latency has
+    more than doubled from the best seen without any gain in throughput also turns the limit down, the
+    extra requests are only queuing somewhere. """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, min_window_seconds: float = 1.0):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.min_window_seconds = min_window_seconds
+        self._direction = 1
+        self._last_throughput = None
+        self._best_latency = None
+        self._window_start = monotonic()
+        self._window_bytes = 0
+        self._window_latencies = []
+        self._lock = Lock()
+
+    def record(self, byte_count: int, latency: float, limited: bool = False):
+        """ Record a completed operation.  limited means that something other than the network
+        (e.g. a memory bound or a slow consumer) kept the limit from being used, those windows do
+        not grow the limit. """
+        with self._lock:
+            self._window_bytes += byte_count
+            self._window_latencies.append(latency)
+            elapsed = monotonic() - self._window_start
+            if elapsed < self.min_window_seconds or len(self._window_latencies) < self.limit:
+                return
+            self._adjust(self._window_bytes / elapsed, sorted(self._window_latencies)[len(self._window_latencies) // 2], limited)
+            self._window_start = monotonic()
+            self._window_bytes = 0
+            self._window_latencies = []
+
+    def _adjust(self, throughput: float, median_latency: float, limited: bool):
+        last_throughput = self._last_throughput
+        self._last_throughput = throughput
+        if self._best_latency is None or median_latency < self._best_latency:
+            self._best_latency = median_latency
+
+        if last_throughput is None or throughput > last_throughput * 1.1:
+            pass  # the first window, or the last step worked: keep going
+        elif throughput < last_throughput * 0.9:
+            self._direction = -self._direction
+        elif median_latency > self._best_latency * 2:
+            self._direction = -1
+        elif self._direction > 0:
+            return  # more did not help, stay put
+        # (fewer did not hurt, keep going down)
+        if limited and self._direction > 0:
+            return
+        step = max(1, self.limit // 4)
+        self.limit = min(max(self.limit + self._direction * step, self.minimum), self.maximum)
+
+
+def imap_adaptive(function: Callable, iterable: Iterable, cost: Callable, max_cost: int,
+                  concurrency: AdaptiveConcurrency, ordered: bool = True) -> Generator:
+    """ Yields (item, function(item)) for every item, running function on up to concurrency.maximum
+    threads, with the number actually running set by concurrency as it goes.  cost(item) estimates
+    the memory an item's result uses (e.g. its size in bytes), items are not started while the results
+    that are running or waiting to be consumed add up to more than max_cost, except that one item is
+    always allowed so that items larger than max_cost still go through.  Results are yielded in order
+    if ordered is True, otherwise as they complete.
+
+    The throughput concurrency sees is cost over the time function took, function should do all of
+    its transfer before returning.  Items with no cost (e.g. streams that the consumer reads later) are
+    not recorded.  Results that were never yielded are closed, if they have a close method. """
+    limited = False  # whether max_cost, rather than the concurrency limit, is holding items back
+
+    def timed(item, item_cost):
+        t_start = monotonic()
+        result = function(item)
+        if item_cost:
+            concurrency.record(item_cost, monotonic() - t_start, limited=limited)
+        return result
+
+    executor = ThreadPoolExecutor(max_workers=concurrency.maximum)
+    items = iter(iterable)
+    next_item = next(items, _NOTHING)
+    submitted = deque()  # (item, future, cost) in submission order, until ready
+    ready = deque()  # (item, future, cost) of finished items, until yielded
+    running = set()
+    pending_cost = 0
+    try:
+        while True:
+            # start as many items as the limits allow
+            limited = False
+            while next_item is not _NOTHING and len(running) < concurrency.limit:
+                item_cost = cost(next_item)
+                if submitted and pending_cost + item_cost > max_cost:
+                    limited = True
+                    break
+                future = executor.submit(timed, next_item, item_cost)
+                submitted.append((next_item, future, item_cost))
+                running.add(future)
+                pending_cost += item_cost
+                next_item = next(items, _NOTHING)
+
+            if not submitted:
+                return
+
+            # wait for something to finish, unless the next result to yield is already there
+            if running and not (ordered and submitted[0][1] not in running):
+                wait(running, return_when=FIRST_COMPLETED)
+            running = {future for future in running if not future.done()}
+
+            if ordered:
+                while submitted and submitted[0][1] not in running:
+                    ready.append(submitted.popleft())
+            else:
+                ready.extend(entry for entry in submitted if entry[1] not in running)
+                submitted = deque(entry for entry in submitted if entry[1] in running)
+
+            while ready:
+                item, future, item_cost = ready.popleft()
+                pending_cost -= item_cost
+                result = future.result()  # raises the function's exception, if any
+                del future
+                yield item, result
+                del result
+    finally:
+        for _, future, _ in submitted:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for _, future, _ in chain(ready, submitted):
+            if not future.cancelled() and future.exception() is None and hasattr(future.result(), "close"):
+                future.result().close()
+
+
+_NOTHING = object()
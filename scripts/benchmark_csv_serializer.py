@@ -0,0 +1,66 @@
+from os.path import abspath as _abspath
+from sys import argv, path as _path
+_one_folder_up = _abspath(__file__).rsplit('/',2)[0]
+_path.insert(1, _one_folder_up)
+
+from time import perf_counter
+
+from libs.csv_serializer import serialize_csv_rows
+
+"""
+Compares the original construct_csv_string implementation (repeated bytes concatenation) with the
+shared csv serializer on accelerometer-like rows.
+
+The original is quadratic, at 1M rows it would run for hours, so by default it is only run up to
+100k rows.  Pass --include-slow to run it at every size anyway.
+"""
+
+HEADER = b"timestamp,UTC time,accuracy,x,y,z"
+ROW_COUNTS = [10_000, 100_000, 1_000_000]
+SLOW_LIMIT = 100_000
+
+
+def original_construct_csv_string(header, rows_list):
+    rows = []
+    for row_items in rows_list:
+        rows.append(b",".join(row_items))
+    seen = set()
+    seen_add = seen.add
+    rows = [x for x in rows if not (x in seen or seen_add(x))]
+    ret = header
+    for row in rows:
+        ret += b"\n" + row
+    return ret
+
+
+def make_rows(count):
+    start = 1579996800000
+    return [
+        [b"%d" % (start + i * 100), b"2020-01-26T00:00:00.000", b"unknown",
+         b"0.%06d" % (i % 999983), b"-0.%06d" % (i % 7919), b"9.%06d" % (i % 104729)]
+        for i in range(count)
+    ]
+
+
+def time_it(function, rows):
+    t_start = perf_counter()
+    output = function(HEADER, rows)
+    return perf_counter() - t_start, output
+
+
+def run(include_slow=False):
+    print("%10s %14s %14s %10s" % ("rows", "original (s)", "serializer (s)", "speedup"))
+    for count in ROW_COUNTS:
+        rows = make_rows(count)
+        new_time, new_output = time_it(serialize_csv_rows, rows)
+
+        if count <= SLOW_LIMIT or include_slow:
+            old_time, old_output = time_it(original_construct_csv_string, rows)
+            assert old_output == new_output, "serializer output does not match the original"
+            print("%10d %14.3f %14.3f %9.1fx" % (count, old_time, new_time, old_time / new_time))
+        else:
+            print("%10d %14s %14.3f %10s" % (count, "skipped", new_time, "-"))
+
+
+if __name__ == "__main__":
+    run(include_slow="--include-slow" in argv)
@@ -0,0 +1,65 @@
+from os.path import abspath as _abspath
+from sys import path as _path
+_one_folder_up = _abspath(__file__).rsplit('/',2)[0]
+_path.insert(1, _one_folder_up)
+
+from os import urandom
+from time import perf_counter
+
+from Crypto.Cipher import AES
+
+from libs.encryption import decrypt_device_line, decrypt_device_lines
+from libs.security import encode_base64
+
+"""
+Compares decrypting a 50k line device upload one line at a time with decrypt_device_line (what
+decrypt_device_file used to do for every line) against the batch decrypt_device_lines.
+
+Lines are encrypted the way the apps do it: AES CBC with PKCS5 padding, a new iv on every line,
+"base64(iv):base64(data)".
+"""
+
+LINE_COUNT = 50_000
+REPEATS = 3
+
+
+def encrypt_line(key, plaintext):
+    iv = urandom(16)
+    padding = 16 - len(plaintext) % 16
+    padded = plaintext + bytes([padding]) * padding
+    return encode_base64(iv) + b":" + encode_base64(AES.new(key, AES.MODE_CBC, IV=iv).encrypt(padded))
+
+
+def make_lines(key):
+    start = 1579996800000
+    return [
+        encrypt_line(key, b"%d,42.%06d,-71.%06d,%d.0,%d.0" % (start + i * 1000, i % 999983, i % 7919, i % 97, i % 13))
+        for i in range(LINE_COUNT)
+    ]
+
+
+def best_time(function):
+    best = None
+    for _ in range(REPEATS):
+        t_start = perf_counter()
+        output = function()
+        elapsed = perf_counter() - t_start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def run():
+    key = urandom(16)
+    lines = make_lines(key)
+
+    per_line_time, per_line_output = best_time(lambda: [decrypt_device_line("", key, line) for line in lines])
+    batch_time, batch_output = best_time(lambda: decrypt_device_lines(key, lines))
+    assert per_line_output == batch_output, "batch decryption does not match per line decryption"
+
+    print("%d lines, best of %d" % (LINE_COUNT, REPEATS))
+    print("%-10s %8.3f s" % ("per line", per_line_time))
+    print("%-10s %8.3f s %6.1fx" % ("batch", batch_time, per_line_time / batch_time))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,54 @@
+from os.path import abspath as _abspath
+from sys import path as _path
+_one_folder_up = _abspath(__file__).rsplit('/',2)[0]
+_path.insert(1, _one_folder_up)
+
+from os import urandom
+from time import perf_counter
+
+from libs.encryption import decrypt_with_server_key, encrypt_with_server_key
+
+"""
+Compares the throughput of the legacy server encryption format (AES CFB with 8 bit segments) with
+the versioned AES CTR format, encrypting and decrypting a chunk sized blob of csv-like data.
+"""
+
+DATA_SIZE = 16 * 1024 * 1024
+REPEATS = 3
+
+
+def make_data():
+    line = b"1579996800000,2020-01-26T00:00:00.000,unknown,0.004837,-0.001223,9.806650\n"
+    return (line * (DATA_SIZE // len(line) + 1))[:DATA_SIZE]
+
+
+def best_time(function):
+    best = None
+    for _ in range(REPEATS):
+        t_start = perf_counter()
+        output = function()
+        elapsed = perf_counter() - t_start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def run():
+    key = urandom(16).hex().encode()[:32]  # study keys are 32 character strings
+    data = make_data()
+
+    print("%d MiB, best of %d" % (DATA_SIZE // 1024 // 1024, REPEATS))
+    baseline = None
+    for name, legacy in (("legacy CFB-8", True), ("CTR", False)):
+        encrypt_time, encrypted = best_time(lambda: encrypt_with_server_key(data, key, legacy=legacy))
+        decrypt_time, decrypted = best_time(lambda: decrypt_with_server_key(encrypted, key))
+        assert decrypted == data, "%s did not round trip" % name
+        baseline = baseline or (encrypt_time, decrypt_time)
+        for operation, elapsed, baseline_time in (("encrypt", encrypt_time, baseline[0]),
+                                                  ("decrypt", decrypt_time, baseline[1])):
+            print("%-14s %-8s %8.3f s %8.1f MiB/s %6.1fx" % (
+                name, operation, elapsed, DATA_SIZE / 1024 / 1024 / elapsed, baseline_time / elapsed
+            ))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,84 @@
+from os.path import abspath as _abspath
+from sys import path as _path
+_one_folder_up = _abspath(__file__).rsplit('/',2)[0]
+_path.insert(1, _one_folder_up)
+
+from datetime import datetime
+from time import perf_counter
+
+from config.constants import API_TIME_FORMAT
+from libs.file_processing import convert_unix_to_human_readable_timestamps
+
+"""
+Compares the original per-row convert_unix_to_human_readable_timestamps (a datetime and strftime call
+for every row) with the memoized formatter it now uses, and with the columnar engine's vectorized
+equivalent if numpy is installed, on one hour of 10 Hz accelerometer data.
+"""
+
+HEADER = b"timestamp,accuracy,x,y,z"
+HOUR_START = 1579996800000
+ROW_COUNT = 60 * 60 * 10
+REPEATS = 5
+
+
+def original_convert_unix_to_human_readable_timestamps(header, rows):
+    for row in rows:
+        unix_millisecond = int(row[0])
+        time_string = datetime.utcfromtimestamp(unix_millisecond // 1000).strftime(API_TIME_FORMAT).encode()
+        time_string += b".%03d" % (unix_millisecond % 1000)
+        row.insert(1, time_string)
+    header = header.split(b",")
+    header.insert(1, b"UTC time")
+    return b",".join(header)
+
+
+def make_rows():
+    return [
+        [b"%d" % (HOUR_START + i * 100), b"unknown", b"0.%06d" % (i % 999983),
+         b"-0.%06d" % (i % 7919), b"9.%06d" % (i % 104729)]
+        for i in range(ROW_COUNT)
+    ]
+
+
+def best_time(function, make_input):
+    """ Returns the best of REPEATS runs, and the output of the last one. """
+    best = None
+    for _ in range(REPEATS):
+        data = make_input()
+        t_start = perf_counter()
+        output = function(data)
+        elapsed = perf_counter() - t_start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def run():
+    original_time, original_rows = best_time(
+        lambda rows: original_convert_unix_to_human_readable_timestamps(HEADER, rows) and rows, make_rows
+    )
+    memoized_time, memoized_rows = best_time(
+        lambda rows: convert_unix_to_human_readable_timestamps(HEADER, rows) and rows, make_rows
+    )
+    assert original_rows == memoized_rows, "memoized output does not match the original"
+
+    print("%d rows (one hour at 10 Hz), best of %d" % (ROW_COUNT, REPEATS))
+    print("%-28s %8.3f s" % ("original", original_time))
+    print("%-28s %8.3f s %6.1fx" % ("memoized", memoized_time, original_time / memoized_time))
+
+    try:
+        from libs.columnar_chunk import ColumnarChunk
+    except ImportError:
+        print("%-28s %8s" % ("columnar", "skipped, numpy is not installed"))
+        return
+
+    body = b"".join(b",".join(row) + b"\n" for row in make_rows())
+    columnar_time, chunk = best_time(
+        lambda chunk: chunk.with_utc_time_column(), lambda: ColumnarChunk.from_csv_body(body)
+    )
+    assert list(chunk.rows()) == [b",".join(row) for row in original_rows], \
+        "columnar output does not match the original"
+    print("%-28s %8.3f s %6.1fx" % ("columnar", columnar_time, original_time / columnar_time))
+
+
+if __name__ == "__main__":
+    run()
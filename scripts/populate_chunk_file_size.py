@@ -6,26 +6,54 @@ _path.insert(1, _one_folder_up)
 from config import load_django
 from datetime import datetime
 
+from django.db.models import Q
+
+from config.constants import CONCURRENT_NETWORK_OPS
 from database.data_access_models import ChunkRegistry
-from libs.s3 import conn, S3_BUCKET
+from libs.s3 import s3_get_size
+from libs.threaded_pipeline import imap_bounded
+
+"""
+Sets the file_size of ChunkRegistry entries to the size of their decrypted contents, as read from the
+encryption header of the S3 file (see s3_get_size).  This covers entries without a size, and chunks,
+because file processing used to record the size of its zlib-compressed copy of a chunk; data access
+uses file_size to decide which files to stream and how much memory a download holds.
+Entries are only updated if they are unchanged since they were read, so this can run while data
+processing does, and can be stopped and rerun at any time.
+"""
 
 print("start:", datetime.now())
 
 # stick study object ids here to process particular studies
 study_object_ids = []
 
-filters = dict(file_size__isnull=True)
+query = ChunkRegistry.objects.filter(Q(file_size__isnull=True) | Q(is_chunkable=True))
 if study_object_ids:
-    filters["study__object_id__in"] = study_object_ids
+    query = query.filter(study__object_id__in=study_object_ids)
 
 # this could be a huge query, use the iterator
-query = ChunkRegistry.objects.filter(**filters).values_list("pk", "chunk_path").iterator()
+query = query.values_list("pk", "chunk_path", "study__object_id", "last_updated", "file_size").iterator()
+
+
+def populate(chunk):
+    pk, path, study_object_id, last_updated, file_size = chunk
+    try:
+        size = s3_get_size(path, study_object_id, raw_path=True)
+    except Exception as e:
+        print("could not get the size of %s: %s" % (path, e))
+        return False
+    if size == file_size:
+        return False
+    # (.update() leaves last_updated alone, so clients do not download these chunks again.)
+    return bool(ChunkRegistry.objects.filter(pk=pk, last_updated=last_updated).update(file_size=size))
 
 
-for i, (pk, path) in enumerate(query):
+updated = 0
+results = imap_bounded(populate, query, threads=CONCURRENT_NETWORK_OPS, max_pending=CONCURRENT_NETWORK_OPS * 2)
+for i, was_updated in enumerate(results):
     if i % 1000 == 0:
-        print(i)
-    size = conn.head_object(Bucket=S3_BUCKET, Key=path)["ContentLength"]
-    ChunkRegistry.objects.filter(pk=pk).update(file_size=size)
+        print(i, "entries checked,", updated, "updated")
+    updated += was_updated
 
+print(updated, "entries updated")
 print("end:", datetime.now())
@@ -17,12 +17,12 @@ _imp.load_source("__init__", _current_folder_init)
 
 # noinspection PyUnresolvedReferences
 from config import load_django
-from config.settings import S3_BUCKET
 from config.constants import CHUNKS_FOLDER, API_TIME_FORMAT
 from database.user_models import Participant
 from database.data_access_models import ChunkRegistry
 from libs.file_processing import unix_time_to_string
-from libs.s3 import s3_list_files, s3_list_versions, conn as s3_conn
+from libs.s3 import s3_list_files
+from libs.s3_async import s3_delete_versions_many
 
 
 UNIX_EPOCH_START = datetime(1970,1,1)
@@ -179,24 +179,14 @@ def assemble_chunked_files(s3_chunks_files, expunge_start_date):
 
 def delete_versions(files_to_delete):
     print("Deleting many files, this could take a while...")
-    for s3_file_path in files_to_delete:
-        file_args = s3_list_versions(s3_file_path)
-
+    # files are deleted concurrently, see libs.s3_async
+    deleted_version_ids = s3_delete_versions_many(files_to_delete)
+    for s3_file_path, version_ids in zip(files_to_delete, deleted_version_ids):
         print(
-            "Deleting %s version(s) of %s with the following VersionIds: %s" %
-            (len(file_args), s3_file_path, ", ".join([f['VersionId'] for f in file_args]) )
+            "Deleted %s version(s) of %s with the following VersionIds: %s" %
+            (len(version_ids), s3_file_path, ", ".join(version_ids))
         )
 
-        delete_args = {
-            "Bucket": S3_BUCKET,
-            "Delete": {
-                'Objects': file_args,
-                'Quiet': False,
-            },
-        }
-
-        s3_conn.delete_objects(**delete_args)
-
 
 setup_data = setup()
 delete_chunk_registries(setup_data)
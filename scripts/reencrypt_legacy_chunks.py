@@ -0,0 +1,58 @@
+from os.path import abspath as _abspath
+from sys import path as _path
+_one_folder_up = _abspath(__file__).rsplit('/',2)[0]
+_path.insert(1, _one_folder_up)
+
+from config import load_django
+from datetime import datetime
+
+from config.constants import CONCURRENT_NETWORK_OPS, WRITE_LEGACY_SERVER_ENCRYPTION
+from database.data_access_models import ChunkRegistry
+from libs.s3 import s3_reencrypt
+from libs.threaded_pipeline import imap_bounded
+
+"""
+Rewrites chunks still stored in the legacy server encryption format (AES CFB-8) in the current
+format, which is much faster to read.  Chunks that are already converted are skipped after
+downloading their header, so this can be stopped and rerun at any time.  It can also run while data
+processing does: a chunk is only rewritten if it is unchanged since this read it (see s3_reencrypt),
+chunks that processing rewrites meanwhile are skipped.  Run it in the background on any server, e.g.
+nohup python scripts/reencrypt_legacy_chunks.py &
+Servers that cannot read the current format must all be gone first, so this refuses to run while
+WRITE_LEGACY_SERVER_ENCRYPTION is set, and processing rewrites chunks in the legacy format.
+"""
+
+if WRITE_LEGACY_SERVER_ENCRYPTION:
+    exit("WRITE_LEGACY_SERVER_ENCRYPTION is set, chunks are still written in the legacy format.")
+
+print("start:", datetime.now())
+
+# stick study object ids here to process particular studies
+study_object_ids = []
+
+filters = {}
+if study_object_ids:
+    filters["study__object_id__in"] = study_object_ids
+
+# this could be a huge query, use the iterator
+query = ChunkRegistry.objects.filter(**filters).values_list("chunk_path", "study__object_id").iterator()
+
+
+def reencrypt(path_and_study):
+    path, study_object_id = path_and_study
+    try:
+        return s3_reencrypt(path, study_object_id, raw_path=True)
+    except Exception as e:
+        print("could not re-encrypt %s: %s" % (path, e))
+        return False
+
+
+converted = 0
+results = imap_bounded(reencrypt, query, threads=CONCURRENT_NETWORK_OPS, max_pending=CONCURRENT_NETWORK_OPS * 2)
+for i, was_converted in enumerate(results):
+    if i % 1000 == 0:
+        print(i, "chunks checked,", converted, "converted")
+    converted += was_converted
+
+print(converted, "chunks converted")
+print("end:", datetime.now())